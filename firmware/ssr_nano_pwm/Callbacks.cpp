@@ -15,15 +15,56 @@ SerialReceiver& g_serial_receiver = controller.getSerialReceiver();
 
 IndexedContainer<PwmInfo,constants::INDEXED_PWMS_COUNT_MAX> g_indexed_pwms;
 
+// one waveform for each high frequency relay, the only relays that can dim
+Waveform g_waveforms[constants::HIGH_FREQ_RELAY_COUNT];
+
+// position of the first method argument in the current request
+int g_serial_receiver_position = 1;
+
+// Arguments come in order from the json message or, for binary
+// requests, the frame, where position is not needed.
+int readIntArg(int& position)
+{
+  if (controller.messageIsBinary())
+  {
+    return controller.getFrameReceiver().readInt();
+  }
+  return g_serial_receiver.readInt(position++);
+}
+
+long readLongArg(int& position)
+{
+  if (controller.messageIsBinary())
+  {
+    return controller.getFrameReceiver().readLong();
+  }
+  return g_serial_receiver.readLong(position++);
+}
+
+// Returns the index of relay in high_freq_relay_pins, or -1 when
+// relay can only be switched fully on or off.
+int getHighFreqIndex(int relay)
+{
+  uint8_t relay_pin = constants::relay_pins[relay];
+  for (uint8_t r=0; r<constants::HIGH_FREQ_RELAY_COUNT; ++r)
+  {
+    if (relay_pin == constants::high_freq_relay_pins[r])
+    {
+      return r;
+    }
+  }
+  return -1;
+}
+
 void startPwmCallback()
 {
-  int serial_receiver_position = 1;
-  int relay = g_serial_receiver.readInt(serial_receiver_position++);
+  int serial_receiver_position = g_serial_receiver_position;
+  int relay = readIntArg(serial_receiver_position);
   if ((relay < 0) || (relay >= constants::RELAY_COUNT))
   {
     return;
   }
-  int power = g_serial_receiver.readInt(serial_receiver_position++);
+  int power = readIntArg(serial_receiver_position);
   if (power < constants::power_min)
   {
     power = constants::power_min;
@@ -32,27 +73,14 @@ void startPwmCallback()
   {
     power = constants::power_max;
   }
-  if (power < constants::power_max)
+  if ((power < constants::power_max) && (getHighFreqIndex(relay) < 0))
   {
-    uint8_t relay_pin = constants::relay_pins[relay];
-    bool relay_pin_is_high_freq = false;
-    for (uint8_t r=0; r<constants::HIGH_FREQ_RELAY_COUNT; ++r)
-    {
-      if (relay_pin == constants::high_freq_relay_pins[r])
-      {
-        relay_pin_is_high_freq = true;
-        break;
-      }
-    }
-    if (!relay_pin_is_high_freq)
-    {
-      power = constants::power_max;
-    }
+    power = constants::power_max;
   }
 
-  long delay = g_serial_receiver.readLong(serial_receiver_position++);
-  long count = g_serial_receiver.readInt(serial_receiver_position++);
-  int pwm_level_count = g_serial_receiver.readInt(serial_receiver_position++);
+  long delay = readLongArg(serial_receiver_position);
+  long count = readIntArg(serial_receiver_position);
+  int pwm_level_count = readIntArg(serial_receiver_position);
   if (pwm_level_count < constants::PWM_LEVEL_COUNT_MIN)
   {
     pwm_level_count = constants::PWM_LEVEL_COUNT_MIN;
@@ -66,8 +94,8 @@ void startPwmCallback()
     return;
   }
 
-  long period = g_serial_receiver.readLong(serial_receiver_position++);
-  long on_duration = g_serial_receiver.readLong(serial_receiver_position++);
+  long period = readLongArg(serial_receiver_position);
+  long on_duration = readLongArg(serial_receiver_position);
 
   PwmInfo pwm_info;
   pwm_info.relay = relay;
@@ -84,8 +112,8 @@ void startPwmCallback()
     pwm_info.power = power;
     pwm_info.level = pwm_level;
     pwm_info.child_index = index;
-    period = g_serial_receiver.readLong(serial_receiver_position++);
-    on_duration = g_serial_receiver.readLong(serial_receiver_position++);
+    period = readLongArg(serial_receiver_position);
+    on_duration = readLongArg(serial_receiver_position);
     pwm_info.period = period;
     pwm_info.on_duration = on_duration;
     index = g_indexed_pwms.add(pwm_info);
@@ -119,12 +147,145 @@ void stopAllPwmCallback()
 {
   EventController::event_controller.removeAllEvents();
   g_indexed_pwms.clear();
+  stopAllWaveforms();
   controller.openAllRelays();
   controller.setAllPwmStatusStopped();
+  controller.resetPulseCounts();
 }
 
 void getPowerCallback()
 {
+  writePower();
+}
+
+void getPwmStatusCallback()
+{
+  writePwmStatus();
+}
+
+void getStateCallback()
+{
+  if (controller.messageIsBinary())
+  {
+    controller.getFrameWriter().writeLong(millis());
+    writePower();
+    writePwmStatus();
+    writePulseCounts();
+    return;
+  }
+  Serial << "[" << millis() << ",";
+  writePower();
+  Serial << ",";
+  writePwmStatus();
+  Serial << ",";
+  writePulseCounts();
+  Serial << "]";
+}
+
+void setNotifyCallback()
+{
+  int serial_receiver_position = g_serial_receiver_position;
+  int relay = readIntArg(serial_receiver_position);
+  if ((relay < 0) || (relay >= constants::RELAY_COUNT))
+  {
+    return;
+  }
+  int level = readIntArg(serial_receiver_position);
+  controller.setNotifyLevel(relay,level);
+}
+
+void getPulseCountsCallback()
+{
+  if (controller.messageIsBinary())
+  {
+    controller.getFrameWriter().writeLong(millis());
+    writePulseCounts();
+    return;
+  }
+  Serial << "[" << millis() << ",";
+  writePulseCounts();
+  Serial << "]";
+}
+
+void setFrameRelayCallback()
+{
+  int serial_receiver_position = g_serial_receiver_position;
+  int relay = readIntArg(serial_receiver_position);
+  controller.setFrameRelay(relay);
+}
+
+void setProtocolCallback()
+{
+  int serial_receiver_position = g_serial_receiver_position;
+  int protocol = readIntArg(serial_receiver_position);
+  controller.setProtocol(protocol);
+  if (controller.messageIsBinary())
+  {
+    controller.getFrameWriter().writeUint8(controller.getProtocol());
+    return;
+  }
+  Serial << controller.getProtocol();
+}
+
+// Sets the level, the start offset and the point count of the
+// waveform of a relay and up to WAVEFORM_POINTS_PER_REQUEST of its
+// points from first_point on, so a whole table arrives as a few
+// pipelined requests in any order. The offset only applies to the
+// next on period, to pick up a waveform part way through.
+void setWaveformCallback()
+{
+  int serial_receiver_position = g_serial_receiver_position;
+  int relay = readIntArg(serial_receiver_position);
+  if ((relay < 0) || (relay >= constants::RELAY_COUNT))
+  {
+    return;
+  }
+  int index = getHighFreqIndex(relay);
+  if (index < 0)
+  {
+    return;
+  }
+  int level = readIntArg(serial_receiver_position);
+  long offset = readLongArg(serial_receiver_position);
+  int point_count = readIntArg(serial_receiver_position);
+  int first_point = readIntArg(serial_receiver_position);
+  if ((level < 0) || (level >= constants::PWM_LEVEL_COUNT_MAX) ||
+      (point_count < 0) || (point_count > constants::WAVEFORM_POINT_COUNT_MAX) ||
+      (first_point < 0) || (first_point > point_count))
+  {
+    return;
+  }
+  Waveform& waveform = g_waveforms[index];
+  waveform.relay = relay;
+  waveform.level = level;
+  waveform.offset = (offset > 0) ? offset : 0;
+  waveform.point_count = point_count;
+  for (int point=first_point; (point<point_count) && (point<first_point+constants::WAVEFORM_POINTS_PER_REQUEST); ++point)
+  {
+    waveform.times[point] = readLongArg(serial_receiver_position);
+    int power = readIntArg(serial_receiver_position);
+    if (power < constants::power_min)
+    {
+      power = constants::power_min;
+    }
+    else if (power > constants::power_max)
+    {
+      power = constants::power_max;
+    }
+    waveform.powers[point] = power;
+  }
+}
+
+void writePower()
+{
+  if (controller.messageIsBinary())
+  {
+    for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
+    {
+      controller.getFrameWriter().writeUint8(controller.getPower(relay));
+    }
+    return;
+  }
   Serial << "[";
   int power;
   for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
@@ -136,11 +297,29 @@ void getPowerCallback()
     power = controller.getPower(relay);
     Serial << power;
   }
-  Serial << "]\n";
+  Serial << "]";
 }
 
-void getPwmStatusCallback()
+// Binary results hold the pwm status of each relay as one byte with a
+// bit per level.
+void writePwmStatus()
 {
+  if (controller.messageIsBinary())
+  {
+    for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
+    {
+      uint8_t pwm_status_bits = 0;
+      for (uint8_t level=0; level<=constants::PWM_LEVEL_COUNT_MAX; ++level)
+      {
+        if (controller.getPwmStatus(relay,level) == constants::PWM_RUNNING)
+        {
+          pwm_status_bits |= (1 << level);
+        }
+      }
+      controller.getFrameWriter().writeUint8(pwm_status_bits);
+    }
+    return;
+  }
   Serial << "[";
   constants::PwmStatus pwm_status;
   for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
@@ -161,7 +340,142 @@ void getPwmStatusCallback()
     }
     Serial << "]";
   }
-  Serial << "]\n";
+  Serial << "]";
+}
+
+void writePulseCounts()
+{
+  if (controller.messageIsBinary())
+  {
+    for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
+    {
+      controller.getFrameWriter().writeLong(controller.getPulseCount(relay));
+    }
+    return;
+  }
+  Serial << "[";
+  for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
+  {
+    if (relay > 0)
+    {
+      Serial << ",";
+    }
+    Serial << controller.getPulseCount(relay);
+  }
+  Serial << "]";
+}
+
+// Returns the power of the waveform at index elapsed ms into its on
+// period and sets next_elapsed to when that power changes next, or to
+// elapsed when it never does. Power is linear between points,
+// truncated toward zero, and holds before the first and after the
+// last point.
+int getWaveformPower(int index, unsigned long elapsed, unsigned long& next_elapsed)
+{
+  Waveform& waveform = g_waveforms[index];
+  next_elapsed = elapsed;
+  uint8_t point = 0;
+  while ((point < waveform.point_count) && (waveform.times[point] <= elapsed))
+  {
+    ++point;
+  }
+  if (point == 0)
+  {
+    next_elapsed = waveform.times[0];
+    return waveform.powers[0];
+  }
+  if (point == waveform.point_count)
+  {
+    return waveform.powers[point-1];
+  }
+  unsigned long time_0 = waveform.times[point-1];
+  unsigned long duration = waveform.times[point] - time_0;
+  int power_0 = waveform.powers[point-1];
+  int power_delta = (int)waveform.powers[point] - power_0;
+  if (power_delta == 0)
+  {
+    next_elapsed = waveform.times[point];
+    return power_0;
+  }
+  unsigned long power_delta_abs = (power_delta > 0) ? power_delta : -power_delta;
+  // 64 bit, since power times duration overflows 32 bits after 4.6 hours
+  unsigned long step = ((unsigned long long)power_delta_abs*(elapsed - time_0))/duration;
+  next_elapsed = time_0 + ((unsigned long long)(step + 1)*duration + power_delta_abs - 1)/power_delta_abs;
+  if (power_delta > 0)
+  {
+    return power_0 + step;
+  }
+  return power_0 - step;
+}
+
+// Sets the power of a running waveform at its elapsed time and
+// schedules the next step for when the power changes next, so a ramp
+// runs on exact board times without stepping when nothing changes.
+void updateWaveform(int index)
+{
+  Waveform& waveform = g_waveforms[index];
+  unsigned long next_elapsed;
+  waveform.power = getWaveformPower(index,waveform.elapsed,next_elapsed);
+  if (next_elapsed > waveform.elapsed)
+  {
+    waveform.step_event_id = EventController::event_controller.addEventUsingDelay(waveformStepEventCallback,
+                                                                                 next_elapsed - waveform.elapsed,
+                                                                                 index);
+    waveform.step_pending = true;
+    waveform.elapsed = next_elapsed;
+  }
+}
+
+void startWaveform(int index)
+{
+  stopWaveform(index);
+  Waveform& waveform = g_waveforms[index];
+  waveform.running = true;
+  waveform.elapsed = waveform.offset;
+  waveform.offset = 0;
+  updateWaveform(index);
+}
+
+void stopWaveform(int index)
+{
+  Waveform& waveform = g_waveforms[index];
+  if (waveform.step_pending)
+  {
+    EventController::event_controller.removeEvent(waveform.step_event_id);
+    waveform.step_pending = false;
+  }
+  waveform.running = false;
+}
+
+// Waveform tables are kept, only their playback stops.
+void stopAllWaveforms()
+{
+  for (uint8_t index=0; index<constants::HIGH_FREQ_RELAY_COUNT; ++index)
+  {
+    g_waveforms[index].step_pending = false;
+    g_waveforms[index].running = false;
+  }
+}
+
+// Returns the power of the pwm at index, or of the waveform of its
+// relay while one is running or about to start on its level.
+int getPwmPower(int index)
+{
+  int high_freq_index = getHighFreqIndex(g_indexed_pwms[index].relay);
+  if (high_freq_index >= 0)
+  {
+    Waveform& waveform = g_waveforms[high_freq_index];
+    if (waveform.running)
+    {
+      return waveform.power;
+    }
+    if ((waveform.point_count > 0) && (waveform.level == g_indexed_pwms[index].level))
+    {
+      unsigned long next_elapsed;
+      return getWaveformPower(high_freq_index,waveform.offset,next_elapsed);
+    }
+  }
+  return g_indexed_pwms[index].power;
 }
 
 // EventController Callbacks
@@ -170,6 +484,7 @@ void setParentPwmStatusRunningEventCallback(int index)
   int relay = g_indexed_pwms[index].relay;
   int level = g_indexed_pwms[index].level + 1;
   controller.setPwmStatusRunning(relay,level);
+  controller.notify(relay,level,getPwmPower(index));
 }
 
 void removeParentAndChildren(int index)
@@ -187,6 +502,7 @@ void setParentPwmStatusStoppedEventCallback(int index)
   int relay = g_indexed_pwms[index].relay;
   int level = g_indexed_pwms[index].level + 1;
   controller.setPwmStatusStopped(relay,level);
+  controller.notify(relay,level,constants::power_min);
   removeParentAndChildren(index);
 }
 
@@ -195,11 +511,22 @@ void startPowerPwmEventCallback(int index)
   int relay = g_indexed_pwms[index].relay;
   int level = g_indexed_pwms[index].level;
   controller.setPwmStatusRunning(relay,level);
+  int high_freq_index = getHighFreqIndex(relay);
+  if ((high_freq_index >= 0) &&
+      (g_waveforms[high_freq_index].point_count > 0) &&
+      (g_waveforms[high_freq_index].level == level))
+  {
+    startWaveform(high_freq_index);
+  }
+  int power = getPwmPower(index);
   int child_index = g_indexed_pwms[index].child_index;
   if (child_index < 0)
   {
-    int power = g_indexed_pwms[index].power;
     controller.setRelayPower(relay,power);
+    if (g_indexed_pwms[index].power > constants::power_min)
+    {
+      controller.countPulse(relay);
+    }
   }
   else
   {
@@ -214,6 +541,7 @@ void startPowerPwmEventCallback(int index)
                                                                                  on_duration,
                                                                                  child_index);
   }
+  controller.notify(relay,level,power);
 }
 
 void stopPwmEventCallback(int index)
@@ -222,6 +550,14 @@ void stopPwmEventCallback(int index)
   controller.openRelay(relay);
   int level = g_indexed_pwms[index].level;
   controller.setPwmStatusStopped(relay,level);
+  int high_freq_index = getHighFreqIndex(relay);
+  if ((high_freq_index >= 0) &&
+      g_waveforms[high_freq_index].running &&
+      (g_waveforms[high_freq_index].level == level))
+  {
+    stopWaveform(high_freq_index);
+  }
+  controller.notify(relay,level,constants::power_min);
   int child_index = g_indexed_pwms[index].child_index;
   if (child_index >= 0)
   {
@@ -230,4 +566,26 @@ void stopPwmEventCallback(int index)
   }
 }
 
+// The relay only takes the new power while its fastest level is on,
+// the next pulse picks it up otherwise.
+void waveformStepEventCallback(int index)
+{
+  Waveform& waveform = g_waveforms[index];
+  waveform.step_pending = false;
+  if (!waveform.running)
+  {
+    return;
+  }
+  int power = waveform.power;
+  updateWaveform(index);
+  if (waveform.power != power)
+  {
+    if (controller.getPwmStatus(waveform.relay,0) == constants::PWM_RUNNING)
+    {
+      controller.setRelayPower(waveform.relay,waveform.power);
+    }
+    controller.notify(waveform.relay,waveform.level,waveform.power);
+  }
+}
+
 }
@@ -27,6 +27,31 @@ struct PwmInfo
   EventController::EventIdPair event_id_pair;
 };
 
+// Piecewise-linear power over the on periods of one pwm level of a
+// high frequency relay, times in ms from the start of the on period.
+struct Waveform
+{
+  int relay;
+  int level;
+  long offset;
+  uint8_t point_count;
+  unsigned long times[constants::WAVEFORM_POINT_COUNT_MAX];
+  uint8_t powers[constants::WAVEFORM_POINT_COUNT_MAX];
+  bool running;
+  unsigned long elapsed;
+  int power;
+  bool step_pending;
+  EventController::EventId step_event_id;
+};
+
+extern int g_serial_receiver_position;
+
+int readIntArg(int& position);
+
+long readLongArg(int& position);
+
+int getHighFreqIndex(int relay);
+
 void startPwmCallback();
 
 void stopAllPwmCallback();
@@ -35,6 +60,36 @@ void getPowerCallback();
 
 void getPwmStatusCallback();
 
+void getStateCallback();
+
+void setNotifyCallback();
+
+void getPulseCountsCallback();
+
+void setFrameRelayCallback();
+
+void setProtocolCallback();
+
+void setWaveformCallback();
+
+void writePower();
+
+void writePwmStatus();
+
+void writePulseCounts();
+
+int getWaveformPower(int index, unsigned long elapsed, unsigned long& next_elapsed);
+
+void updateWaveform(int index);
+
+void startWaveform(int index);
+
+void stopWaveform(int index);
+
+void stopAllWaveforms();
+
+int getPwmPower(int index);
+
 // EventController Callbacks
 void setParentPwmStatusRunningEventCallback(int index);
 
@@ -46,5 +101,7 @@ void startPowerPwmEventCallback(int index);
 
 void stopPwmEventCallback(int index);
 
+void waveformStepEventCallback(int index);
+
 }
 #endif
@@ -17,6 +17,17 @@ enum{HIGH_FREQ_RELAY_COUNT=2};
 enum{INDEXED_PWMS_COUNT_MAX=16};
 enum{PWM_LEVEL_COUNT_MIN=1};
 enum{PWM_LEVEL_COUNT_MAX=3};
+enum{NOTIFY_LEVEL_DISABLED=PWM_LEVEL_COUNT_MAX+1};
+enum{NOTIFICATION_QUEUE_SIZE=16};
+enum{REQUEST_ID_HISTORY_SIZE=8};
+enum{FRAME_RELAY_DISABLED=-1};
+enum{FRAME_SYNC=0xA5};
+enum{FRAME_PAYLOAD_SIZE_MAX=64};
+enum{FRAME_REQUEST_SIZE_MIN=6};
+enum{FRAME_TIMEOUT=50};
+enum{CRC_INIT=0xFFFF};
+enum{WAVEFORM_POINT_COUNT_MAX=16};
+enum{WAVEFORM_POINTS_PER_REQUEST=4};
 
 enum
   {
@@ -24,6 +35,26 @@ enum
     METHOD_ID_STOP_ALL_PULSES,
     METHOD_ID_GET_POWER,
     METHOD_ID_GET_PWM_STATUS,
+    METHOD_ID_GET_STATE,
+    METHOD_ID_SET_NOTIFY,
+    METHOD_ID_REQUEST_ID,
+    METHOD_ID_GET_PULSE_COUNTS,
+    METHOD_ID_SET_FRAME_RELAY,
+    METHOD_ID_SET_PROTOCOL,
+    METHOD_ID_SET_WAVEFORM,
+  };
+
+enum Protocol
+  {
+    PROTOCOL_JSON=0,
+    PROTOCOL_BINARY=1,
+  };
+
+enum FrameKind
+  {
+    FRAME_KIND_REQUEST=0,
+    FRAME_KIND_REPLY=1,
+    FRAME_KIND_NOTIFICATION=2,
   };
 
 enum PwmStatus
@@ -20,8 +20,17 @@ void Controller::setup()
   {
     pinMode(constants::relay_pins[relay],OUTPUT);
     openRelay(relay);
+    notify_level_[relay] = constants::NOTIFY_LEVEL_DISABLED;
   }
   setAllPwmStatusStopped();
+  resetPulseCounts();
+  frame_relay_ = constants::FRAME_RELAY_DISABLED;
+  notification_head_ = 0;
+  notification_count_ = 0;
+  notification_seq_ = 0;
+  clearRequestIds();
+  message_is_binary_ = false;
+  protocol_ = constants::PROTOCOL_JSON;
 
   // Setup Streams
   Serial.begin(constants::baudrate);
@@ -33,13 +42,32 @@ void Controller::update()
   // Check if message is available
   while (Serial.available() > 0)
   {
-    serial_receiver_.process(Serial.read());
-    if (serial_receiver_.messageReady())
+    uint8_t byte = Serial.read();
+    // json text never holds the sync byte, so it can only start a frame
+    if (frame_receiver_.active() || (byte == constants::FRAME_SYNC))
     {
-      processMessage();
-      serial_receiver_.reset();
+      frame_receiver_.process(byte);
+      if (frame_receiver_.messageReady())
+      {
+        processFrame();
+        frame_receiver_.reset();
+      }
     }
+    else
+    {
+      serial_receiver_.process(byte);
+      if (serial_receiver_.messageReady())
+      {
+        processMessage();
+        serial_receiver_.reset();
+      }
+    }
+  }
+  if (frame_receiver_.timedOut())
+  {
+    frame_receiver_.reset();
   }
+  writeNotifications();
 }
 
 SerialReceiver& Controller::getSerialReceiver()
@@ -47,6 +75,42 @@ SerialReceiver& Controller::getSerialReceiver()
   return serial_receiver_;
 }
 
+FrameReceiver& Controller::getFrameReceiver()
+{
+  return frame_receiver_;
+}
+
+FrameWriter& Controller::getFrameWriter()
+{
+  return frame_writer_;
+}
+
+// Callbacks read arguments from and write results to the frame when
+// the request being processed came as a binary frame.
+bool Controller::messageIsBinary()
+{
+  return message_is_binary_;
+}
+
+// Notifications are written in the protocol the host asked for last,
+// requests are always answered in the protocol they came in. Every
+// host that connects sets the protocol first and numbers its requests
+// from the start again, so the request ids of the last host are
+// forgotten.
+void Controller::setProtocol(int protocol)
+{
+  if ((protocol == constants::PROTOCOL_JSON) || (protocol == constants::PROTOCOL_BINARY))
+  {
+    protocol_ = (constants::Protocol)protocol;
+  }
+  clearRequestIds();
+}
+
+constants::Protocol Controller::getProtocol()
+{
+  return protocol_;
+}
+
 void Controller::closeRelay(int relay)
 {
   digitalWrite(constants::relay_pins[relay],HIGH);
@@ -111,12 +175,205 @@ constants::PwmStatus Controller::getPwmStatus(int relay, int level)
   return pwm_status_[relay][level];
 }
 
+void Controller::setNotifyLevel(int relay, int level)
+{
+  if (level < 0)
+  {
+    level = 0;
+  }
+  else if (level > constants::NOTIFY_LEVEL_DISABLED)
+  {
+    level = constants::NOTIFY_LEVEL_DISABLED;
+  }
+  notify_level_[relay] = level;
+}
+
+// Called from EventController callbacks, so only queue the
+// notification here and write it to serial from update(). power is
+// the power of the pwm level that changed, not the instantaneous
+// relay power, so child pwm levels with notifications disabled do not
+// alias into it.
+void Controller::notify(int relay, int level, int power)
+{
+  if (level < notify_level_[relay])
+  {
+    return;
+  }
+  uint8_t sreg = SREG;
+  cli();
+  if (notification_count_ < constants::NOTIFICATION_QUEUE_SIZE)
+  {
+    uint8_t tail = (notification_head_ + notification_count_) % constants::NOTIFICATION_QUEUE_SIZE;
+    Notification& notification = notifications_[tail];
+    notification.seq = notification_seq_;
+    notification.time = millis();
+    notification.frame = -1;
+    if (frame_relay_ != constants::FRAME_RELAY_DISABLED)
+    {
+      notification.frame = pulse_counts_[frame_relay_];
+    }
+    notification.relay = relay;
+    notification.level = level;
+    notification.pwm_status = pwm_status_[relay][level];
+    notification.power = power;
+    ++notification_count_;
+  }
+  // seq still advances when the queue is full so the host can detect dropped notifications
+  ++notification_seq_;
+  SREG = sreg;
+}
+
+// Called from EventController callbacks each time a relay is switched
+// on, so a camera trigger relay counts the frames it triggered.
+void Controller::countPulse(int relay)
+{
+  ++pulse_counts_[relay];
+}
+
+unsigned long Controller::getPulseCount(int relay)
+{
+  noInterrupts();
+  unsigned long pulse_count = pulse_counts_[relay];
+  interrupts();
+  return pulse_count;
+}
+
+void Controller::resetPulseCounts()
+{
+  noInterrupts();
+  for (uint8_t relay=0; relay<constants::RELAY_COUNT; ++relay)
+  {
+    pulse_counts_[relay] = 0;
+  }
+  interrupts();
+}
+
+// Notifications carry the pulse count of frame_relay as a frame
+// stamp, FRAME_RELAY_DISABLED leaves it out.
+void Controller::setFrameRelay(int relay)
+{
+  if ((relay < 0) || (relay >= constants::RELAY_COUNT))
+  {
+    relay = constants::FRAME_RELAY_DISABLED;
+  }
+  frame_relay_ = relay;
+}
+
+void Controller::writeNotifications()
+{
+  Notification notification;
+  while (true)
+  {
+    noInterrupts();
+    if (notification_count_ == 0)
+    {
+      interrupts();
+      break;
+    }
+    notification = notifications_[notification_head_];
+    notification_head_ = (notification_head_ + 1) % constants::NOTIFICATION_QUEUE_SIZE;
+    --notification_count_;
+    interrupts();
+    if (protocol_ == constants::PROTOCOL_BINARY)
+    {
+      frame_writer_.begin(constants::FRAME_KIND_NOTIFICATION);
+      frame_writer_.writeLong(notification.seq);
+      frame_writer_.writeLong(notification.time);
+      frame_writer_.writeLong(notification.frame);
+      frame_writer_.writeUint8(notification.relay);
+      frame_writer_.writeUint8(notification.level);
+      frame_writer_.writeUint8(notification.pwm_status);
+      frame_writer_.writeUint8(notification.power);
+      frame_writer_.end();
+      continue;
+    }
+    // keys are read from flash, so they do not take up sram
+    Serial << F("{\"seq\":") << notification.seq;
+    Serial << F(",\"time\":") << notification.time;
+    if (notification.frame >= 0)
+    {
+      Serial << F(",\"frame\":") << notification.frame;
+    }
+    Serial << F(",\"relay\":") << notification.relay;
+    Serial << F(",\"level\":") << notification.level;
+    Serial << F(",\"pwm_status\":") << notification.pwm_status;
+    Serial << F(",\"power\":") << notification.power;
+    Serial << "}\n";
+  }
+}
+
+// Requests are either [method_id,args...] or
+// [METHOD_ID_REQUEST_ID,request_id,method_id,args...]. The second
+// form is always answered with [request_id] or [request_id,result] so
+// the host can match replies to pipelined requests and retry lost ones.
 void Controller::processMessage()
 {
-  int method_id;
+  int position = 0;
+  int method_id = serial_receiver_.readInt(position++);
+  long request_id = -1;
+  if (method_id == constants::METHOD_ID_REQUEST_ID)
+  {
+    request_id = serial_receiver_.readLong(position++);
+    method_id = serial_receiver_.readInt(position++);
+  }
+  callbacks::g_serial_receiver_position = position;
+  message_is_binary_ = false;
 
-  method_id = serial_receiver_.readInt(0);
+  bool has_result = methodHasResult(method_id);
+  if (request_id >= 0)
+  {
+    Serial << "[" << request_id;
+    if (has_result)
+    {
+      Serial << ",";
+    }
+    else if (requestIdIsDuplicate(request_id))
+    {
+      // retry of a request that was already run, only resend the reply
+      Serial << "]\n";
+      return;
+    }
+  }
+
+  runMethod(method_id);
+
+  if (request_id >= 0)
+  {
+    Serial << "]\n";
+  }
+  else if (has_result)
+  {
+    Serial << "\n";
+  }
+}
+
+// Binary requests always carry a request id and are answered with a
+// reply frame of the method id, the result if it has one and the
+// request id.
+void Controller::processFrame()
+{
+  if ((frame_receiver_.getLength() < constants::FRAME_REQUEST_SIZE_MIN) ||
+      (frame_receiver_.getKind() != constants::FRAME_KIND_REQUEST))
+  {
+    return;
+  }
+  int method_id = frame_receiver_.getMethodId();
+  long request_id = frame_receiver_.getRequestId();
+  message_is_binary_ = true;
+  frame_writer_.begin(constants::FRAME_KIND_REPLY);
+  frame_writer_.writeUint8(method_id);
+  // retry of a request that was already run, only resend the reply
+  if (methodHasResult(method_id) || !requestIdIsDuplicate(request_id))
+  {
+    runMethod(method_id);
+  }
+  frame_writer_.writeLong(request_id);
+  frame_writer_.end();
+  message_is_binary_ = false;
+}
 
+void Controller::runMethod(int method_id)
+{
   switch (method_id)
   {
     case constants::METHOD_ID_START_PWM:
@@ -131,9 +388,65 @@ void Controller::processMessage()
     case constants::METHOD_ID_GET_PWM_STATUS:
       callbacks::getPwmStatusCallback();
       break;
+    case constants::METHOD_ID_GET_STATE:
+      callbacks::getStateCallback();
+      break;
+    case constants::METHOD_ID_SET_NOTIFY:
+      callbacks::setNotifyCallback();
+      break;
+    case constants::METHOD_ID_GET_PULSE_COUNTS:
+      callbacks::getPulseCountsCallback();
+      break;
+    case constants::METHOD_ID_SET_FRAME_RELAY:
+      callbacks::setFrameRelayCallback();
+      break;
+    case constants::METHOD_ID_SET_PROTOCOL:
+      callbacks::setProtocolCallback();
+      break;
+    case constants::METHOD_ID_SET_WAVEFORM:
+      callbacks::setWaveformCallback();
+      break;
     default:
       break;
   }
 }
 
+bool Controller::methodHasResult(int method_id)
+{
+  switch (method_id)
+  {
+    case constants::METHOD_ID_GET_POWER:
+    case constants::METHOD_ID_GET_PWM_STATUS:
+    case constants::METHOD_ID_GET_STATE:
+    case constants::METHOD_ID_GET_PULSE_COUNTS:
+    case constants::METHOD_ID_SET_PROTOCOL:
+      return true;
+    default:
+      return false;
+  }
+}
+
+void Controller::clearRequestIds()
+{
+  for (uint8_t i=0; i<constants::REQUEST_ID_HISTORY_SIZE; ++i)
+  {
+    request_ids_[i] = -1;
+  }
+  request_id_index_ = 0;
+}
+
+bool Controller::requestIdIsDuplicate(long request_id)
+{
+  for (uint8_t i=0; i<constants::REQUEST_ID_HISTORY_SIZE; ++i)
+  {
+    if (request_ids_[i] == request_id)
+    {
+      return true;
+    }
+  }
+  request_ids_[request_id_index_] = request_id;
+  request_id_index_ = (request_id_index_ + 1) % constants::REQUEST_ID_HISTORY_SIZE;
+  return false;
+}
+
 Controller controller;
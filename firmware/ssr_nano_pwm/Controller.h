@@ -11,8 +11,20 @@
 #include "TimerOne.h"
 #include "EventController.h"
 #include "Constants.h"
+#include "Frame.h"
 #include "Callbacks.h"
 
+struct Notification
+{
+  unsigned long seq;
+  unsigned long time;
+  long frame;
+  uint8_t relay;
+  uint8_t level;
+  uint8_t pwm_status;
+  uint8_t power;
+};
+
 class Controller
 {
 public:
@@ -20,6 +32,11 @@ public:
   void setup();
   void update();
   SerialReceiver& getSerialReceiver();
+  FrameReceiver& getFrameReceiver();
+  FrameWriter& getFrameWriter();
+  bool messageIsBinary();
+  void setProtocol(int protocol);
+  constants::Protocol getProtocol();
 
   void closeRelay(int relay);
   void openRelay(int relay);
@@ -30,11 +47,36 @@ public:
   void setAllPwmStatusStopped();
   int getPower(int relay);
   constants::PwmStatus getPwmStatus(int relay, int level);
+  void setNotifyLevel(int relay, int level);
+  void notify(int relay, int level, int power);
+  void countPulse(int relay);
+  unsigned long getPulseCount(int relay);
+  void resetPulseCounts();
+  void setFrameRelay(int relay);
 private:
   SerialReceiver serial_receiver_;
+  FrameReceiver frame_receiver_;
+  FrameWriter frame_writer_;
+  bool message_is_binary_;
+  constants::Protocol protocol_;
   int power_[constants::RELAY_COUNT];
   constants::PwmStatus pwm_status_[constants::RELAY_COUNT][constants::PWM_LEVEL_COUNT_MAX+1];
+  int notify_level_[constants::RELAY_COUNT];
+  volatile unsigned long pulse_counts_[constants::RELAY_COUNT];
+  int frame_relay_;
+  Notification notifications_[constants::NOTIFICATION_QUEUE_SIZE];
+  volatile uint8_t notification_head_;
+  volatile uint8_t notification_count_;
+  volatile unsigned long notification_seq_;
+  long request_ids_[constants::REQUEST_ID_HISTORY_SIZE];
+  uint8_t request_id_index_;
   void processMessage();
+  void processFrame();
+  void runMethod(int method_id);
+  bool methodHasResult(int method_id);
+  void clearRequestIds();
+  bool requestIdIsDuplicate(long request_id);
+  void writeNotifications();
 };
 
 extern Controller controller;
@@ -0,0 +1,194 @@
+// ----------------------------------------------------------------------------
+// Frame.cpp
+//
+//
+// Authors:
+// Peter Polidoro polidorop@janelia.hhmi.org
+// ----------------------------------------------------------------------------
+#include "Frame.h"
+#include <util/crc16.h>
+
+
+FrameReceiver::FrameReceiver()
+{
+  reset();
+}
+
+void FrameReceiver::reset()
+{
+  state_ = WAIT_SYNC;
+  length_ = 0;
+  position_ = 0;
+}
+
+void FrameReceiver::process(uint8_t byte)
+{
+  byte_time_ = millis();
+  switch (state_)
+  {
+    case WAIT_SYNC:
+      if (byte == constants::FRAME_SYNC)
+      {
+        crc_ = constants::CRC_INIT;
+        state_ = LENGTH;
+      }
+      break;
+    case LENGTH:
+      if (byte > constants::FRAME_PAYLOAD_SIZE_MAX)
+      {
+        reset();
+        break;
+      }
+      length_ = byte;
+      position_ = 0;
+      crc_ = _crc_xmodem_update(crc_,byte);
+      state_ = (length_ > 0) ? PAYLOAD : CRC_LOW;
+      break;
+    case PAYLOAD:
+      payload_[position_++] = byte;
+      crc_ = _crc_xmodem_update(crc_,byte);
+      if (position_ == length_)
+      {
+        state_ = CRC_LOW;
+      }
+      break;
+    case CRC_LOW:
+      crc_received_ = byte;
+      state_ = CRC_HIGH;
+      break;
+    case CRC_HIGH:
+      crc_received_ |= ((uint16_t)byte << 8);
+      if (crc_received_ == crc_)
+      {
+        // arguments follow the kind and method id
+        position_ = 2;
+        state_ = READY;
+      }
+      else
+      {
+        // the host retries requests that get no reply
+        reset();
+      }
+      break;
+    case READY:
+      break;
+  }
+}
+
+bool FrameReceiver::active()
+{
+  return (state_ != WAIT_SYNC) && (state_ != READY);
+}
+
+bool FrameReceiver::messageReady()
+{
+  return state_ == READY;
+}
+
+// A frame that stops arriving part way through is dropped, so one
+// lost byte never swallows the requests after it.
+bool FrameReceiver::timedOut()
+{
+  return active() && ((millis() - byte_time_) > constants::FRAME_TIMEOUT);
+}
+
+uint8_t FrameReceiver::getLength()
+{
+  return length_;
+}
+
+uint8_t FrameReceiver::getKind()
+{
+  return payload_[0];
+}
+
+uint8_t FrameReceiver::getMethodId()
+{
+  return payload_[1];
+}
+
+long FrameReceiver::getRequestId()
+{
+  return readUint32(length_ - 4);
+}
+
+// Arguments past the end of the frame read as 0, the same as missing
+// arguments of a json request.
+int FrameReceiver::readInt()
+{
+  uint16_t value = 0;
+  if ((position_ + 2) <= (length_ - 4))
+  {
+    value = payload_[position_] | ((uint16_t)payload_[position_+1] << 8);
+  }
+  position_ += 2;
+  return (int16_t)value;
+}
+
+long FrameReceiver::readLong()
+{
+  uint32_t value = 0;
+  if ((position_ + 4) <= (length_ - 4))
+  {
+    value = readUint32(position_);
+  }
+  position_ += 4;
+  return (int32_t)value;
+}
+
+uint32_t FrameReceiver::readUint32(uint8_t position)
+{
+  return ((uint32_t)payload_[position] |
+          ((uint32_t)payload_[position+1] << 8) |
+          ((uint32_t)payload_[position+2] << 16) |
+          ((uint32_t)payload_[position+3] << 24));
+}
+
+FrameWriter::FrameWriter()
+{
+  length_ = 0;
+}
+
+void FrameWriter::begin(uint8_t kind)
+{
+  length_ = 0;
+  writeUint8(kind);
+}
+
+void FrameWriter::writeUint8(uint8_t value)
+{
+  if (length_ < constants::FRAME_PAYLOAD_SIZE_MAX)
+  {
+    payload_[length_++] = value;
+  }
+}
+
+void FrameWriter::writeInt(int value)
+{
+  writeUint8(value & 0xFF);
+  writeUint8((value >> 8) & 0xFF);
+}
+
+void FrameWriter::writeLong(long value)
+{
+  uint32_t bits = value;
+  for (uint8_t i=0; i<4; ++i)
+  {
+    writeUint8(bits & 0xFF);
+    bits >>= 8;
+  }
+}
+
+void FrameWriter::end()
+{
+  uint16_t crc = _crc_xmodem_update(constants::CRC_INIT,length_);
+  for (uint8_t i=0; i<length_; ++i)
+  {
+    crc = _crc_xmodem_update(crc,payload_[i]);
+  }
+  Serial.write((uint8_t)constants::FRAME_SYNC);
+  Serial.write(length_);
+  Serial.write(payload_,length_);
+  Serial.write((uint8_t)(crc & 0xFF));
+  Serial.write((uint8_t)(crc >> 8));
+}
@@ -0,0 +1,68 @@
+// ----------------------------------------------------------------------------
+// Frame.h
+//
+//
+// Authors:
+// Peter Polidoro polidorop@janelia.hhmi.org
+// ----------------------------------------------------------------------------
+#ifndef FRAME_H
+#define FRAME_H
+#include "Arduino.h"
+#include "Constants.h"
+
+
+// Binary frames are FRAME_SYNC, the payload length, the payload and a
+// CRC-16/CCITT of the length and payload, low byte first. Request and
+// reply payloads are the frame kind, the method id, the arguments or
+// result and the request id as the last four bytes. All values are
+// little endian.
+class FrameReceiver
+{
+public:
+  FrameReceiver();
+  void reset();
+  void process(uint8_t byte);
+  bool active();
+  bool messageReady();
+  bool timedOut();
+  uint8_t getLength();
+  uint8_t getKind();
+  uint8_t getMethodId();
+  long getRequestId();
+  int readInt();
+  long readLong();
+private:
+  enum State
+  {
+    WAIT_SYNC,
+    LENGTH,
+    PAYLOAD,
+    CRC_LOW,
+    CRC_HIGH,
+    READY,
+  };
+  State state_;
+  uint8_t payload_[constants::FRAME_PAYLOAD_SIZE_MAX];
+  uint8_t length_;
+  uint8_t position_;
+  uint16_t crc_;
+  uint16_t crc_received_;
+  unsigned long byte_time_;
+  uint32_t readUint32(uint8_t position);
+};
+
+class FrameWriter
+{
+public:
+  FrameWriter();
+  void begin(uint8_t kind);
+  void writeUint8(uint8_t value);
+  void writeInt(int value);
+  void writeLong(long value);
+  void end();
+private:
+  uint8_t payload_[constants::FRAME_PAYLOAD_SIZE_MAX];
+  uint8_t length_;
+};
+
+#endif
@@ -5,6 +5,7 @@
 #include "Constants.h"
 #include "Callbacks.h"
 #include "Controller.h"
+#include "Frame.h"
 
 #include "TimerOne.h"
 #include "EventController.h"
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+'''
+Performance benchmarks of the sleep_assay host code.
+
+The relay board is a VirtualRelayBoard on the far side of a
+pseudo-terminal, so every request goes through SerialDevice, the
+serial port driver and SerialTransport exactly as it would with a
+board attached, without the board itself. Needs linux or osx.
+
+Measures request round trip latency per method, the highest frame
+rate update_run sustains and cpu time per frame with each protocol,
+the bytes each request and reply take on the wire, data writer
+throughput, and writes them to a json file under results/ that
+--compare can diff against the results of another release.
+'''
+from __future__ import print_function, division
+import argparse
+import datetime
+import json
+import os
+import platform
+import pty
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+import numpy as np
+import yaml
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+from sleep_assay import SleepAssay, DataWriter, VirtualRelayBoard, Clock, VirtualClock
+from sleep_assay.protocol import PROTOCOLS, RequestEncoder
+
+
+RESULTS_VERSION = 1
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR,'results')
+CONFIG_FILE_PATH = os.path.join(BENCHMARKS_DIR,os.pardir,os.pardir,os.pardir,'config','example_config.yaml')
+
+REQUEST_COUNT = 200
+FRAME_RATE_DURATION = 5.0
+LOGGING_ROW_COUNT = 200000
+# high enough that the camera trigger never limits update_run
+CAMERA_FRAME_RATE = 500
+WRITE_WRITE_DELAYS = (0.05,0)
+# the baud rate of the relay board firmware, 10 bits per byte on the wire
+BAUDRATE = 9600
+
+METHODS = (('stop_all_pulses',[1]),
+           ('get_power',[2]),
+           ('get_pwm_status',[3]),
+           ('get_state',[4]),
+           ('get_pulse_counts',[7]))
+
+
+class PtyRelayBoard(object):
+    '''
+    VirtualRelayBoard answering on the master side of a
+    pseudo-terminal. Open port like a serial port.
+    '''
+    def __init__(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._board = VirtualRelayBoard(Clock())
+        self._running = True
+        self._thread = threading.Thread(target=self._run,name='pty_relay_board')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            readable, _, _ = select.select([self._master],[],[],0.001)
+            if readable:
+                self._board.write(os.read(self._master,4096))
+            chars = self._board.read(self._board.in_waiting)
+            if chars:
+                os.write(self._master,chars)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class PtyRelayBoardProcess(object):
+    '''
+    PtyRelayBoard in a child process, so cpu times measured in this
+    process only count the host code.
+    '''
+    def __init__(self):
+        self._process = subprocess.Popen([sys.executable,os.path.abspath(__file__),'--pty-board'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self.port = self._process.stdout.readline().decode().strip()
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+
+def serve_pty_board():
+    board = PtyRelayBoard()
+    print(board.port)
+    sys.stdout.flush()
+    # serve until the parent closes stdin
+    sys.stdin.read()
+    board.close()
+
+
+def _stats_ms(durations):
+    durations_ms = 1000*np.asarray(durations)
+    return {'mean_ms': float(np.mean(durations_ms)),
+            'p50_ms': float(np.percentile(durations_ms,50)),
+            'p90_ms': float(np.percentile(durations_ms,90)),
+            'p99_ms': float(np.percentile(durations_ms,99)),
+            'max_ms': float(np.max(durations_ms))}
+
+
+def _write_config(port,output_dir):
+    with open(CONFIG_FILE_PATH,'r') as config_stream:
+        config = yaml.safe_load(config_stream)
+    config['relay_board_serial_port'] = {'linux': port,
+                                         'osx': port,
+                                         'windows': port}
+    config['start']['offset_days'] = -1
+    config['camera_trigger']['frame_rate_hz'] = CAMERA_FRAME_RATE
+    config['data_writer'] = {'output_dir': output_dir}
+    config_file_path = os.path.join(output_dir,'benchmark_config.yaml')
+    with open(config_file_path,'w') as config_stream:
+        yaml.safe_dump(config,config_stream)
+    return config_file_path
+
+
+def benchmark_request_latency(sa,count):
+    results = {}
+    for name, args in METHODS:
+        durations = []
+        for i in range(count):
+            time_start = time.perf_counter()
+            sa._send_request_get_result(*args)
+            durations.append(time.perf_counter() - time_start)
+        results[name] = _stats_ms(durations)
+    return results
+
+
+def benchmark_frame_rate(sa,duration):
+    sa.start_run('benchmark')
+    frame_durations = []
+    cpu_start = time.process_time()
+    time_start = time.perf_counter()
+    time_stop = time_start + duration
+    time_frame = time_start
+    while time_frame < time_stop:
+        sa.update_run()
+        time_now = time.perf_counter()
+        frame_durations.append(time_now - time_frame)
+        time_frame = time_now
+    cpu_time = time.process_time() - cpu_start
+    sa.finish_run()
+    frame_count = len(frame_durations)
+    results = {'frame_rate_hz': frame_count/(time_frame - time_start),
+               'cpu_ms_per_frame': 1000*cpu_time/frame_count}
+    results.update(_stats_ms(frame_durations))
+    return results
+
+
+def benchmark_message_bytes():
+    '''
+    Bytes on the wire of each request and its reply in each protocol,
+    and how long they take to send at the board baud rate.
+    '''
+    results = {}
+    for protocol_name, protocol in sorted(PROTOCOLS.items()):
+        board = VirtualRelayBoard(VirtualClock())
+        board.write(RequestEncoder().encode(1,[9,protocol]))
+        board.read(board.in_waiting)
+        encoder = RequestEncoder(protocol)
+        for name, args in METHODS:
+            request = encoder.encode(1000,args)
+            board.write(request)
+            reply = board.read(board.in_waiting)
+            results.setdefault(name,{})[protocol_name] = {'request_bytes': len(request),
+                                                          'reply_bytes': len(reply),
+                                                          'wire_ms': 1000*10*(len(request) + len(reply))/BAUDRATE}
+    return results
+
+
+def benchmark_logging(output_dir,row_count):
+    dw = DataWriter(output_dir,'benchmark',queue_size=row_count)
+    epoch = time.time()
+    monotonic = time.monotonic()
+    time_start = time.perf_counter()
+    for video_frame in range(row_count):
+        dw.write(video_frame,epoch + video_frame,monotonic + video_frame,'entrainment',video_frame % 256,0,0)
+    time_queued = time.perf_counter()
+    dw.close()
+    time_written = time.perf_counter()
+    return {'write_us_per_row': 1e6*(time_queued - time_start)/row_count,
+            'rows_per_second': row_count/(time_written - time_start),
+            'dropped_row_count': dw.get_dropped_row_count()}
+
+
+def _git_describe():
+    try:
+        return subprocess.check_output(['git','describe','--tags','--always','--dirty'],
+                                       cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _flatten_results(results,prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value,dict):
+            flat.update(_flatten_results(value,prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def run_benchmarks(quick=False):
+    count = REQUEST_COUNT
+    duration = FRAME_RATE_DURATION
+    row_count = LOGGING_ROW_COUNT
+    if quick:
+        count //= 10
+        duration /= 5
+        row_count //= 10
+    output_dir = tempfile.mkdtemp(prefix='sleep_assay_benchmark_')
+    board = PtyRelayBoardProcess()
+    benchmarks = {}
+    try:
+        config_file_path = _write_config(board.port,output_dir)
+        for protocol in sorted(PROTOCOLS):
+            for write_write_delay in WRITE_WRITE_DELAYS:
+                print('protocol = {0}, write_write_delay = {1}'.format(protocol,write_write_delay))
+                sa = SleepAssay(config_file_path,write_write_delay=write_write_delay,protocol=protocol)
+                try:
+                    key = '{0}.write_write_delay_{1}'.format(protocol,write_write_delay)
+                    benchmarks.setdefault('startup',{})[key] = sa.get_startup_times()
+                    benchmarks.setdefault('request_latency',{})[key] = benchmark_request_latency(sa,count)
+                    benchmarks.setdefault('frame_rate',{})[key] = benchmark_frame_rate(sa,duration)
+                finally:
+                    sa._close()
+        benchmarks['message_bytes'] = benchmark_message_bytes()
+        benchmarks['logging'] = benchmark_logging(output_dir,row_count)
+    finally:
+        board.close()
+    return {'version': RESULTS_VERSION,
+            'sleep_assay_version': _git_describe(),
+            'date_time': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+            'benchmarks': benchmarks,
+            'data_dir': output_dir}
+
+
+def compare_results(file_path_a,file_path_b):
+    with open(file_path_a,'r') as file_a:
+        results_a = json.load(file_a)
+    with open(file_path_b,'r') as file_b:
+        results_b = json.load(file_b)
+    flat_a = _flatten_results(results_a['benchmarks'])
+    flat_b = _flatten_results(results_b['benchmarks'])
+    print('{0:60} {1:>12} {2:>12} {3:>8}'.format('',results_a['sleep_assay_version'],results_b['sleep_assay_version'],'b/a'))
+    for key in sorted(set(flat_a) | set(flat_b)):
+        a = flat_a.get(key)
+        b = flat_b.get(key)
+        ratio = ''
+        if a and (b is not None):
+            ratio = '{0:.2f}'.format(b/a)
+        print('{0:60} {1:>12} {2:>12} {3:>8}'.format(key,
+                                                    '' if a is None else '{0:.4g}'.format(a),
+                                                    '' if b is None else '{0:.4g}'.format(b),
+                                                    ratio))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Benchmark the sleep_assay host code against a virtual relay board.")
+    parser.add_argument('-q',"--quick", help="Run shorter benchmarks.", action="store_true")
+    parser.add_argument('-o',"--output", help="Path of the results json file.")
+    parser.add_argument('-c',"--compare", nargs=2, metavar=('RESULTS_A','RESULTS_B'), help="Compare two results json files.")
+    parser.add_argument("--pty-board", help=argparse.SUPPRESS, action="store_true")
+
+    args = parser.parse_args(args)
+
+    if args.pty_board:
+        serve_pty_board()
+        return
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    results = run_benchmarks(args.quick)
+    output = args.output
+    if output is None:
+        if not os.path.exists(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        file_name = '{0}-{1}.json'.format(results['sleep_assay_version'],
+                                          datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'))
+        output = os.path.join(RESULTS_DIR,file_name)
+    with open(output,'w') as output_file:
+        json.dump(results,output_file,indent=1,sort_keys=True)
+    for key, value in sorted(_flatten_results(results['benchmarks']).items()):
+        print('{0:60} {1:.4g}'.format(key,value))
+    print('results written to {0}'.format(output))
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -49,11 +49,12 @@ setup(
         # that you indicate whether you support Python 2, Python 3 or both.
         # 'Programming Language :: Python :: 2',
         # 'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
-        # 'Programming Language :: Python :: 3',
+        # 'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
         # 'Programming Language :: Python :: 3.2',
         # 'Programming Language :: Python :: 3.3',
         # 'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.5',
     ],
 
     # What does your project relate to?
@@ -93,6 +94,11 @@ setup(
     entry_points={
         'console_scripts': [
             'sleep_assay=sleep_assay:main',
+            'sleep_assay_multi_rig=sleep_assay.multi_rig:main',
+            'sleep_assay_convert_data=sleep_assay.data_log:main',
+            'sleep_assay_extract_activity=sleep_assay.activity:main',
+            'sleep_assay_sleep=sleep_assay.sleep_bouts:main',
+            'sleep_assay_batch_activity=sleep_assay.batch:main',
         ],
     },
 )
@@ -1,3 +1,48 @@
 '''
 '''
-from sleep_assay import SleepAssay, main
+import importlib
+import sys
+
+
+# names are imported from their module on first use, so an acquisition
+# run does not pay for the analysis modules and a script that only
+# loads data does not pay for the serial and asyncio ones
+_MODULE_NAMES = {'.sleep_assay': ['SleepAssay', 'main'],
+                 '.transport': ['SerialTransport', 'TransportError'],
+                 '.protocol': ['RequestEncoder', 'FrameParser', 'ProtocolError', 'PROTOCOLS'],
+                 '.multi_rig': ['MultiRig'],
+                 '.data_log': ['BinaryDataWriter', 'load_binary_data', 'csv_to_binary', 'binary_to_csv'],
+                 '.data_writer': ['DataWriter', 'load_data_index'],
+                 '.data_loader': ['iter_data', 'load_data', 'load_decimated', 'decimate_min_max'],
+                 '.live_view': ['RingBuffer', 'LiveView'],
+                 '.timeline': ['Timeline', 'TimelineError', 'compile_phase', 'resume_command', 'waveform_power'],
+                 '.clock': ['Clock', 'VirtualClock'],
+                 '.virtual_board': ['VirtualRelayBoard', 'VirtualTransport'],
+                 '.scheduler': ['FrameScheduler'],
+                 '.clock_sync': ['ClockSync'],
+                 '.journal': ['RunJournal', 'JournalError'],
+                 '.metrics': ['Metrics', 'MetricsServer', 'MetricsFileWriter', 'write_metrics_file'],
+                 '.tracing': ['Tracer'],
+                 '.activity': ['ActivityExtractor', 'ActivityWriter', 'grid_well_labels', 'extract_activity', 'load_activity', 'iter_frames'],
+                 '.frame_index': ['FrameIndex', 'load_frame_index'],
+                 '.sleep_bouts': ['SleepBoutDetector', 'detect_sleep_bouts', 'join_light_state', 'summarize_sleep', 'analyze_sleep'],
+                 '.batch': ['ActivityJob', 'run_jobs']}
+_NAME_MODULES = {name: module_name for module_name, names in _MODULE_NAMES.items() for name in names}
+
+__all__ = sorted(_NAME_MODULES)
+
+
+def __getattr__(name):
+    if name not in _NAME_MODULES:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__,name))
+    value = getattr(importlib.import_module(_NAME_MODULES[name],__name__),name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+if sys.version_info < (3,7):
+    # modules only look up __getattr__ from python 3.7
+    for name in __all__:
+        __getattr__(name)
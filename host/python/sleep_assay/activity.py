@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import argparse
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+ACTIVITY_MAGIC = b'SLEEPACT'
+ACTIVITY_VERSION = 1
+ACTIVITY_HEADER = struct.Struct('<8sIIIq')
+
+METHOD_DIFFERENCE = 'difference'
+METHOD_BACKGROUND = 'background'
+METHODS = (METHOD_DIFFERENCE,METHOD_BACKGROUND)
+
+CHUNK_FRAMES = 256
+
+
+class ActivityError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def grid_well_labels(shape,rows,columns,roi=None,margin=0.1):
+    '''
+    Returns a label image of shape (height,width) with a grid of rows
+    by columns rectangular wells numbered from 1 row by row and 0
+    between wells. roi is (x,y,width,height) of the plate in the image,
+    the whole image by default. margin is the fraction of each well
+    left out at its edges, so the walls do not count as motion.
+    '''
+    height, width = shape[0:2]
+    if roi is None:
+        roi = (0,0,width,height)
+    x, y, roi_width, roi_height = roi
+    labels = np.zeros((height,width),dtype=np.int32)
+    well_height = roi_height/rows
+    well_width = roi_width/columns
+    for row in range(rows):
+        y_start = int(round(y + (row + margin/2)*well_height))
+        y_stop = int(round(y + (row + 1 - margin/2)*well_height))
+        for column in range(columns):
+            x_start = int(round(x + (column + margin/2)*well_width))
+            x_stop = int(round(x + (column + 1 - margin/2)*well_width))
+            labels[y_start:y_stop,x_start:x_stop] = row*columns + column + 1
+    return labels
+
+
+def _import_cv2():
+    '''
+    Returns the opencv module, or None when it is not installed. It is
+    only imported once frames are read, since it is slow to import and
+    every acquisition run imports this package.
+    '''
+    try:
+        import cv2
+    except ImportError:
+        return None
+    return cv2
+
+
+def _absolute_difference(a,b):
+    # stays in uint8, which is much faster than widening to int16
+    return np.maximum(a,b) - np.minimum(a,b)
+
+
+def _to_gray(frames):
+    if frames.ndim == 4:
+        cv2 = _import_cv2()
+        if cv2 is not None:
+            return np.array([cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY) for frame in frames])
+        return frames.mean(axis=3).astype(np.uint8)
+    return frames
+
+
+def iter_array_frames(frames,chunk_frames=CHUNK_FRAMES,start=0,stop=None):
+    '''
+    Yields grayscale chunks of at most chunk_frames frames of an array
+    of shape (frame_count,height,width) or (frame_count,height,width,3),
+    for example a memory mapped .npy file.
+    '''
+    if stop is None:
+        stop = len(frames)
+    stop = min(stop,len(frames))
+    for chunk_start in range(start,stop,chunk_frames):
+        yield _to_gray(np.asarray(frames[chunk_start:min(chunk_start + chunk_frames,stop)]))
+
+
+def iter_video_frames(video_file_path,chunk_frames=CHUNK_FRAMES,start=0,stop=None):
+    '''
+    Yields grayscale chunks of at most chunk_frames frames of a video
+    file. Needs opencv.
+    '''
+    cv2 = _import_cv2()
+    if cv2 is None:
+        raise ActivityError('Reading video files needs opencv (cv2)')
+    capture = cv2.VideoCapture(video_file_path)
+    if not capture.isOpened():
+        raise ActivityError('Unable to open video file: {0}'.format(video_file_path))
+    try:
+        if start > 0:
+            capture.set(cv2.CAP_PROP_POS_FRAMES,start)
+        frame_index = start
+        while (stop is None) or (frame_index < stop):
+            chunk = []
+            while (len(chunk) < chunk_frames) and ((stop is None) or (frame_index < stop)):
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                chunk.append(frame)
+                frame_index += 1
+            if not chunk:
+                break
+            yield _to_gray(np.array(chunk))
+            if len(chunk) < chunk_frames:
+                break
+    finally:
+        capture.release()
+
+
+def iter_frames(frames_file_path,chunk_frames=CHUNK_FRAMES,start=0,stop=None):
+    '''
+    Yields grayscale chunks of the frames of a video file or a .npy
+    file of frames, which is memory mapped.
+    '''
+    if frames_file_path.endswith('.npy'):
+        return iter_array_frames(np.load(frames_file_path,mmap_mode='r'),chunk_frames,start,stop)
+    return iter_video_frames(frames_file_path,chunk_frames,start,stop)
+
+
+def get_frame_count(frames_file_path):
+    if frames_file_path.endswith('.npy'):
+        return len(np.load(frames_file_path,mmap_mode='r'))
+    cv2 = _import_cv2()
+    if cv2 is None:
+        raise ActivityError('Reading video files needs opencv (cv2)')
+    capture = cv2.VideoCapture(frames_file_path)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return frame_count
+
+
+class ActivityExtractor(object):
+    '''
+    Turns chunks of grayscale frames into the number of moving pixels
+    in each well of each frame.
+
+    Only the pixels inside wells are read, and each chunk is processed
+    with whole array operations, with no python loop over pixels. With
+    the difference method a pixel moves when it changed by more than
+    threshold since the previous frame. With the background method it
+    moves when it differs by more than threshold from a background
+    that starts as the first frame and follows every frame after it is
+    compared, with a time constant of 1/alpha frames. The last frame
+    or background is kept between chunks, so a recording fed through
+    in chunks of any size gives the same activity.
+
+    Example Usage:
+
+    labels = grid_well_labels((1080,1920),8,12)
+    ae = ActivityExtractor(labels)
+    for chunk in iter_frames('video.avi'):
+        activity = ae.process(chunk)
+    '''
+    METHOD = METHOD_DIFFERENCE
+    THRESHOLD = 20
+    ALPHA = 0.001
+
+    def __init__(self,labels,*args,**kwargs):
+        self._method = kwargs.pop('method',self.METHOD)
+        if self._method not in METHODS:
+            raise ActivityError('Unknown activity method: {0}'.format(self._method))
+        self._threshold = kwargs.pop('threshold',self.THRESHOLD)
+        self._alpha = np.float32(kwargs.pop('alpha',self.ALPHA))
+        state = kwargs.pop('state',None)
+        labels = np.asarray(labels)
+        self._shape = labels.shape
+        labels_flat = labels.ravel()
+        pixels = np.flatnonzero(labels_flat > 0)
+        # pixels grouped by well, so each well is one contiguous slice
+        order = np.argsort(labels_flat[pixels],kind='stable')
+        self._pixels = pixels[order]
+        self._well_ids, self._starts, self._well_sizes = np.unique(labels_flat[self._pixels],return_index=True,return_counts=True)
+        if len(self._well_ids) == 0:
+            raise ActivityError('No wells in labels')
+        if self._well_sizes.max() < 2**16:
+            self._dtype = np.dtype('<u2')
+        else:
+            self._dtype = np.dtype('<u4')
+        self.reset()
+        if state is not None:
+            self.set_state(state)
+
+    def reset(self):
+        self._previous = None
+        self._background = None
+
+    def get_well_count(self):
+        return len(self._well_ids)
+
+    def get_well_ids(self):
+        return self._well_ids
+
+    def get_well_sizes(self):
+        return self._well_sizes
+
+    def get_dtype(self):
+        return self._dtype
+
+    def get_method(self):
+        return self._method
+
+    def get_state(self):
+        '''
+        Returns a copy of what is kept between chunks, the last frame
+        or the background of the pixels in wells, or None after reset.
+        '''
+        if self._method == METHOD_DIFFERENCE:
+            state = self._previous
+        else:
+            state = self._background
+        if state is None:
+            return None
+        return state.copy()
+
+    def set_state(self,state):
+        '''
+        Continues from a state returned by get_state, as if the frames
+        before it had just been processed.
+        '''
+        if self._method == METHOD_DIFFERENCE:
+            self._previous = np.array(state,dtype=np.uint8)
+        else:
+            self._background = np.array(state,dtype=np.float32)
+
+    def get_warm_up_frame_count(self):
+        '''
+        Returns how many frames before the first frame of a range have
+        to be processed and discarded so the range starts in the same
+        state as when the whole recording is processed, or None when
+        that takes every frame from the start of the recording, since
+        the background remembers all of them.
+        '''
+        if self._method == METHOD_DIFFERENCE:
+            return 1
+        return None
+
+    def process(self,frames):
+        '''
+        Returns an array of shape (frame_count,well_count) with the
+        number of moving pixels in each well of each frame. The first
+        frame after reset has no motion.
+        '''
+        frames = np.asarray(frames)
+        if frames.shape[1:3] != self._shape:
+            raise ActivityError('Frame shape {0} does not match labels shape {1}'.format(frames.shape[1:3],self._shape))
+        frame_count = len(frames)
+        if frame_count == 0:
+            return np.zeros((0,self.get_well_count()),dtype=self._dtype)
+        pixels = np.take(frames.reshape(frame_count,-1),self._pixels,axis=1)
+        if self._method == METHOD_DIFFERENCE:
+            if self._previous is None:
+                self._previous = pixels[0]
+            previous = np.concatenate((self._previous[np.newaxis],pixels[:-1]))
+            moving = _absolute_difference(pixels,previous) > self._threshold
+            self._previous = pixels[-1].copy()
+        else:
+            if self._background is None:
+                self._background = pixels[0].astype(np.float32)
+            # each frame is compared to the background as it stood before
+            # that frame, and the update is one vector operation per frame,
+            # so the result is the same in chunks of any size
+            backgrounds = np.empty_like(pixels)
+            background = self._background
+            difference = np.empty_like(background)
+            for frame in range(frame_count):
+                np.rint(background,out=difference)
+                backgrounds[frame] = difference
+                np.subtract(pixels[frame],background,out=difference)
+                difference *= self._alpha
+                background += difference
+            moving = _absolute_difference(pixels,backgrounds) > self._threshold
+        return np.add.reduceat(moving.view(np.uint8),self._starts,axis=1,dtype=self._dtype)
+
+
+class ActivityWriter(object):
+    '''
+    Appends per well activity to a binary activity file.
+
+    The file is a header followed by one row of well_count unsigned
+    integers per frame, starting at video frame first_frame, so it
+    can be memory mapped with load_activity.
+
+    Example Usage:
+
+    writer = ActivityWriter('activity.bin',96)
+    writer.write(activity)
+    writer.close()
+    '''
+    def __init__(self,file_path,well_count,first_frame=0,dtype=np.dtype('<u2')):
+        self._file_path = file_path
+        self._well_count = well_count
+        self._dtype = np.dtype(dtype)
+        self._file = open(file_path,'wb')
+        self._file.write(ACTIVITY_HEADER.pack(ACTIVITY_MAGIC,ACTIVITY_VERSION,well_count,self._dtype.itemsize,first_frame))
+
+    def get_file_path(self):
+        return self._file_path
+
+    def write(self,activity):
+        activity = np.ascontiguousarray(activity,dtype=self._dtype)
+        if (activity.ndim != 2) or (activity.shape[1] != self._well_count):
+            raise ActivityError('Activity must have shape (frame_count,{0})'.format(self._well_count))
+        self._file.write(activity.tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_activity_header(file_path):
+    '''
+    Returns the well count, item size and first frame of an activity
+    file.
+    '''
+    with open(file_path,'rb') as fid:
+        header = fid.read(ACTIVITY_HEADER.size)
+    if len(header) < ACTIVITY_HEADER.size:
+        raise ActivityError('Activity file header is truncated: {0}'.format(file_path))
+    magic, version, well_count, item_size, first_frame = ACTIVITY_HEADER.unpack(header)
+    if magic != ACTIVITY_MAGIC:
+        raise ActivityError('Not an activity file: {0}'.format(file_path))
+    if (version != ACTIVITY_VERSION) or (item_size not in (2,4)):
+        raise ActivityError('Unsupported activity file version {0}: {1}'.format(version,file_path))
+    return well_count, item_size, first_frame
+
+
+def load_activity(file_path):
+    '''
+    Returns the video frame of each row and a read only memory map of
+    shape (frame_count,well_count) of an activity file.
+    '''
+    well_count, item_size, first_frame = read_activity_header(file_path)
+    dtype = np.dtype('<u{0}'.format(item_size))
+    frame_count = (os.path.getsize(file_path) - ACTIVITY_HEADER.size)//(well_count*item_size)
+    video_frame = np.arange(first_frame,first_frame + frame_count,dtype=np.int64)
+    if frame_count == 0:
+        return video_frame, np.zeros((0,well_count),dtype=dtype)
+    activity = np.memmap(file_path,dtype=dtype,mode='r',offset=ACTIVITY_HEADER.size,shape=(frame_count,well_count))
+    return video_frame, activity
+
+
+def extract_activity(frames_file_path,activity_file_path,labels,chunk_frames=CHUNK_FRAMES,start=0,stop=None,**kwargs):
+    '''
+    Writes the activity of each well in frames start to stop of a
+    video or .npy file to an activity file and returns the number of
+    frames written. Frames before start are only read as far as needed
+    to warm up the extractor, or not at all when its state at start is
+    passed as state, so a range gives the same activity as processing
+    the whole recording.
+    '''
+    extractor = ActivityExtractor(labels,**kwargs)
+    return extract_activity_range(extractor,frames_file_path,activity_file_path,chunk_frames,start,stop)
+
+
+def extract_activity_range(extractor,frames_file_path,activity_file_path,chunk_frames=CHUNK_FRAMES,start=0,stop=None):
+    '''
+    Like extract_activity with an extractor that already exists, so
+    its state can be read once the range is done.
+    '''
+    if extractor.get_state() is not None:
+        read_start = start
+    elif extractor.get_warm_up_frame_count() is None:
+        read_start = 0
+    else:
+        read_start = max(0,start - extractor.get_warm_up_frame_count())
+    writer = ActivityWriter(activity_file_path,extractor.get_well_count(),start,extractor.get_dtype())
+    frame_index = read_start
+    frame_count = 0
+    try:
+        for chunk in iter_frames(frames_file_path,chunk_frames,read_start,stop):
+            activity = extractor.process(chunk)
+            skip = max(0,start - frame_index)
+            frame_index += len(chunk)
+            if skip < len(activity):
+                writer.write(activity[skip:])
+                frame_count += len(activity) - skip
+    finally:
+        writer.close()
+    return frame_count
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Extract the activity of each well from recorded frames.")
+    parser.add_argument("frames_file_path", help="Path to a video file or a .npy file of frames.")
+    parser.add_argument("activity_file_path", help="Path to write the activity file.")
+    parser.add_argument('-r',"--rows", type=int, default=8, help="Rows of wells.")
+    parser.add_argument('-c',"--columns", type=int, default=12, help="Columns of wells.")
+    parser.add_argument("--roi", type=int, nargs=4, metavar=('X','Y','WIDTH','HEIGHT'), help="Region of the plate in the frames.")
+    parser.add_argument("--labels", help="Path to a .npy label image of the wells, instead of a grid.")
+    parser.add_argument('-m',"--method", choices=METHODS, default=ActivityExtractor.METHOD, help="Motion detection method.")
+    parser.add_argument('-t',"--threshold", type=int, default=ActivityExtractor.THRESHOLD, help="Gray level change that counts as motion.")
+    parser.add_argument("--chunk-frames", type=int, default=CHUNK_FRAMES, help="Frames processed at once.")
+    parser.add_argument("--start", type=int, default=0, help="First frame.")
+    parser.add_argument("--stop", type=int, help="Frame after the last frame.")
+    parser.add_argument("--frame-rate", type=float, help="Recording frame rate, to report speed relative to real time.")
+
+    args = parser.parse_args(args)
+
+    if args.labels:
+        labels = np.load(args.labels)
+    else:
+        first_chunk = next(iter(iter_frames(args.frames_file_path,1)))
+        labels = grid_well_labels(first_chunk.shape[1:3],args.rows,args.columns,args.roi)
+    time_start = time.time()
+    frame_count = extract_activity(args.frames_file_path,
+                                   args.activity_file_path,
+                                   labels,
+                                   args.chunk_frames,
+                                   args.start,
+                                   args.stop,
+                                   method=args.method,
+                                   threshold=args.threshold)
+    duration = time.time() - time_start
+    print('{0} frames written to {1} in {2:.1f} s'.format(frame_count,args.activity_file_path,duration))
+    if args.frame_rate and (duration > 0):
+        print('{0:.1f} times faster than real time'.format(frame_count/(args.frame_rate*duration)))
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
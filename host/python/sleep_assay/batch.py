@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from .activity import (ActivityExtractor, ActivityWriter, ActivityError, extract_activity_range, load_activity,
+                       get_frame_count, grid_well_labels, iter_frames, CHUNK_FRAMES, METHODS)
+
+
+JOB_VERSION = 1
+# half an hour of video at 30 frames per second
+JOB_CHUNK_FRAMES = 54000
+
+
+def _chunk_file_name(start,stop):
+    return 'chunk-{0:012d}-{1:012d}.bin'.format(start,stop)
+
+
+def _state_file_path(chunk_file_path):
+    return chunk_file_path.replace('.bin','-state.npy')
+
+
+def _run_chunk(frames_file_path,labels_file_path,chunk_file_path,start,stop,chunk_frames,extractor_kwargs,previous_chunk_file_path=None):
+    '''
+    Extracts the activity of one frame range in a worker process. The
+    chunk file only appears once it is complete, so it is the
+    checkpoint. With previous_chunk_file_path the range starts from
+    the extractor state saved at the end of the previous range, and
+    saves its own for the next one.
+    '''
+    labels = np.load(labels_file_path)
+    extractor = ActivityExtractor(labels,**extractor_kwargs)
+    if previous_chunk_file_path is not None:
+        extractor.set_state(np.load(_state_file_path(previous_chunk_file_path)))
+    chunk_file_path_tmp = chunk_file_path + '.tmp'
+    frame_count = extract_activity_range(extractor,frames_file_path,chunk_file_path_tmp,chunk_frames,start,stop)
+    if extractor.get_warm_up_frame_count() is None:
+        state_file_path = _state_file_path(chunk_file_path)
+        state_file_path_tmp = state_file_path + '.tmp'
+        with open(state_file_path_tmp,'wb') as state_file:
+            np.save(state_file,extractor.get_state())
+        os.replace(state_file_path_tmp,state_file_path)
+    os.replace(chunk_file_path_tmp,chunk_file_path)
+    return start, stop, frame_count
+
+
+class ActivityJob(object):
+    '''
+    Activity extraction of one recording split into frame ranges that
+    can run in parallel and survive interruption.
+
+    The job directory holds the labels, a json file with the job
+    settings and one activity file per finished frame range. Ranges
+    with a finished file are skipped when the job is run again, so an
+    interrupted job picks up where it stopped. merge joins the ranges
+    in frame order into one activity file, which is the same as
+    extracting the whole recording in one pass. With the background
+    method, which remembers every frame before a range, each range
+    starts from the state saved by the one before it, so the ranges of
+    a recording run one after another.
+
+    Example Usage:
+
+    job = ActivityJob('video.avi','video-activity',labels)
+    job.get_pending_chunks()
+    job.merge('video-activity.bin')
+    '''
+    def __init__(self,frames_file_path,job_dir,labels,*args,**kwargs):
+        self._chunk_frames = kwargs.pop('chunk_frames',CHUNK_FRAMES)
+        job_chunk_frames = kwargs.pop('job_chunk_frames',JOB_CHUNK_FRAMES)
+        self._extractor_kwargs = kwargs
+        self._frames_file_path = os.path.abspath(frames_file_path)
+        self._job_dir = job_dir
+        self._labels_file_path = os.path.join(job_dir,'labels.npy')
+        self._job_file_path = os.path.join(job_dir,'job.json')
+        labels = np.asarray(labels)
+        frame_count = get_frame_count(self._frames_file_path)
+        job = {'version': JOB_VERSION,
+               'frames_file_path': self._frames_file_path,
+               'frame_count': frame_count,
+               'job_chunk_frames': job_chunk_frames,
+               'extractor': kwargs}
+        if os.path.exists(self._job_file_path):
+            with open(self._job_file_path,'r') as job_file:
+                job_prev = json.load(job_file)
+            if (job_prev != job) or (not np.array_equal(np.load(self._labels_file_path),labels)):
+                raise ActivityError('Job directory {0} holds a job with other settings'.format(job_dir))
+        else:
+            if not os.path.exists(job_dir):
+                os.makedirs(job_dir)
+            np.save(self._labels_file_path,labels)
+            job_file_path_tmp = self._job_file_path + '.tmp'
+            with open(job_file_path_tmp,'w') as job_file:
+                json.dump(job,job_file,indent=1,sort_keys=True)
+            os.replace(job_file_path_tmp,self._job_file_path)
+        self._chunks = [(start,min(start + job_chunk_frames,frame_count)) for start in range(0,frame_count,job_chunk_frames)]
+        extractor = ActivityExtractor(labels,**kwargs)
+        self._well_count = extractor.get_well_count()
+        self._sequential = extractor.get_warm_up_frame_count() is None
+
+    def get_chunks(self):
+        return list(self._chunks)
+
+    def is_sequential(self):
+        '''
+        Returns True when each frame range needs the previous one to
+        be finished first.
+        '''
+        return self._sequential
+
+    def get_chunk_file_path(self,start,stop):
+        return os.path.join(self._job_dir,_chunk_file_name(start,stop))
+
+    def get_pending_chunks(self):
+        return [(start,stop) for start, stop in self._chunks
+                if not os.path.exists(self.get_chunk_file_path(start,stop))]
+
+    def get_task_args(self,start,stop):
+        previous_chunk_file_path = None
+        index = self._chunks.index((start,stop))
+        if self._sequential and (index > 0):
+            previous_chunk_file_path = self.get_chunk_file_path(*self._chunks[index - 1])
+        return (self._frames_file_path,
+                self._labels_file_path,
+                self.get_chunk_file_path(start,stop),
+                start,
+                stop,
+                self._chunk_frames,
+                self._extractor_kwargs,
+                previous_chunk_file_path)
+
+    def merge(self,activity_file_path,chunk_frames=16*CHUNK_FRAMES):
+        '''
+        Joins the activity of every frame range in order into one
+        activity file and returns its frame count.
+        '''
+        pending = self.get_pending_chunks()
+        if pending:
+            raise ActivityError('{0} frame ranges are not finished'.format(len(pending)))
+        writer = None
+        frame_count = 0
+        try:
+            for start, stop in self._chunks:
+                video_frame, activity = load_activity(self.get_chunk_file_path(start,stop))
+                if (len(video_frame) != stop - start) or ((len(video_frame) > 0) and (video_frame[0] != start)):
+                    raise ActivityError('Frame range {0} to {1} is incomplete'.format(start,stop))
+                if writer is None:
+                    writer = ActivityWriter(activity_file_path,self._well_count,start,activity.dtype)
+                for row in range(0,len(activity),chunk_frames):
+                    writer.write(activity[row:row + chunk_frames])
+                frame_count += len(activity)
+        finally:
+            if writer is not None:
+                writer.close()
+        return frame_count
+
+
+def run_jobs(jobs,workers=None):
+    '''
+    Runs the pending frame ranges of every job in a pool of workers
+    processes, one per cpu by default. Finished ranges are printed as
+    they complete, in whatever order that is. The ranges of a
+    sequential job are submitted one at a time, in order.
+    '''
+    pending = [collections.deque(job.get_pending_chunks()) for job in jobs]
+    task_count = sum(len(chunks) for chunks in pending)
+    if task_count == 0:
+        return 0
+    time_start = time.time()
+    frame_count = 0
+    done_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        def submit(job_index):
+            start, stop = pending[job_index].popleft()
+            futures[executor.submit(_run_chunk,*jobs[job_index].get_task_args(start,stop))] = job_index
+        for job_index, job in enumerate(jobs):
+            while pending[job_index]:
+                submit(job_index)
+                if job.is_sequential():
+                    break
+        while futures:
+            done = concurrent.futures.wait(futures,return_when=concurrent.futures.FIRST_COMPLETED)[0]
+            for future in done:
+                job_index = futures.pop(future)
+                start, stop, chunk_frame_count = future.result()
+                frame_count += chunk_frame_count
+                done_count += 1
+                print('{0}/{1} frame ranges done, {2:.0f} frames/s'.format(done_count,
+                                                                           task_count,
+                                                                           frame_count/max(time.time() - time_start,1e-9)))
+                if jobs[job_index].is_sequential() and pending[job_index]:
+                    submit(job_index)
+    return frame_count
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Extract the activity of each well from many recordings in parallel. Run it again to resume an interrupted batch.")
+    parser.add_argument("frames_file_paths", nargs='+', help="Paths to video files or .npy files of frames.")
+    parser.add_argument('-o',"--output-dir", help="Directory for the activity files, next to each recording by default.")
+    parser.add_argument('-w',"--workers", type=int, help="Worker processes, one per cpu by default.")
+    parser.add_argument('-r',"--rows", type=int, default=8, help="Rows of wells.")
+    parser.add_argument('-c',"--columns", type=int, default=12, help="Columns of wells.")
+    parser.add_argument("--roi", type=int, nargs=4, metavar=('X','Y','WIDTH','HEIGHT'), help="Region of the plate in the frames.")
+    parser.add_argument("--labels", help="Path to a .npy label image of the wells, instead of a grid.")
+    parser.add_argument('-m',"--method", choices=METHODS, default=ActivityExtractor.METHOD, help="Motion detection method.")
+    parser.add_argument('-t',"--threshold", type=int, default=ActivityExtractor.THRESHOLD, help="Gray level change that counts as motion.")
+    parser.add_argument("--job-chunk-frames", type=int, default=JOB_CHUNK_FRAMES, help="Frames in each checkpointed range.")
+
+    args = parser.parse_args(args)
+
+    jobs = []
+    activity_file_paths = []
+    for frames_file_path in args.frames_file_paths:
+        if args.labels:
+            labels = np.load(args.labels)
+        else:
+            first_chunk = next(iter(iter_frames(frames_file_path,1)))
+            labels = grid_well_labels(first_chunk.shape[1:3],args.rows,args.columns,args.roi)
+        base_name = os.path.splitext(os.path.basename(frames_file_path))[0]
+        output_dir = args.output_dir or os.path.dirname(os.path.abspath(frames_file_path))
+        jobs.append(ActivityJob(frames_file_path,
+                                os.path.join(output_dir,base_name + '-activity-job'),
+                                labels,
+                                job_chunk_frames=args.job_chunk_frames,
+                                method=args.method,
+                                threshold=args.threshold))
+        activity_file_paths.append(os.path.join(output_dir,base_name + '-activity.bin'))
+    run_jobs(jobs,args.workers)
+    for job, activity_file_path in zip(jobs,activity_file_paths):
+        frame_count = job.merge(activity_file_path)
+        print('{0} frames written to {1}'.format(frame_count,activity_file_path))
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import datetime
+import threading
+import time
+
+
+class Clock(object):
+    '''
+    Wall clock used to time a run when a relay board is attached.
+
+    Example Usage:
+
+    clock = Clock()
+    deadline = clock.monotonic() + 1
+    clock.sleep(deadline - clock.monotonic())
+    clock.now()
+    monotonic, epoch = clock.stamp()
+    '''
+    # seconds between reads of the wall clock by stamp
+    STAMP_ANCHOR_PERIOD = 60
+
+    def __init__(self):
+        self._stamp_offset = None
+        self._stamp_anchor = None
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self,seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def stamp(self):
+        '''
+        Returns monotonic and epoch times of the same instant from a
+        single monotonic read. The wall clock offset is read again
+        every STAMP_ANCHOR_PERIOD seconds, so wall clock steps show up
+        in epoch within that period but never break monotonic.
+        '''
+        monotonic = self.monotonic()
+        if (self._stamp_anchor is None) or (monotonic - self._stamp_anchor >= self.STAMP_ANCHOR_PERIOD):
+            self._stamp_offset = self.time() - self.monotonic()
+            self._stamp_anchor = monotonic
+        return monotonic, monotonic + self._stamp_offset
+
+
+class VirtualClock(Clock):
+    '''
+    Clock that starts at the current time but can run much faster than
+    real time.
+
+    With speed None, time only advances when sleep is called and sleep
+    returns immediately, so a run that spends most of its time waiting
+    finishes as fast as the host can compute it. With a speed, time
+    advances speed times faster than real time.
+
+    Example Usage:
+
+    clock = VirtualClock()
+    clock.sleep(24*60*60)
+    clock.now()
+    '''
+    def __init__(self,start_time=None,speed=None):
+        if start_time is None:
+            start_time = time.time()
+        self._time = start_time
+        self._speed = speed
+        self._real_start_time = time.time()
+        self._lock = threading.Lock()
+
+    def get_speed(self):
+        return self._speed
+
+    def time(self):
+        if self._speed is None:
+            return self._time
+        return self._time + self._speed*(time.time() - self._real_start_time)
+
+    def monotonic(self):
+        # virtual time never steps back
+        return self.time()
+
+    def stamp(self):
+        monotonic = self.monotonic()
+        return monotonic, monotonic
+
+    def sleep(self,seconds):
+        if seconds <= 0:
+            return
+        if self._speed is None:
+            with self._lock:
+                self._time += seconds
+        else:
+            time.sleep(seconds/self._speed)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import collections
+
+import numpy as np
+
+
+# the board millis() counter is an unsigned long
+BOARD_TIME_MODULUS = 2**32
+
+
+class ClockSyncError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class ClockSync(object):
+    '''
+    Offset and drift of the relay board millis() clock relative to the
+    host monotonic clock.
+
+    Every request that returns the board time is an exchange: the host
+    times when the request was written and when the reply was read,
+    and the board time is taken to be at the midpoint. Of the
+    exchanges in each interval only the one with the shortest round
+    trip is kept, like the NTP clock filter, since its midpoint is the
+    least uncertain. A line is fit through the kept samples in a
+    sliding window, after dropping the slowest round trips and then
+    the samples whose residuals are far from the rest. Until the
+    window spans min_drift_span seconds only the offset is fit. The
+    line is refit when it is next used rather than on every sample, so
+    exchanges stay cheap when nothing needs the board clock.
+
+    Board times are unwrapped across millis() overflow, so a fit
+    stays valid for runs longer than 49 days.
+
+    Example Usage:
+
+    cs = ClockSync()
+    time_sent = clock.monotonic()
+    board_time = get_board_time()
+    time_received = clock.monotonic()
+    cs.add_exchange(time_sent,board_time,time_received)
+    cs.board_to_host(board_time)
+    cs.host_to_board_duration(delay)
+    '''
+    INTERVAL = 10.0
+    WINDOW = 360
+    MIN_SAMPLE_COUNT = 4
+    MIN_DRIFT_SPAN = 600.0
+    RTT_QUANTILE = 0.5
+    OUTLIER_THRESHOLD = 4.0
+    # millis() only counts whole milliseconds
+    RESOLUTION = 0.001
+
+    def __init__(self,*args,**kwargs):
+        self._interval = kwargs.pop('interval',self.INTERVAL)
+        self._window = kwargs.pop('window',self.WINDOW)
+        self._min_drift_span = kwargs.pop('min_drift_span',self.MIN_DRIFT_SPAN)
+        self._rtt_quantile = kwargs.pop('rtt_quantile',self.RTT_QUANTILE)
+        self._outlier_threshold = kwargs.pop('outlier_threshold',self.OUTLIER_THRESHOLD)
+        self.reset()
+
+    def reset(self):
+        self._samples = collections.deque(maxlen=self._window)
+        self._candidate = None
+        self._interval_start = None
+        self._board_time_prev = None
+        self._wrap_count = 0
+        self._exchange_count = 0
+        self._rejected_count = 0
+        self._host_ref = None
+        self._board_ref = None
+        self._rate = 1.0
+        self._residual_ms = None
+        self._fit_pending = False
+
+    def _unwrap(self,board_time):
+        '''
+        Returns board_time in seconds, counting millis() overflows
+        from the previous exchange.
+        '''
+        if (self._board_time_prev is not None) and (board_time < self._board_time_prev - BOARD_TIME_MODULUS//2):
+            self._wrap_count += 1
+        self._board_time_prev = board_time
+        return (board_time + self._wrap_count*BOARD_TIME_MODULUS)/1000
+
+    def add_exchange(self,time_sent,board_time,time_received):
+        '''
+        Adds an exchange of host monotonic times in seconds around a
+        request and the board time in milliseconds it returned.
+        Returns True when a sample was kept for the next fit.
+        '''
+        if time_received < time_sent:
+            raise ClockSyncError('Reply received before request was sent')
+        self._exchange_count += 1
+        sample = ((time_sent + time_received)/2,self._unwrap(board_time),time_received - time_sent)
+        if self._interval_start is None:
+            self._interval_start = time_received
+        if (self._candidate is None) or (sample[2] < self._candidate[2]):
+            self._candidate = sample
+        if (time_received - self._interval_start < self._interval) and self.is_ready():
+            return False
+        self._samples.append(self._candidate)
+        self._candidate = None
+        self._interval_start = time_received
+        self._fit_pending = True
+        return True
+
+    def is_due(self,time_now):
+        '''
+        Returns True when an exchange at host monotonic time_now would
+        add a sample, for callers that have to ask for one.
+        '''
+        return (self._interval_start is None) or (time_now - self._interval_start >= self._interval)
+
+    def get_due_time(self):
+        '''
+        Returns the host monotonic time from which an exchange would add
+        a sample.
+        '''
+        if self._interval_start is None:
+            return float('-inf')
+        return self._interval_start + self._interval
+
+    def is_ready(self):
+        return len(self._samples) >= self.MIN_SAMPLE_COUNT
+
+    def _update_fit(self):
+        if self._fit_pending:
+            self._fit_pending = False
+            self._fit()
+
+    def _fit(self):
+        samples = np.array(self._samples)
+        host, board, rtt = samples[:,0], samples[:,1], samples[:,2]
+        keep = rtt <= np.quantile(rtt,self._rtt_quantile)
+        host_ref = float(host[keep][0])
+        fit_drift = (host[keep][-1] - host_ref) >= self._min_drift_span
+        for i in range(2):
+            x = host[keep] - host_ref
+            y = board[keep] - host[keep]
+            if fit_drift:
+                slope, intercept = np.polyfit(x,y,1)
+            else:
+                slope, intercept = 0.0, np.median(y)
+            residuals = (board - host) - (intercept + slope*(host - host_ref))
+            if i == 1:
+                break
+            # a robust spread, floored so millis() quantization is never an outlier
+            spread = max(1.4826*np.median(np.abs(residuals[keep])),self.RESOLUTION)
+            inliers = keep & (np.abs(residuals) <= self._outlier_threshold*spread)
+            if np.count_nonzero(inliers) < 2:
+                break
+            self._rejected_count += int(np.count_nonzero(keep & ~inliers))
+            keep = inliers
+        self._host_ref = host_ref
+        self._board_ref = float(host_ref + intercept)
+        self._rate = float(1 + slope)
+        self._residual_ms = 1000*float(np.sqrt(np.mean(residuals[keep]**2)))
+
+    def get_offset(self,time_host=None):
+        '''
+        Returns board time minus host time in seconds at host
+        monotonic time_host, or at the newest sample.
+        '''
+        self._update_fit()
+        if self._host_ref is None:
+            return None
+        if time_host is None:
+            time_host = self._samples[-1][0]
+        return self.host_to_board(time_host) - time_host
+
+    def get_drift_ppm(self):
+        '''
+        Returns how many microseconds the board clock gains per host
+        second.
+        '''
+        self._update_fit()
+        return 1e6*(self._rate - 1)
+
+    def host_to_board(self,time_host):
+        '''
+        Returns the unwrapped board time in seconds at host monotonic
+        time_host.
+        '''
+        self._update_fit()
+        if self._host_ref is None:
+            raise ClockSyncError('No clock sync samples')
+        return self._board_ref + self._rate*(time_host - self._host_ref)
+
+    def board_to_host(self,board_time):
+        '''
+        Returns the host monotonic time in seconds of a board time in
+        milliseconds, taking the millis() overflow nearest the newest
+        sample.
+        '''
+        self._update_fit()
+        if self._host_ref is None:
+            raise ClockSyncError('No clock sync samples')
+        board_latest = self._samples[-1][1]
+        wrap_count = int(round((board_latest*1000 - board_time)/BOARD_TIME_MODULUS))
+        board = (board_time + wrap_count*BOARD_TIME_MODULUS)/1000
+        return self._host_ref + (board - self._board_ref)/self._rate
+
+    def host_to_board_duration(self,duration):
+        '''
+        Returns how long the board clock takes to count a host
+        duration, so delays, periods and on durations sent to the board
+        end on time by the host clock.
+        '''
+        self._update_fit()
+        return duration*self._rate
+
+    def get_statistics(self):
+        self._update_fit()
+        statistics = {'exchange_count': self._exchange_count,
+                      'sample_count': len(self._samples),
+                      'rejected_count': self._rejected_count,
+                      'offset_s': self.get_offset(),
+                      'drift_ppm': self.get_drift_ppm(),
+                      'residual_ms': self._residual_ms}
+        if self._samples:
+            rtt = np.array([sample[2] for sample in self._samples])
+            statistics['rtt_median_ms'] = 1000*float(np.median(rtt))
+            statistics['rtt_max_ms'] = 1000*float(np.max(rtt))
+        return statistics
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from .data_log import DATA_DTYPE, CSV_HEADER, load_binary_data, is_binary_data_file, state_to_code
+from .data_writer import is_data_index_file
+
+
+CHUNK_ROWS = 1000000
+MAX_POINTS = 20000
+
+
+def _date_time_strs_to_epoch(date_time_strs):
+    '''
+    Converts an array of local time 'year-month-day-hour-min-sec'
+    strings to seconds since the epoch without a python loop over
+    rows. The local utc offset is only looked up once per distinct
+    hour, which keeps daylight saving changes right.
+    '''
+    fields = np.array(np.char.split(date_time_strs,'-').tolist(),dtype=np.int64).reshape(-1,6)
+    months = (fields[:,0] - 1970)*12 + (fields[:,1] - 1)
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + (fields[:,2] - 1)
+    naive = days*86400 + fields[:,3]*3600 + fields[:,4]*60 + fields[:,5]
+    hours, inverse = np.unique(naive//3600,return_inverse=True)
+    offsets = np.array([time.mktime(time.gmtime(hour*3600)[:8] + (-1,)) - hour*3600 for hour in hours])
+    return naive + offsets[inverse]
+
+
+def iter_csv_data(csv_file_path,chunk_rows=CHUNK_ROWS):
+    '''
+    Parses a csv data file chunk_rows lines at a time and yields each
+    chunk as a structured array with DATA_DTYPE fields. Files written
+    before the epoch and monotonic columns were added still load, with
+    epoch parsed from date_time and monotonic set to nan.
+    '''
+    with open(csv_file_path,'r') as csv_file:
+        header = csv_file.readline().rstrip().split(',')
+        columns = dict((name,header.index(name)) for name in CSV_HEADER if name in header)
+        while True:
+            lines = list(itertools.islice(csv_file,chunk_rows))
+            if not lines:
+                break
+            table = np.array([line.rstrip().split(',') for line in lines if line.strip()])
+            if len(table) == 0:
+                continue
+            chunk = np.zeros(len(table),dtype=DATA_DTYPE)
+            chunk['video_frame'] = table[:,columns['video_frame']].astype(np.int64)
+            if 'epoch' in columns:
+                chunk['epoch'] = table[:,columns['epoch']].astype(np.float64)
+            else:
+                chunk['epoch'] = _date_time_strs_to_epoch(table[:,columns['date_time']])
+            if 'monotonic' in columns:
+                chunk['monotonic'] = table[:,columns['monotonic']].astype(np.float64)
+            else:
+                chunk['monotonic'] = np.nan
+            state = table[:,columns['state']]
+            white_light_power = table[:,columns['white_light_power']]
+            red_light_pwm_status = table[:,columns['red_light_pwm_status']]
+            red_light_power = table[:,columns['red_light_power']]
+            states, inverse = np.unique(state,return_inverse=True)
+            chunk['state'] = np.array([state_to_code(s) for s in states],dtype=np.uint8)[inverse]
+            chunk['white_light_power'] = white_light_power.astype(np.uint8)
+            chunk['red_light_pwm_status'] = red_light_pwm_status.astype(np.uint8)
+            chunk['red_light_power'] = red_light_power.astype(np.uint8)
+            yield chunk
+
+
+def iter_binary_data(binary_file_path,chunk_rows=CHUNK_ROWS):
+    data = load_binary_data(binary_file_path)
+    for start in range(0,len(data),chunk_rows):
+        yield data[start:start+chunk_rows]
+
+
+def iter_data(data_file_path,chunk_rows=CHUNK_ROWS):
+    '''
+    Yields the records of a csv, binary or index data file in chunks
+    of at most chunk_rows, so files of any length can be processed in
+    bounded memory.
+    '''
+    if is_data_index_file(data_file_path):
+        with open(data_file_path,'r') as index_file:
+            index = json.load(index_file)
+        output_dir = os.path.dirname(os.path.abspath(data_file_path))
+        for segment in index['segments']:
+            for chunk in iter_binary_data(os.path.join(output_dir,segment['binary']),chunk_rows):
+                yield chunk
+    elif is_binary_data_file(data_file_path):
+        for chunk in iter_binary_data(data_file_path,chunk_rows):
+            yield chunk
+    else:
+        for chunk in iter_csv_data(data_file_path,chunk_rows):
+            yield chunk
+
+
+def load_data(data_file_path):
+    '''
+    Returns every record of a csv, binary or index data file as one
+    structured array with DATA_DTYPE fields.
+    '''
+    chunks = list(iter_data(data_file_path))
+    if not chunks:
+        return np.zeros(0,dtype=DATA_DTYPE)
+    return np.concatenate(chunks)
+
+
+def decimate_min_max(x,y,bin_count):
+    '''
+    Reduces sorted x and matching y to at most four points per bin:
+    the first, minimum, maximum and last point of each of bin_count
+    equal width bins of x. Every extreme and every step edge between
+    bins survives, so step plots of the result look like plots of
+    the full data.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= 4*bin_count:
+        return x, y
+    x_min = x[0]
+    x_range = x[-1] - x_min
+    if x_range <= 0:
+        bins = np.zeros(len(x),dtype=np.int64)
+    else:
+        bins = np.minimum(((x - x_min)*bin_count/x_range).astype(np.int64),bin_count - 1)
+    order = np.lexsort((y,bins))
+    sorted_bins = bins[order]
+    group_starts = np.flatnonzero(np.r_[True,sorted_bins[1:] != sorted_bins[:-1]])
+    group_ends = np.r_[group_starts[1:],len(order)] - 1
+    bin_starts = np.flatnonzero(np.r_[True,bins[1:] != bins[:-1]])
+    bin_ends = np.r_[bin_starts[1:],len(bins)] - 1
+    keep = np.unique(np.concatenate((bin_starts,
+                                     order[group_starts],
+                                     order[group_ends],
+                                     bin_ends)))
+    return x[keep], y[keep]
+
+
+def load_decimated(data_file_path,field_names,max_points=MAX_POINTS,chunk_rows=CHUNK_ROWS):
+    '''
+    Returns a dict of (video_frame, value) array pairs, one per field
+    name, with at most about max_points points each. Chunks are
+    decimated as they are read, so memory use does not grow with the
+    length of the data file.
+    '''
+    bin_count = max(1,max_points//4)
+    decimated = dict((field_name,(np.zeros(0,dtype=DATA_DTYPE['video_frame']),
+                                  np.zeros(0,dtype=DATA_DTYPE[field_name])))
+                     for field_name in field_names)
+    for chunk in iter_data(data_file_path,chunk_rows):
+        for field_name in field_names:
+            x, y = decimate_min_max(chunk['video_frame'],chunk[field_name],bin_count)
+            x = np.concatenate((decimated[field_name][0],x))
+            y = np.concatenate((decimated[field_name][1],y))
+            if len(x) > 2*max_points:
+                x, y = decimate_min_max(x,y,bin_count)
+            decimated[field_name] = (x,y)
+    for field_name in field_names:
+        x, y = decimated[field_name]
+        decimated[field_name] = decimate_min_max(x,y,bin_count)
+    return decimated
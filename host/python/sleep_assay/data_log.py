@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import argparse
+import csv
+import datetime
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+
+MAGIC = b'SLEEPLOG'
+VERSION = 2
+HEADER = struct.Struct('<8sII')
+RECORD = struct.Struct('<qddBBBB')
+
+# monotonic is seconds on the host monotonic clock, only differences
+# between rows of one run mean anything
+DATA_DTYPE = np.dtype([('video_frame','<i8'),
+                       ('epoch','<f8'),
+                       ('monotonic','<f8'),
+                       ('state','u1'),
+                       ('white_light_power','u1'),
+                       ('red_light_pwm_status','u1'),
+                       ('red_light_power','u1')])
+
+# version 1 files have no monotonic time
+DATA_DTYPE_V1 = np.dtype([('video_frame','<i8'),
+                          ('epoch','<f8'),
+                          ('state','u1'),
+                          ('white_light_power','u1'),
+                          ('red_light_pwm_status','u1'),
+                          ('red_light_power','u1')])
+DATA_DTYPES = {1: DATA_DTYPE_V1,
+               2: DATA_DTYPE}
+
+CSV_HEADER = ['video_frame',
+              'date_time',
+              'epoch',
+              'monotonic',
+              'state',
+              'white_light_power',
+              'red_light_pwm_status',
+              'red_light_power']
+
+STATE_INITIALIZATION = 0
+STATE_ENTRAINMENT = 1
+STATE_RECOVERY = 2
+# experiment_run{n} is stored as STATE_EXPERIMENT_RUN + n
+STATE_EXPERIMENT_RUN = 3
+STATE_NAMES = {'initialization': STATE_INITIALIZATION,
+               'entrainment': STATE_ENTRAINMENT,
+               'recovery': STATE_RECOVERY}
+EXPERIMENT_RUN_PREFIX = 'experiment_run'
+
+
+class DataLogError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def state_to_code(state):
+    try:
+        return STATE_NAMES[state]
+    except KeyError:
+        pass
+    if state.startswith(EXPERIMENT_RUN_PREFIX):
+        return STATE_EXPERIMENT_RUN + int(state[len(EXPERIMENT_RUN_PREFIX):])
+    raise DataLogError('Unknown state: {0}'.format(state))
+
+
+def code_to_state(code):
+    code = int(code)
+    if code >= STATE_EXPERIMENT_RUN:
+        return '{0}{1}'.format(EXPERIMENT_RUN_PREFIX,code - STATE_EXPERIMENT_RUN)
+    for state, state_code in STATE_NAMES.items():
+        if state_code == code:
+            return state
+    raise DataLogError('Unknown state code: {0}'.format(code))
+
+
+def date_time_str_to_epoch(date_time_str):
+    '''
+    Converts the local time 'year-month-day-hour-min-sec' strings of
+    the csv data files to seconds since the epoch.
+    '''
+    fields = [int(field) for field in date_time_str.split('-')]
+    return time.mktime(datetime.datetime(*fields).timetuple())
+
+
+def epoch_to_date_time_str(epoch):
+    localtime = time.localtime(epoch)
+    return '{0:04d}-{1:02d}-{2:02d}-{3:02d}-{4:02d}-{5:02d}'.format(localtime.tm_year,
+                                                                    localtime.tm_mon,
+                                                                    localtime.tm_mday,
+                                                                    localtime.tm_hour,
+                                                                    localtime.tm_min,
+                                                                    localtime.tm_sec)
+
+
+def epochs_to_date_time_strs(epochs):
+    '''
+    Formats an array of epoch times as local time
+    'year-month-day-hour-min-sec' strings in bulk. localtime is only
+    called once per distinct hour, which keeps daylight saving changes
+    right, and each distinct second is only formatted once.
+    '''
+    seconds = np.floor(np.asarray(epochs,dtype=np.float64)).astype(np.int64)
+    if len(seconds) == 0:
+        return np.zeros(0,dtype='U19')
+    unique_seconds, inverse = np.unique(seconds,return_inverse=True)
+    hours, hour_inverse = np.unique(unique_seconds//3600,return_inverse=True)
+    offsets = np.array([time.localtime(hour*3600).tm_gmtoff for hour in hours],dtype=np.int64)
+    local = (unique_seconds + offsets[hour_inverse]).astype('datetime64[s]')
+    date_time_strs = np.char.replace(np.char.replace(np.datetime_as_string(local,unit='s'),'T','-'),':','-')
+    return date_time_strs[inverse]
+
+
+class BinaryDataWriter(object):
+    '''
+    Appends fixed size records to a binary data file.
+
+    The file is a 16 byte header followed by packed DATA_DTYPE
+    records, so it can be memory mapped with load_binary_data without
+    any parsing. Records are only ever appended, so a file cut short
+    by a crash loses at most its last partial record, which is
+    dropped when the file is appended to again.
+
+    Example Usage:
+
+    writer = BinaryDataWriter('data.bin')
+    writer.write(0,time.time(),time.monotonic(),'entrainment',100,0,0)
+    writer.close()
+    '''
+    def __init__(self,file_path):
+        self._file_path = file_path
+        size = 0
+        if os.path.exists(file_path):
+            size = os.path.getsize(file_path)
+        self._file = open(file_path,'ab')
+        if size < HEADER.size:
+            # a header cut short by a crash is written again
+            self._file.truncate(0)
+            self._file.write(HEADER.pack(MAGIC,VERSION,RECORD.size))
+        elif read_header(file_path) != VERSION:
+            self._file.close()
+            raise DataLogError('Cannot append to an older binary data file: {0}'.format(file_path))
+        else:
+            # so records appended after a partial record line up
+            self._file.truncate(size - (size - HEADER.size) % RECORD.size)
+
+    def get_file_path(self):
+        return self._file_path
+
+    def write(self,video_frame,epoch,monotonic,state,white_light_power,red_light_pwm_status,red_light_power):
+        self._file.write(RECORD.pack(video_frame,
+                                     epoch,
+                                     monotonic,
+                                     state_to_code(state),
+                                     white_light_power,
+                                     red_light_pwm_status,
+                                     red_light_power))
+
+    def flush(self):
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+def read_header(file_path):
+    with open(file_path,'rb') as fid:
+        header = fid.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise DataLogError('Binary data file header is truncated: {0}'.format(file_path))
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise DataLogError('Not a binary data file: {0}'.format(file_path))
+    if (version not in DATA_DTYPES) or (record_size != DATA_DTYPES[version].itemsize):
+        raise DataLogError('Unsupported binary data file version {0}: {1}'.format(version,file_path))
+    return version
+
+
+def load_binary_data(file_path):
+    '''
+    Returns a read only memory map of the records in a binary data
+    file as a structured array with DATA_DTYPE fields. Older versions
+    are converted in memory, with missing fields set to nan.
+    '''
+    version = read_header(file_path)
+    dtype = DATA_DTYPES[version]
+    record_count = (os.path.getsize(file_path) - HEADER.size)//dtype.itemsize
+    if record_count == 0:
+        return np.zeros(0,dtype=DATA_DTYPE)
+    data = np.memmap(file_path,dtype=dtype,mode='r',offset=HEADER.size,shape=(record_count,))
+    if version == VERSION:
+        return data
+    converted = np.zeros(record_count,dtype=DATA_DTYPE)
+    converted['monotonic'] = np.nan
+    for name in dtype.names:
+        converted[name] = data[name]
+    return converted
+
+
+def is_binary_data_file(file_path):
+    with open(file_path,'rb') as fid:
+        return fid.read(len(MAGIC)) == MAGIC
+
+
+def csv_to_binary(csv_file_path,binary_file_path):
+    '''
+    Converts a csv data file written by SleepAssay to a binary data
+    file and returns the number of records written.
+    '''
+    writer = BinaryDataWriter(binary_file_path)
+    record_count = 0
+    try:
+        with open(csv_file_path,'r',newline='') as csv_file:
+            reader = csv.DictReader(csv_file)
+            for row in reader:
+                if row.get('epoch'):
+                    epoch = float(row['epoch'])
+                else:
+                    epoch = date_time_str_to_epoch(row['date_time'])
+                monotonic = float(row.get('monotonic') or 'nan')
+                writer.write(int(row['video_frame']),
+                             epoch,
+                             monotonic,
+                             row['state'],
+                             int(row['white_light_power']),
+                             int(row['red_light_pwm_status']),
+                             int(row['red_light_power']))
+                record_count += 1
+    finally:
+        writer.close()
+    return record_count
+
+
+def binary_to_csv(binary_file_path,csv_file_path):
+    '''
+    Converts a binary data file to the csv layout written by
+    SleepAssay and returns the number of rows written.
+    '''
+    data = load_binary_data(binary_file_path)
+    with open(csv_file_path,'w',newline='') as csv_file:
+        writer = csv.writer(csv_file,quotechar='\"',quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(records_to_csv_rows(data))
+    return len(data)
+
+
+def records_to_csv_rows(records):
+    '''
+    Returns csv rows of an array of DATA_DTYPE records, formatting the
+    date time strings in bulk.
+    '''
+    date_time_strs = epochs_to_date_time_strs(records['epoch'])
+    states = [code_to_state(code) for code in range(256)]
+    return [[video_frame,
+             date_time_str,
+             '{0:.6f}'.format(epoch),
+             '{0:.6f}'.format(monotonic),
+             states[state],
+             white_light_power,
+             red_light_pwm_status,
+             red_light_power]
+            for video_frame, date_time_str, epoch, monotonic, state, white_light_power, red_light_pwm_status, red_light_power
+            in zip(records['video_frame'].tolist(),
+                   date_time_strs.tolist(),
+                   records['epoch'].tolist(),
+                   records['monotonic'].tolist(),
+                   records['state'].tolist(),
+                   records['white_light_power'].tolist(),
+                   records['red_light_pwm_status'].tolist(),
+                   records['red_light_power'].tolist())]
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Convert between csv and binary data files.")
+    parser.add_argument("input_file_path", help="Path to csv or binary data file.")
+    parser.add_argument("output_file_path", help="Path to write the converted data file.")
+
+    args = parser.parse_args(args)
+
+    if is_binary_data_file(args.input_file_path):
+        count = binary_to_csv(args.input_file_path,args.output_file_path)
+    else:
+        count = csv_to_binary(args.input_file_path,args.output_file_path)
+    print('{0} records written to {1}'.format(count,args.output_file_path))
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
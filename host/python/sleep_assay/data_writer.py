@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import collections
+import csv
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .metrics import Metrics
+from .tracing import Tracer
+from .data_log import BinaryDataWriter, CSV_HEADER, HEADER, RECORD, load_binary_data, epoch_to_date_time_str
+
+
+INDEX_VERSION = 1
+# enough of the end of a csv file to hold its last complete row
+CSV_TAIL_BYTES = 4096
+
+
+class DataWriter(object):
+    '''
+    Writes data rows to csv and binary segment files from a
+    background thread.
+
+    write() only puts the row on a bounded queue, so the acquisition
+    loop never waits on the disk. The writer thread writes rows in
+    batches, flushes every flush_interval seconds and fsyncs every
+    fsync_interval seconds. When rotate_daily is set and a row has the
+    epoch of a later local day than the segment, or a segment grows
+    past rotate_bytes, a new pair of segment files is started.
+    Every segment is listed in an index file that is replaced
+    atomically and rewritten as soon as a segment is opened, so after
+    a power loss the index lists every segment with data. Segment files
+    are only ever appended to. Write errors are retried until the disk
+    comes back, without writing a row twice to either file, until close
+    gives up after close_timeout seconds and returns how many rows
+    were not written. Rows that arrive while the queue is full are
+    counted and dropped, and reported from the writer thread at most
+    every drop_report_interval seconds. With resume, the segments
+    already in an existing index are kept and new rows go to a new
+    segment after them. Batch write and fsync times and write errors
+    are kept in metrics, and traced in the writer thread with an
+    enabled tracer.
+
+    Example Usage:
+
+    dw = DataWriter('~/sleep_assay_data/2016-7-15','2016-7-15-9-0-0')
+    dw.write(0,time.time(),time.monotonic(),'entrainment',100,0,0)
+    dw.close()
+    '''
+    QUEUE_SIZE = 100000
+    FLUSH_INTERVAL = 1.0
+    FSYNC_INTERVAL = 10.0
+    RETRY_DELAY = 1.0
+    CLOSE_TIMEOUT = 30.0
+    DROP_REPORT_INTERVAL = 10.0
+
+    def __init__(self,output_dir,base_name,*args,**kwargs):
+        self._queue_size = kwargs.pop('queue_size',self.QUEUE_SIZE)
+        self._flush_interval = kwargs.pop('flush_interval',self.FLUSH_INTERVAL)
+        self._fsync_interval = kwargs.pop('fsync_interval',self.FSYNC_INTERVAL)
+        self._rotate_daily = kwargs.pop('rotate_daily',False)
+        self._rotate_bytes = kwargs.pop('rotate_bytes',None)
+        self._close_timeout = kwargs.pop('close_timeout',self.CLOSE_TIMEOUT)
+        self._drop_report_interval = kwargs.pop('drop_report_interval',self.DROP_REPORT_INTERVAL)
+        resume = kwargs.pop('resume',False)
+        self._metrics = kwargs.pop('metrics',None)
+        if self._metrics is None:
+            self._metrics = Metrics()
+        self._tracer = kwargs.pop('tracer',None)
+        if self._tracer is None:
+            self._tracer = Tracer()
+        self._output_dir = output_dir
+        self._base_name = base_name
+        self._index_file_path = os.path.join(output_dir,base_name + '-data-index.json')
+        self._segments = []
+        if resume and os.path.exists(self._index_file_path):
+            with open(self._index_file_path,'r') as index_file:
+                self._segments = json.load(index_file)['segments']
+        self._csv_file = None
+        self._csv_writer = None
+        self._binary_data_writer = None
+        self._segment_date = None
+        self._dropped_row_count = 0
+        self._reported_dropped_row_count = 0
+        self._time_drop_report = None
+        self._written_row_count = 0
+        self._date_time_second = None
+        self._date_time_str_cached = None
+        self._row_in_csv = False
+        self._rows = collections.deque()
+        self._closing = threading.Event()
+        self._give_up = False
+        self._queue = queue.Queue(self._queue_size)
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run,name='sleep_assay_data_writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_csv_file_path(self):
+        return os.path.join(self._output_dir,self._segments[0]['csv'])
+
+    def get_binary_file_path(self):
+        return os.path.join(self._output_dir,self._segments[0]['binary'])
+
+    def get_index_file_path(self):
+        return self._index_file_path
+
+    def get_queue_depth(self):
+        return self._queue.qsize()
+
+    def get_dropped_row_count(self):
+        return self._dropped_row_count
+
+    def get_written_row_count(self):
+        return self._written_row_count
+
+    def write(self,video_frame,epoch,monotonic,state,white_light_power,red_light_pwm_status,red_light_power):
+        row = (video_frame,epoch,monotonic,state,white_light_power,red_light_pwm_status,red_light_power)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # only counted here, the writer thread reports it
+            self._dropped_row_count += 1
+
+    def close(self):
+        '''
+        Writes the queued rows and closes the files. Returns how many
+        rows were given up because the writer thread could not finish
+        within close_timeout seconds, for example on a failing disk.
+        '''
+        if self._thread is None:
+            return 0
+        self._closing.set()
+        try:
+            # wakes the writer thread, which also sees closing once a full
+            # queue is drained
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(self._close_timeout)
+        unwritten_row_count = 0
+        if self._thread.is_alive():
+            self._give_up = True
+            unwritten_row_count = len(self._rows) + sum(1 for row in list(self._queue.queue) if row is not None)
+            print('Error!','\ndata writer did not finish, rows not written:',unwritten_row_count)
+        self._thread = None
+        self._report_dropped_rows(True)
+        return unwritten_row_count
+
+    def _report_dropped_rows(self,now=False):
+        dropped_row_count = self._dropped_row_count
+        if dropped_row_count == self._reported_dropped_row_count:
+            return
+        time_now = time.monotonic()
+        if (not now) and (self._time_drop_report is not None) and (time_now - self._time_drop_report < self._drop_report_interval):
+            return
+        self._reported_dropped_row_count = dropped_row_count
+        self._time_drop_report = time_now
+        print('Error!','\ndata writer queue full, rows dropped:',dropped_row_count)
+
+    def _segment_name(self):
+        segment = len(self._segments)
+        if segment == 0:
+            return self._base_name + '-data'
+        return '{0}-data-{1:03d}'.format(self._base_name,segment)
+
+    def _open_csv_file(self,csv_file_path):
+        '''
+        Opens a csv segment file to append to, dropping a row cut short
+        by a crash, and writes the header to a new one.
+        '''
+        if os.path.exists(csv_file_path):
+            with open(csv_file_path,'r+b') as csv_file:
+                size = csv_file.seek(0,os.SEEK_END)
+                tail_start = max(0,size - CSV_TAIL_BYTES)
+                csv_file.seek(tail_start)
+                csv_file.truncate(tail_start + csv_file.read().rfind(b'\n') + 1)
+        self._csv_file = open(csv_file_path,'a',newline='')
+        self._csv_writer = csv.writer(self._csv_file,quotechar='\"',quoting=csv.QUOTE_MINIMAL)
+        if self._csv_file.tell() == 0:
+            self._csv_writer.writerow(CSV_HEADER)
+
+    def _open_segment(self):
+        '''
+        Opens the files of a new segment and lists it in the index right
+        away. A segment a crash opened before it was listed is appended
+        to, not truncated.
+        '''
+        name = self._segment_name()
+        self._open_csv_file(os.path.join(self._output_dir,name + '.txt'))
+        binary_file_path = os.path.join(self._output_dir,name + '.bin')
+        self._binary_data_writer = BinaryDataWriter(binary_file_path)
+        self._binary_data_writer.flush()
+        self._segment_date = None
+        segment = {'csv': name + '.txt',
+                   'binary': name + '.bin',
+                   'rows': 0}
+        records = load_binary_data(binary_file_path)
+        if len(records) > 0:
+            segment['rows'] = len(records)
+            segment['first_video_frame'] = int(records['video_frame'][0])
+            segment['first_epoch'] = float(records['epoch'][0])
+            segment['first_monotonic'] = float(records['monotonic'][0])
+            self._segment_date = datetime.date.fromtimestamp(records['epoch'][-1])
+        self._segments.append(segment)
+        self._write_index()
+
+    def _close_segment(self):
+        if self._csv_file.closed:
+            return
+        self._sync()
+        self._csv_file.close()
+        self._binary_data_writer.close()
+
+    def _segment_full(self,epoch):
+        # the day of the row, not of the host clock when it is written
+        if self._rotate_daily and (self._segment_date is not None) and (datetime.date.fromtimestamp(epoch) != self._segment_date):
+            return True
+        if self._rotate_bytes is not None:
+            segment_bytes = HEADER.size + self._segments[-1]['rows']*RECORD.size
+            if segment_bytes >= self._rotate_bytes:
+                return True
+        return False
+
+    def _write_rows(self,rows):
+        '''
+        Removes each row from rows once it is written to both files,
+        and remembers when it is only in the csv file, so a batch
+        interrupted by a write error is resumed without duplicates.
+        '''
+        while rows:
+            row = rows[0]
+            if (not self._row_in_csv) and self._segment_full(row[1]):
+                self._close_segment()
+                self._open_segment()
+            video_frame, epoch, monotonic, state, white_light_power, red_light_pwm_status, red_light_power = row
+            if not self._row_in_csv:
+                self._csv_writer.writerow([video_frame,
+                                           self._date_time_str(epoch),
+                                           '{0:.6f}'.format(epoch),
+                                           '{0:.6f}'.format(monotonic),
+                                           state,
+                                           white_light_power,
+                                           red_light_pwm_status,
+                                           red_light_power])
+                self._row_in_csv = True
+            self._binary_data_writer.write(*row)
+            self._row_in_csv = False
+            rows.popleft()
+            segment = self._segments[-1]
+            if segment['rows'] == 0:
+                segment['first_video_frame'] = video_frame
+                segment['first_epoch'] = epoch
+                segment['first_monotonic'] = monotonic
+                self._segment_date = datetime.date.fromtimestamp(epoch)
+            segment['rows'] += 1
+            self._written_row_count += 1
+
+    def _date_time_str(self,epoch):
+        # rows come many times a second, so only format once per second
+        second = int(epoch)
+        if second != self._date_time_second:
+            self._date_time_second = second
+            self._date_time_str_cached = epoch_to_date_time_str(second)
+        return self._date_time_str_cached
+
+    def _flush(self):
+        self._csv_file.flush()
+        self._binary_data_writer.flush()
+
+    def _sync(self):
+        time_start = time.monotonic()
+        with self._tracer.span('fsync'):
+            self._flush()
+            os.fsync(self._csv_file.fileno())
+            os.fsync(self._binary_data_writer.fileno())
+            self._write_index()
+        self._metrics.observe('fsync_ms',None,1000*(time.monotonic() - time_start))
+
+    def _write_index(self):
+        index = {'version': INDEX_VERSION,
+                 'segments': self._segments}
+        index_file_path_tmp = self._index_file_path + '.tmp'
+        with open(index_file_path_tmp,'w') as index_file:
+            json.dump(index,index_file,indent=1)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(index_file_path_tmp,self._index_file_path)
+
+    def _run(self):
+        rows = self._rows
+        time_flush = time.time()
+        time_fsync = time_flush
+        closing = False
+        while True:
+            if not closing:
+                timeout = max(0,min(time_flush + self._flush_interval,time_fsync + self._fsync_interval) - time.time())
+                try:
+                    row = self._queue.get(timeout=timeout)
+                    while row is not None:
+                        rows.append(row)
+                        row = self._queue.get_nowait()
+                    closing = True
+                except queue.Empty:
+                    closing = self._closing.is_set()
+            self._report_dropped_rows()
+            try:
+                if rows:
+                    time_start = time.monotonic()
+                    with self._tracer.span('write_rows',rows=len(rows)):
+                        self._write_rows(rows)
+                    self._metrics.observe('write_ms',None,1000*(time.monotonic() - time_start))
+                if closing:
+                    self._close_segment()
+                    return
+                time_now = time.time()
+                if time_now >= (time_fsync + self._fsync_interval):
+                    self._sync()
+                    time_flush = time_fsync = time_now
+                elif time_now >= (time_flush + self._flush_interval):
+                    self._flush()
+                    time_flush = time_now
+            except (IOError, OSError) as e:
+                # rows stay in the batch and are written once the disk recovers
+                self._metrics.increment('write_errors')
+                print('Error!','\ndata writer:',e)
+                if self._give_up:
+                    return
+                time.sleep(self.RETRY_DELAY)
+
+
+def load_data_index(index_file_path):
+    '''
+    Returns the records of every segment listed in an index file as
+    one structured array.
+    '''
+    with open(index_file_path,'r') as index_file:
+        index = json.load(index_file)
+    output_dir = os.path.dirname(os.path.abspath(index_file_path))
+    segments = [load_binary_data(os.path.join(output_dir,segment['binary'])) for segment in index['segments']]
+    return np.concatenate(segments)
+
+
+def is_data_index_file(file_path):
+    return file_path.endswith('-data-index.json')
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import numpy as np
+
+from .data_loader import load_data
+
+
+FIELDS = ['state',
+          'white_light_power',
+          'red_light_pwm_status',
+          'red_light_power']
+
+
+class FrameIndexError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class FrameIndex(object):
+    '''
+    Per video frame state of a data log, which only has a row when
+    something changed.
+
+    Each frame takes the values of the last row at or before it, the
+    same as a step plot with where='post'. Frames before the first row
+    are not valid and take fill. Lookups use searchsorted on the
+    video_frame column, so no array as long as the recording is ever
+    made: get_values costs a binary search per frame asked for,
+    get_range expands only the rows inside the range and get_runs
+    returns the range as runs of constant values.
+
+    Example Usage:
+
+    fi = FrameIndex(load_data('2016-7-15-9-0-0-data-index.json'))
+    fi.get_values([0,1000,2000])['white_light_power']
+    values = fi.get_range(0,1000000)
+    starts, stops, values = fi.get_runs(0,1000000)
+    '''
+    def __init__(self,log,*args,**kwargs):
+        self._fields = kwargs.pop('fields',FIELDS)
+        self._fill = kwargs.pop('fill',0)
+        video_frame = np.asarray(log['video_frame'],dtype=np.int64)
+        if np.any(np.diff(video_frame) < 0):
+            raise FrameIndexError('Data log video frames are not in order')
+        self._video_frame = video_frame
+        self._columns = dict((field,np.asarray(log[field])) for field in self._fields)
+
+    def get_row_count(self):
+        return len(self._video_frame)
+
+    def get_frame_span(self):
+        '''
+        Returns the first and last video frame with a row.
+        '''
+        if len(self._video_frame) == 0:
+            return None
+        return int(self._video_frame[0]), int(self._video_frame[-1])
+
+    def get_rows(self,frames):
+        '''
+        Returns the index of the row in effect at each of frames, the
+        last row at or before it, or -1 before the first row.
+        '''
+        return np.searchsorted(self._video_frame,frames,side='right') - 1
+
+    def _take(self,rows):
+        valid = rows >= 0
+        values = {'valid': valid}
+        safe_rows = np.where(valid,rows,0)
+        for field in self._fields:
+            column = self._columns[field]
+            if len(column) == 0:
+                values[field] = np.full(rows.shape,self._fill,dtype=column.dtype)
+            else:
+                values[field] = np.where(valid,column[safe_rows],self._fill).astype(column.dtype)
+        return values
+
+    def get_values(self,frames):
+        '''
+        Returns a dict of arrays with the value of each field at each
+        of frames, in any order, and a valid mask.
+        '''
+        return self._take(self.get_rows(np.asarray(frames,dtype=np.int64)))
+
+    def _get_run_rows(self,start,stop):
+        # the row in effect at start, then every row that starts inside the range
+        first = int(self.get_rows(start))
+        last = int(np.searchsorted(self._video_frame,stop,side='left'))
+        rows = np.arange(first,max(last,first + 1),dtype=np.int64)
+        starts = np.full(len(rows),start,dtype=np.int64)
+        starts[1:] = self._video_frame[rows[1:]]
+        stops = np.append(starts[1:],stop)
+        # rows sharing a frame with a later row are never in effect
+        keep = stops > starts
+        return rows[keep], starts[keep], stops[keep]
+
+    def get_runs(self,start,stop):
+        '''
+        Returns the start frames, stop frames and a dict of values of
+        the runs of constant values covering frames start to stop,
+        with one run per row in effect inside the range.
+        '''
+        if stop <= start:
+            rows = np.zeros(0,dtype=np.int64)
+            return rows, rows.copy(), self._take(rows)
+        rows, starts, stops = self._get_run_rows(start,stop)
+        return starts, stops, self._take(rows)
+
+    def get_range(self,start,stop):
+        '''
+        Returns a dict of arrays with the value of each field at every
+        frame from start to stop, and a valid mask.
+        '''
+        if stop <= start:
+            return self._take(np.zeros(0,dtype=np.int64))
+        rows, starts, stops = self._get_run_rows(start,stop)
+        return self._take(np.repeat(rows,stops - starts))
+
+
+def load_frame_index(data_file_path,*args,**kwargs):
+    '''
+    Returns a FrameIndex of a csv, binary or index data file.
+    '''
+    return FrameIndex(load_data(data_file_path),*args,**kwargs)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+JOURNAL_VERSION = 1
+
+
+class JournalError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def hash_config_file(config_file_path):
+    '''
+    Returns the sha256 of the bytes of a config file, so a run is only
+    resumed with the protocol it was started with.
+    '''
+    with open(config_file_path,'rb') as config_file:
+        return hashlib.sha256(config_file.read()).hexdigest()
+
+
+def get_journal_file_path(index_file_path):
+    return index_file_path.replace('-data-index.json','-journal.json')
+
+
+class RunJournal(object):
+    '''
+    Durable record of a run in progress, enough to pick it up again
+    after the host process dies or the serial link resets.
+
+    The journal holds the hash of the config file, the absolute start
+    time of the camera trigger, each phase issued to the board and how
+    many of its commands were sent, and the last frame logged. It is a
+    small json file that is replaced atomically, so after a crash it
+    holds the last complete update.
+
+    update() only changes the fields in memory and wakes a background
+    thread that writes them, so the acquisition loop never waits on
+    the disk. Updates that come faster than the disk are written
+    together as the latest fields. close() writes what is left. Write
+    errors are retried until the disk comes back.
+
+    Example Usage:
+
+    journal = RunJournal('2016-7-15-9-0-0-journal.json',{'config_sha256': sha256})
+    journal.update(video_frame=1000)
+    journal.close()
+    journal = RunJournal('2016-7-15-9-0-0-journal.json')
+    journal.get('video_frame')
+    '''
+    RETRY_DELAY = 1.0
+
+    def __init__(self,journal_file_path,fields=None):
+        self._journal_file_path = journal_file_path
+        if fields is None:
+            if not os.path.exists(journal_file_path):
+                raise JournalError('No journal file: {0}'.format(journal_file_path))
+            with open(journal_file_path,'r') as journal_file:
+                self._fields = json.load(journal_file)
+            if self._fields.get('version') != JOURNAL_VERSION:
+                raise JournalError('Unknown journal version: {0}'.format(self._fields.get('version')))
+        else:
+            self._fields = dict(fields)
+            self._fields['version'] = JOURNAL_VERSION
+            self._write(self._dumps())
+        self._condition = threading.Condition()
+        self._update_count = 0
+        self._written_update_count = 0
+        self._closing = False
+        self._thread = threading.Thread(target=self._run,name='sleep_assay_journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_journal_file_path(self):
+        return self._journal_file_path
+
+    def get(self,key,default=None):
+        with self._condition:
+            return self._fields.get(key,default)
+
+    def get_fields(self):
+        with self._condition:
+            return dict(self._fields)
+
+    def update(self,**fields):
+        with self._condition:
+            self._fields.update(fields)
+            self._update_count += 1
+            self._condition.notify_all()
+
+    def close(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def _dumps(self):
+        return json.dumps(self._fields,indent=1,sort_keys=True)
+
+    def _write(self,journal):
+        journal_file_path_tmp = self._journal_file_path + '.tmp'
+        with open(journal_file_path_tmp,'w') as journal_file:
+            journal_file.write(journal)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(journal_file_path_tmp,self._journal_file_path)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while (self._written_update_count == self._update_count) and not self._closing:
+                    self._condition.wait()
+                if self._written_update_count == self._update_count:
+                    return
+                # serialized here, so fields changed meanwhile are never half written
+                journal = self._dumps()
+                update_count = self._update_count
+            try:
+                self._write(journal)
+            except (IOError, OSError) as e:
+                print('Error!','\njournal:',e)
+                time.sleep(self.RETRY_DELAY)
+                continue
+            with self._condition:
+                self._written_update_count = update_count
+                self._condition.notify_all()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import threading
+import time
+
+import numpy as np
+
+from .data_log import DATA_DTYPE
+
+
+class RingBuffer(object):
+    '''
+    Fixed size buffer of the most recent samples.
+
+    Storage is one preallocated structured array, so appending a
+    sample never allocates and old samples are overwritten in place.
+
+    Example Usage:
+
+    rb = RingBuffer(1000)
+    rb.append((0,time.time(),time.monotonic(),1,100,0,0))
+    rb.get_last(10)
+    '''
+    def __init__(self,capacity,dtype=DATA_DTYPE):
+        self._data = np.zeros(capacity,dtype=dtype)
+        self._capacity = capacity
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count,self._capacity)
+
+    def get_capacity(self):
+        return self._capacity
+
+    def get_count(self):
+        '''
+        Returns the number of samples ever appended.
+        '''
+        return self._count
+
+    def append(self,sample):
+        with self._lock:
+            self._data[self._count % self._capacity] = sample
+            self._count += 1
+
+    def get_last(self,n=None):
+        '''
+        Returns a copy of the last n samples, oldest first.
+        '''
+        with self._lock:
+            size = min(self._count,self._capacity)
+            if (n is None) or (n > size):
+                n = size
+            end = self._count % self._capacity
+            start = end - n
+            if start >= 0:
+                return self._data[start:end].copy()
+            return np.concatenate((self._data[start:],self._data[:end]))
+
+
+class LiveView(object):
+    '''
+    Plots the samples in a RingBuffer while a run is in progress.
+
+    The figure is created once and each redraw only replaces the line
+    data. update() returns immediately unless redraw_interval seconds
+    have passed since the last redraw, and also skips the redraw when
+    the previous redraw took longer than the time left before the
+    caller's next deadline, so drawing never delays acquisition.
+
+    Example Usage:
+
+    lv = LiveView(ring_buffer,scale_factor)
+    lv.update(deadline)
+    '''
+    REDRAW_INTERVAL = 1.0
+    SAMPLE_COUNT = 10000
+
+    def __init__(self,ring_buffer,scale_factor,*args,**kwargs):
+        self._ring_buffer = ring_buffer
+        self._scale_factor = scale_factor
+        self._redraw_interval = kwargs.pop('redraw_interval',self.REDRAW_INTERVAL)
+        self._sample_count = kwargs.pop('sample_count',self.SAMPLE_COUNT)
+        self._time_redraw_prev = 0
+        self._redraw_duration = 0
+        self._count_prev = 0
+
+        # imported here so runs without a live view never load matplotlib
+        import matplotlib.pyplot as plt
+        plt.ion()
+        self._fig, (self._white_light_axes, self._red_light_axes) = plt.subplots(2,1)
+        self._fig.suptitle('live', fontsize=14, fontweight='bold')
+        self._white_light_line, = self._white_light_axes.step([],[],where='post')
+        self._white_light_axes.set_ylim(-0.1,255+45)
+        self._white_light_axes.set_ylabel('white light power')
+        self._white_light_axes.grid(True)
+        self._red_light_line, = self._red_light_axes.step([],[],where='post')
+        self._red_light_axes.set_ylim(-0.1,1.25)
+        self._red_light_axes.set_ylabel('red light pwm status')
+        self._red_light_axes.set_xlabel('days')
+        self._red_light_axes.grid(True)
+        plt.show(block=False)
+
+    def update(self,deadline=None):
+        '''
+        Redraws if due and if there is time before deadline, a
+        time.time() value. Returns True if it redrew.
+        '''
+        time_start = time.time()
+        if (time_start - self._time_redraw_prev) < self._redraw_interval:
+            return False
+        if (deadline is not None) and ((deadline - time_start) < self._redraw_duration):
+            return False
+        count = self._ring_buffer.get_count()
+        if count == self._count_prev:
+            return False
+        self._count_prev = count
+        samples = self._ring_buffer.get_last(self._sample_count)
+        t = samples['video_frame']*self._scale_factor
+        self._white_light_line.set_data(t,samples['white_light_power'])
+        self._red_light_line.set_data(t,samples['red_light_pwm_status'])
+        for axes in (self._white_light_axes,self._red_light_axes):
+            if len(t) > 1:
+                axes.set_xlim(t[0],t[-1])
+        self._fig.canvas.draw_idle()
+        self._fig.canvas.flush_events()
+        time_stop = time.time()
+        self._redraw_duration = time_stop - time_start
+        self._time_redraw_prev = time_stop
+        return True
+
+    def close(self):
+        import matplotlib.pyplot as plt
+        plt.close(self._fig)
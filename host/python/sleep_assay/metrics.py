@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import bisect
+import json
+import os
+import threading
+import time
+
+
+# upper edges of the latency histogram bins, the last bin holds the rest
+LATENCY_BIN_EDGES_MS = (0.5,1,2,5,10,20,50,100,200,500,1000,2000,5000)
+
+
+class _Histogram(object):
+    def __init__(self,bin_count):
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.histogram = [0]*bin_count
+
+
+class Metrics(object):
+    '''
+    Counters, latency histograms and gauges of a running acquisition,
+    to catch a degrading serial link or a slowing disk before it costs
+    data.
+
+    Counters and histograms have a name and an optional key, like the
+    method id of a request, and can be updated from any thread. Gauges
+    are functions that are only called when a snapshot is taken, so
+    values other objects already keep, like the data writer queue
+    depth, are not copied on every change.
+
+    Example Usage:
+
+    metrics = Metrics()
+    metrics.increment('requests',4)
+    metrics.observe('request_latency_ms',4,1.2)
+    metrics.add_gauge('queue_depth',data_writer.get_queue_depth)
+    metrics.get_snapshot()
+    '''
+    def __init__(self,*args,**kwargs):
+        self._bin_edges = tuple(kwargs.pop('bin_edges',LATENCY_BIN_EDGES_MS))
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._time_start = time.time()
+
+    def increment(self,name,key=None,count=1):
+        with self._lock:
+            counter = self._counters.setdefault(name,{})
+            counter[key] = counter.get(key,0) + count
+
+    def observe(self,name,key,value):
+        '''
+        Adds value, in milliseconds, to the histogram of name and key.
+        '''
+        with self._lock:
+            histograms = self._histograms.setdefault(name,{})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = _Histogram(len(self._bin_edges) + 1)
+            histogram.count += 1
+            histogram.sum += value
+            histogram.max = max(histogram.max,value)
+            histogram.histogram[bisect.bisect_left(self._bin_edges,value)] += 1
+
+    def add_gauge(self,name,function):
+        with self._lock:
+            self._gauges[name] = function
+
+    def remove_gauge(self,name):
+        with self._lock:
+            self._gauges.pop(name,None)
+
+    def get_counter(self,name,key=None):
+        with self._lock:
+            return self._counters.get(name,{}).get(key,0)
+
+    def _keyed(self,values,function):
+        # counters without a key are plain values, keyed ones are dicts
+        if list(values.keys()) == [None]:
+            return function(values[None])
+        return dict((str(key),function(value)) for key, value in values.items())
+
+    def get_snapshot(self):
+        with self._lock:
+            counters = dict((name,self._keyed(counter,int)) for name, counter in self._counters.items())
+            histograms = dict((name,self._keyed(histograms,self._histogram_statistics)) for name, histograms in self._histograms.items())
+            gauges = dict(self._gauges)
+        gauge_values = {}
+        for name, function in gauges.items():
+            try:
+                gauge_values[name] = function()
+            except Exception as e:
+                gauge_values[name] = None
+                print('Error!','\ngauge:',name,e)
+        return {'epoch': time.time(),
+                'uptime_s': time.time() - self._time_start,
+                'counters': counters,
+                'histograms': histograms,
+                'gauges': gauge_values,
+                'bin_edges_ms': list(self._bin_edges)}
+
+    def _histogram_statistics(self,histogram):
+        return {'count': histogram.count,
+                'mean_ms': histogram.sum/histogram.count if histogram.count else None,
+                'max_ms': histogram.max,
+                'histogram': list(histogram.histogram)}
+
+
+def write_metrics_file(metrics,metrics_file_path):
+    '''
+    Replaces the metrics file atomically with a snapshot, so a reader
+    polling it never sees a partial file.
+    '''
+    metrics_file_path_tmp = metrics_file_path + '.tmp'
+    with open(metrics_file_path_tmp,'w') as metrics_file:
+        json.dump(metrics.get_snapshot(),metrics_file,indent=1,sort_keys=True)
+    os.replace(metrics_file_path_tmp,metrics_file_path)
+
+
+class MetricsFileWriter(object):
+    '''
+    Rewrites a metrics file with a snapshot every interval seconds
+    from a background thread, so the acquisition loop never waits on
+    the disk. close() writes a last snapshot.
+
+    Example Usage:
+
+    writer = MetricsFileWriter(metrics,'2016-7-15-9-0-0-metrics.json')
+    writer.close()
+    '''
+    INTERVAL = 10.0
+
+    def __init__(self,metrics,metrics_file_path,*args,**kwargs):
+        self._interval = kwargs.pop('interval',self.INTERVAL)
+        self._metrics = metrics
+        self._metrics_file_path = metrics_file_path
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run,name='sleep_assay_metrics_file')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_metrics_file_path(self):
+        return self._metrics_file_path
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._closing.set()
+        self._thread.join()
+        self._thread = None
+
+    def _write(self):
+        try:
+            write_metrics_file(self._metrics,self._metrics_file_path)
+        except (IOError, OSError) as e:
+            print('Error!','\nmetrics file:',e)
+
+    def _run(self):
+        while not self._closing.wait(self._interval):
+            self._write()
+        self._write()
+
+
+class MetricsServer(object):
+    '''
+    Serves metrics snapshots as json on a local http port from a
+    background thread.
+
+    Example Usage:
+
+    server = MetricsServer(metrics,8000)
+    # curl http://127.0.0.1:8000/metrics
+    server.close()
+    '''
+    HOST = '127.0.0.1'
+
+    def __init__(self,metrics,port,*args,**kwargs):
+        host = kwargs.pop('host',self.HOST)
+        # only runs that serve metrics pay for importing http.server
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.rstrip('/') not in ('','/metrics'):
+                    handler.send_error(404)
+                    return
+                body = json.dumps(metrics.get_snapshot(),indent=1,sort_keys=True).encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type','application/json')
+                handler.send_header('Content-Length',str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+            def log_message(handler,*args):
+                pass
+        self._server = HTTPServer((host,port),Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,name='sleep_assay_metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_address(self):
+        return self._server.server_address
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import argparse
+import heapq
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .sleep_assay import SleepAssay
+
+
+class MultiRig(object):
+    '''
+    Runs the protocols of several relay boards, one config file per
+    rig, from a single process.
+
+    Each rig keeps its own SleepAssay device and data file. One
+    scheduler thread keeps the next frame deadline of every rig in a
+    heap and hands due rigs to a shared thread pool, so rigs waiting
+    on their serial port never hold up the others and no rig spins in
+    its own polling loop.
+
+    Without hardware, the virtual boards run speed times faster than
+    real time. Rigs are scheduled on the wall clock, so a speed must be
+    given; the fast forward of a single SleepAssay run is not available.
+
+    Example Usage:
+
+    mr = MultiRig(['rig0_config.yaml','rig1_config.yaml'])
+    mr.run()
+    '''
+    SPEED = 1.0
+
+    def __init__(self,config_file_paths,quick_test=False,no_hardware=False,notify=False,max_workers=None,**kwargs):
+        speed = kwargs.pop('speed',self.SPEED)
+        if speed is None:
+            raise RuntimeError('MultiRig needs a speed, rigs are scheduled on the wall clock')
+        # frame deadlines are in virtual seconds without hardware
+        self._speed = speed if no_hardware else 1.0
+        if max_workers is None:
+            max_workers = len(config_file_paths)
+        self._max_workers = max(1,max_workers)
+        with ThreadPoolExecutor(self._max_workers) as pool:
+            # each device waits for the board to reset, so open them all at once
+            self._rigs = list(pool.map(lambda path: SleepAssay(path,quick_test,no_hardware,notify,speed=speed),
+                                       config_file_paths))
+        self._names = [self._config_file_path_to_name(path) for path in config_file_paths]
+
+    def _config_file_path_to_name(self,config_file_path):
+        return os.path.splitext(os.path.basename(config_file_path))[0]
+
+    def get_rigs(self):
+        return self._rigs
+
+    def stop(self):
+        for rig in self._rigs:
+            rig.stop()
+
+    def run(self):
+        data_file_paths = []
+        for rig, name in zip(self._rigs,self._names):
+            data_file_paths.append(rig.start_run(name))
+
+        deadlines = [(time.monotonic(),index) for index in range(len(self._rigs))]
+        heapq.heapify(deadlines)
+        running = {}
+        with ThreadPoolExecutor(self._max_workers) as pool:
+            while deadlines or running:
+                if deadlines:
+                    timeout = max(0,deadlines[0][0] - time.monotonic())
+                else:
+                    timeout = None
+                if running:
+                    done, not_done = wait(running,timeout=timeout,return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                    done = []
+                for future in done:
+                    deadline, index = running.pop(future)
+                    try:
+                        rig_running = future.result()
+                    except Exception as e:
+                        # the other rigs keep going and the board of this
+                        # one keeps running, so its run can be resumed
+                        print('Error!','\n{0} failed:'.format(self._names[index]),e)
+                        continue
+                    if not rig_running:
+                        print('{0} finished'.format(self._names[index]))
+                        continue
+                    # each rig keeps its own frame deadlines and missed frame policy
+                    deadline = time.monotonic() + self._rigs[index].get_time_until_next_frame()/self._speed
+                    heapq.heappush(deadlines,(deadline,index))
+                time_now = time.monotonic()
+                while deadlines and (deadlines[0][0] <= time_now):
+                    deadline, index = heapq.heappop(deadlines)
+                    running[pool.submit(self._rigs[index].update_run)] = (deadline,index)
+        return data_file_paths
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file_paths", nargs='+', help="Paths to yaml config files, one per rig.")
+    parser.add_argument('-q',"--quick-test", help="Quick test.", action="store_true")
+    parser.add_argument('-n',"--no-hardware", help="Run without USB hardware attached.", action="store_true")
+    parser.add_argument("--notify", help="Let the relay boards push state changes instead of polling them.", action="store_true")
+    parser.add_argument('-w',"--max-workers", type=int, help="Number of rigs serviced at the same time.")
+    parser.add_argument("--speed", type=float, default=MultiRig.SPEED, help="With --no-hardware, run the virtual boards this many times faster than real time.")
+
+    args = parser.parse_args(args)
+
+    mr = MultiRig(args.config_file_paths,args.quick_test,args.no_hardware,args.notify,args.max_workers,speed=args.speed)
+    try:
+        data_file_paths = mr.run()
+    except KeyboardInterrupt:
+        mr.stop()
+        return
+    print('data_file_paths:')
+    for data_file_path in data_file_paths:
+        print(data_file_path)
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
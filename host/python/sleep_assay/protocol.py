@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import binascii
+import collections
+import struct
+
+
+# firmware/ssr_nano_pwm/Constants.h
+METHOD_ID_START_PWM = 0
+METHOD_ID_STOP_ALL_PULSES = 1
+METHOD_ID_GET_POWER = 2
+METHOD_ID_GET_PWM_STATUS = 3
+METHOD_ID_GET_STATE = 4
+METHOD_ID_SET_NOTIFY = 5
+METHOD_ID_REQUEST_ID = 6
+METHOD_ID_GET_PULSE_COUNTS = 7
+METHOD_ID_SET_FRAME_RELAY = 8
+METHOD_ID_SET_PROTOCOL = 9
+METHOD_ID_SET_WAVEFORM = 10
+
+RELAY_COUNT = 8
+PWM_LEVEL_COUNT_MAX = 3
+
+PROTOCOL_JSON = 0
+PROTOCOL_BINARY = 1
+PROTOCOLS = {'json': PROTOCOL_JSON,
+             'binary': PROTOCOL_BINARY}
+
+# a byte that never appears in json text, so binary frames and json
+# lines can share the serial link
+FRAME_SYNC = 0xA5
+FRAME_PAYLOAD_SIZE_MAX = 64
+FRAME_KIND_REQUEST = 0
+FRAME_KIND_REPLY = 1
+FRAME_KIND_NOTIFICATION = 2
+CRC_INIT = 0xFFFF
+
+_REQUEST_ID = struct.Struct('<I')
+_CRC = struct.Struct('<H')
+
+# argument formats of each method, the tail format repeats for the
+# rest of the arguments, each field is the size the firmware reads it as
+REQUEST_FORMATS = {METHOD_ID_START_PWM: ('<hhlhh','<ll'),
+                   METHOD_ID_STOP_ALL_PULSES: ('<',None),
+                   METHOD_ID_GET_POWER: ('<',None),
+                   METHOD_ID_GET_PWM_STATUS: ('<',None),
+                   METHOD_ID_GET_STATE: ('<',None),
+                   METHOD_ID_SET_NOTIFY: ('<hh',None),
+                   METHOD_ID_GET_PULSE_COUNTS: ('<',None),
+                   METHOD_ID_SET_FRAME_RELAY: ('<h',None),
+                   METHOD_ID_SET_PROTOCOL: ('<h',None),
+                   METHOD_ID_SET_WAVEFORM: ('<hhlhh','<lh')}
+
+# requests without arguments that are sent over and over, encoded
+# once when the protocol is negotiated
+CONSTANT_REQUESTS = ((METHOD_ID_STOP_ALL_PULSES,),
+                     (METHOD_ID_GET_POWER,),
+                     (METHOD_ID_GET_PWM_STATUS,),
+                     (METHOD_ID_GET_STATE,),
+                     (METHOD_ID_GET_PULSE_COUNTS,))
+
+# pwm status is one bit per level, one byte per relay
+_POWER = struct.Struct('<{0}B'.format(RELAY_COUNT))
+_PWM_STATUS = struct.Struct('<{0}B'.format(RELAY_COUNT))
+_PULSE_COUNTS = struct.Struct('<I{0}I'.format(RELAY_COUNT))
+_STATE = struct.Struct('<I{0}B{0}B{0}I'.format(RELAY_COUNT))
+_PROTOCOL = struct.Struct('<B')
+_NOTIFICATION = struct.Struct('<IIlBBBB')
+
+
+class ProtocolError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def crc16(data,crc=CRC_INIT):
+    '''
+    CRC-16/CCITT-FALSE, the same as _crc_xmodem_update from
+    util/crc16.h on the board starting from 0xFFFF.
+    '''
+    return binascii.crc_hqx(data,crc)
+
+
+def _wrap(value,size):
+    bits = 8*size
+    return ((int(value) + 2**(bits - 1)) % 2**bits) - 2**(bits - 1)
+
+
+def _pack_fields(format,values):
+    # wrap like the firmware casts, so out of range values never raise
+    s = struct.Struct(format)
+    sizes = [struct.calcsize('<' + code) for code in format[1:]]
+    values = list(values) + [0]*(len(sizes) - len(values))
+    return s.pack(*[_wrap(value,size) for value, size in zip(values,sizes)])
+
+
+def encode_args(method_id,args):
+    '''
+    Returns the binary arguments of a request. Missing arguments are
+    sent as 0, which is what the firmware reads for them anyway.
+    '''
+    try:
+        head_format, tail_format = REQUEST_FORMATS[method_id]
+    except KeyError:
+        raise ProtocolError('No binary format for method: {0}'.format(method_id))
+    head_count = len(head_format) - 1
+    chars = _pack_fields(head_format,args[:head_count])
+    if tail_format is not None:
+        tail_count = len(tail_format) - 1
+        tail = args[head_count:]
+        for position in range(0,len(tail),tail_count):
+            chars += _pack_fields(tail_format,tail[position:position + tail_count])
+    return chars
+
+
+def decode_args(method_id,chars):
+    '''
+    Returns the arguments of a binary request as a list of ints, the
+    inverse of encode_args.
+    '''
+    head_format, tail_format = REQUEST_FORMATS.get(method_id,('<',None))
+    head_size = struct.calcsize(head_format)
+    if len(chars) < head_size:
+        chars = chars + bytes(head_size - len(chars))
+    args = list(struct.unpack_from(head_format,chars))
+    if tail_format is not None:
+        tail_size = struct.calcsize(tail_format)
+        for position in range(head_size,len(chars) - tail_size + 1,tail_size):
+            args.extend(struct.unpack_from(tail_format,chars,position))
+    return args
+
+
+def encode_frame(payload):
+    if len(payload) > FRAME_PAYLOAD_SIZE_MAX:
+        raise ProtocolError('Frame payload too long: {0} bytes'.format(len(payload)))
+    head = bytes((len(payload),)) + payload
+    return bytes((FRAME_SYNC,)) + head + _CRC.pack(crc16(head))
+
+
+def encode_request(request_id,args):
+    method_id = args[0]
+    payload = bytes((FRAME_KIND_REQUEST,method_id)) + encode_args(method_id,list(args[1:])) + _REQUEST_ID.pack(request_id)
+    return encode_frame(payload)
+
+
+# every json request starts with the request id method and the id
+_JSON_REQUEST_PREFIX = '[{0},'.format(METHOD_ID_REQUEST_ID).encode()
+
+
+def encode_json_request(request_id,args):
+    return ('[' + ','.join(map(str,[METHOD_ID_REQUEST_ID,request_id] + list(args))) + ']\n').encode()
+
+
+def _pack_pwm_status(pwm_status):
+    return _PWM_STATUS.pack(*[sum(1 << level for level, status in enumerate(statuses) if status) for statuses in pwm_status])
+
+
+# the levels of every byte of a bit packed pwm status, to unpack it by lookup
+_PWM_STATUS_LEVELS = [tuple((mask >> level) & 1 for level in range(PWM_LEVEL_COUNT_MAX + 1)) for mask in range(256)]
+
+
+def _unpack_pwm_status(masks):
+    return [list(_PWM_STATUS_LEVELS[mask]) for mask in masks]
+
+
+def encode_result(method_id,result):
+    '''
+    Returns the binary result of a reply from the same values the json
+    reply holds.
+    '''
+    if result is None:
+        return b''
+    if method_id == METHOD_ID_GET_POWER:
+        return _POWER.pack(*result)
+    if method_id == METHOD_ID_GET_PWM_STATUS:
+        return _pack_pwm_status(result)
+    if method_id == METHOD_ID_GET_STATE:
+        time_ms, power, pwm_status, pulse_counts = result
+        return _STATE.pack(time_ms,*(list(power) + list(_pack_pwm_status(pwm_status)) + list(pulse_counts)))
+    if method_id == METHOD_ID_GET_PULSE_COUNTS:
+        time_ms, pulse_counts = result
+        return _PULSE_COUNTS.pack(time_ms,*pulse_counts)
+    if method_id == METHOD_ID_SET_PROTOCOL:
+        return _PROTOCOL.pack(result)
+    raise ProtocolError('No binary result for method: {0}'.format(method_id))
+
+
+def decode_result(method_id,chars):
+    if not chars:
+        return None
+    try:
+        if method_id == METHOD_ID_GET_POWER:
+            return list(_POWER.unpack(chars))
+        if method_id == METHOD_ID_GET_PWM_STATUS:
+            return _unpack_pwm_status(_PWM_STATUS.unpack(chars))
+        if method_id == METHOD_ID_GET_STATE:
+            values = _STATE.unpack(chars)
+            return [values[0],
+                    list(values[1:1 + RELAY_COUNT]),
+                    _unpack_pwm_status(values[1 + RELAY_COUNT:1 + 2*RELAY_COUNT]),
+                    list(values[1 + 2*RELAY_COUNT:])]
+        if method_id == METHOD_ID_GET_PULSE_COUNTS:
+            values = _PULSE_COUNTS.unpack(chars)
+            return [values[0],list(values[1:])]
+        if method_id == METHOD_ID_SET_PROTOCOL:
+            return _PROTOCOL.unpack(chars)[0]
+    except struct.error as e:
+        raise ProtocolError('Bad result of method {0}: {1}'.format(method_id,e))
+    raise ProtocolError('No binary result for method: {0}'.format(method_id))
+
+
+def encode_reply(method_id,request_id,result=None):
+    payload = bytes((FRAME_KIND_REPLY,method_id)) + encode_result(method_id,result) + _REQUEST_ID.pack(request_id)
+    return encode_frame(payload)
+
+
+def encode_notification(notification):
+    payload = bytes((FRAME_KIND_NOTIFICATION,)) + _NOTIFICATION.pack(notification['seq'],
+                                                                      notification['time'],
+                                                                      notification.get('frame',-1),
+                                                                      notification['relay'],
+                                                                      notification['level'],
+                                                                      notification['pwm_status'],
+                                                                      notification['power'])
+    return encode_frame(payload)
+
+
+def decode_request(payload):
+    '''
+    Returns the method id, request id and args of a request frame
+    payload.
+    '''
+    if (len(payload) < 2 + _REQUEST_ID.size) or (payload[0] != FRAME_KIND_REQUEST):
+        raise ProtocolError('Not a request frame')
+    method_id = payload[1]
+    request_id = _REQUEST_ID.unpack_from(payload,len(payload) - _REQUEST_ID.size)[0]
+    return method_id, request_id, decode_args(method_id,payload[2:len(payload) - _REQUEST_ID.size])
+
+
+def decode_payload(payload):
+    '''
+    Returns a reply frame payload as [request_id] or
+    [request_id,result] and a notification frame payload as a dict,
+    the same as their json lines parse to.
+    '''
+    if len(payload) == 0:
+        raise ProtocolError('Empty frame')
+    kind = payload[0]
+    if kind == FRAME_KIND_REPLY:
+        if len(payload) < 2 + _REQUEST_ID.size:
+            raise ProtocolError('Reply frame too short')
+        method_id = payload[1]
+        request_id = _REQUEST_ID.unpack_from(payload,len(payload) - _REQUEST_ID.size)[0]
+        result = decode_result(method_id,payload[2:len(payload) - _REQUEST_ID.size])
+        if result is None:
+            return [request_id]
+        return [request_id,result]
+    if kind == FRAME_KIND_NOTIFICATION:
+        try:
+            seq, time_ms, frame, relay, level, pwm_status, power = _NOTIFICATION.unpack(payload[1:])
+        except struct.error as e:
+            raise ProtocolError('Bad notification frame: {0}'.format(e))
+        notification = collections.OrderedDict([('seq',seq),('time',time_ms)])
+        if frame >= 0:
+            notification['frame'] = frame
+        notification['relay'] = relay
+        notification['level'] = level
+        notification['pwm_status'] = pwm_status
+        notification['power'] = power
+        return notification
+    raise ProtocolError('Unknown frame kind: {0}'.format(kind))
+
+
+class RequestEncoder(object):
+    '''
+    Encodes requests as json lines or binary frames.
+
+    Binary frames are a sync byte, the payload length, the payload and
+    a CRC-16 of the length and payload. The request id is the last
+    field of the payload, so the constant requests are encoded once
+    up to the request id, along with the crc of that prefix, and each
+    send only packs the id and finishes the crc over its four bytes.
+    Json constant requests likewise keep everything after the id.
+
+    Example Usage:
+
+    encoder = RequestEncoder(PROTOCOL_BINARY)
+    serial_device.write(encoder.encode(request_id,[METHOD_ID_GET_STATE]))
+    '''
+    def __init__(self,protocol=PROTOCOL_JSON,constant_requests=CONSTANT_REQUESTS):
+        self._protocol = protocol
+        self._constant = {}
+        for args in constant_requests:
+            args = tuple(args)
+            if protocol == PROTOCOL_BINARY:
+                payload = bytes((FRAME_KIND_REQUEST,args[0])) + encode_args(args[0],list(args[1:]))
+                prefix = bytes((FRAME_SYNC,len(payload) + _REQUEST_ID.size)) + payload
+                self._constant[args] = (prefix,crc16(prefix[1:]))
+            else:
+                self._constant[args] = (',' + ','.join(map(str,args)) + ']\n').encode()
+
+    def get_protocol(self):
+        return self._protocol
+
+    def encode(self,request_id,args):
+        constant = self._constant.get(tuple(args))
+        if self._protocol == PROTOCOL_BINARY:
+            if constant is None:
+                return encode_request(request_id,args)
+            prefix, crc = constant
+            request_id_chars = _REQUEST_ID.pack(request_id)
+            return prefix + request_id_chars + _CRC.pack(crc16(request_id_chars,crc))
+        if constant is None:
+            return encode_json_request(request_id,args)
+        return _JSON_REQUEST_PREFIX + str(request_id).encode() + constant
+
+
+class FrameParser(object):
+    '''
+    Splits a byte stream into json lines and binary frames.
+
+    feed returns a list of (kind, chars) with kind 'line' for a json
+    line without its newline, 'frame' for the payload of a binary
+    frame with a good crc and 'crc_error' for a frame whose crc did
+    not match or whose length is too long. After a bad frame the parser looks for the next sync
+    byte from the byte after the bad sync byte, so one lost byte never
+    costs more than the frame it was in.
+
+    Example Usage:
+
+    parser = FrameParser()
+    for kind, chars in parser.feed(serial_device.read(serial_device.in_waiting)):
+        ...
+    '''
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self,chars):
+        self._buffer.extend(chars)
+        messages = []
+        buffer = self._buffer
+        while buffer:
+            if buffer[0] == FRAME_SYNC:
+                if len(buffer) < 2:
+                    break
+                length = buffer[1]
+                if length > FRAME_PAYLOAD_SIZE_MAX:
+                    messages.append(('crc_error',bytes(buffer[:2])))
+                    del buffer[:1]
+                    continue
+                frame_size = 2 + length + _CRC.size
+                if len(buffer) < frame_size:
+                    break
+                head = bytes(buffer[1:2 + length])
+                if _CRC.unpack_from(buffer,2 + length)[0] == crc16(head):
+                    messages.append(('frame',head[1:]))
+                    del buffer[:frame_size]
+                else:
+                    messages.append(('crc_error',bytes(buffer[:frame_size])))
+                    del buffer[:1]
+                continue
+            newline = buffer.find(b'\n')
+            sync = buffer.find(bytes((FRAME_SYNC,)))
+            if (sync >= 0) and ((newline < 0) or (sync < newline)):
+                # text cut off by a frame, like noise before a reset
+                if sync > 0:
+                    messages.append(('line',bytes(buffer[:sync])))
+                del buffer[:sync]
+                continue
+            if newline < 0:
+                break
+            messages.append(('line',bytes(buffer[:newline])))
+            del buffer[:newline + 1]
+        return messages
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import bisect
+import math
+
+from .clock import Clock
+
+
+POLICY_SKIP = 'skip'
+POLICY_CATCH_UP = 'catch_up'
+POLICIES = (POLICY_SKIP,POLICY_CATCH_UP)
+
+# upper edges of the jitter histogram bins, the last bin holds the rest
+JITTER_BIN_EDGES_MS = (0.1,0.2,0.5,1,2,5,10,20,50,100,200,500,1000)
+
+
+class SchedulerError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class _PhaseTiming(object):
+    def __init__(self,bin_count):
+        self.tick_count = 0
+        self.missed_tick_count = 0
+        self.jitter_sum = 0
+        self.jitter_max = 0
+        self.histogram = [0]*bin_count
+
+
+class FrameScheduler(object):
+    '''
+    Frame deadlines on a fixed grid of a monotonic clock.
+
+    Deadline n is always start + n*period, so timing errors never add
+    up over a run. tick() is called when a frame starts and records how
+    late it started. A frame that starts a whole period or more late
+    counts as a missed tick. With the skip policy, frames whose
+    deadlines have passed are dropped and tick() returns how many frame
+    periods the late frame covers. With the catch_up policy, every
+    frame is still run, back to back, unless the scheduler is more
+    than max_catch_up frames behind, then it skips ahead. Lateness is
+    collected in a histogram for each phase.
+
+    Example Usage:
+
+    fs = FrameScheduler(1/30)
+    fs.start()
+    while True:
+        fs.wait()
+        acquire()
+    '''
+    POLICY = POLICY_SKIP
+    MAX_CATCH_UP = 100
+
+    def __init__(self,period,clock=None,*args,**kwargs):
+        self._policy = kwargs.pop('policy',self.POLICY)
+        if self._policy not in POLICIES:
+            raise SchedulerError('Unknown scheduler policy: {0}'.format(self._policy))
+        self._max_catch_up = kwargs.pop('max_catch_up',self.MAX_CATCH_UP)
+        self._bin_edges = tuple(kwargs.pop('bin_edges',JITTER_BIN_EDGES_MS))
+        if clock is None:
+            clock = Clock()
+        self._clock = clock
+        self._period = period
+        self._phases = {}
+        self._phase = None
+        self.set_phase('')
+        self.start()
+
+    def get_period(self):
+        return self._period
+
+    def get_policy(self):
+        return self._policy
+
+    def start(self,time_start=None):
+        if time_start is None:
+            time_start = self._clock.monotonic()
+        self._time_start = time_start
+        self._index = 0
+
+    def set_phase(self,name):
+        '''
+        Collects the timing of following ticks under name.
+        '''
+        if name not in self._phases:
+            self._phases[name] = _PhaseTiming(len(self._bin_edges) + 1)
+        self._phase = self._phases[name]
+
+    def get_deadline(self):
+        return self._time_start + self._index*self._period
+
+    def get_time_until_deadline(self):
+        return self.get_deadline() - self._clock.monotonic()
+
+    def wait(self):
+        '''
+        Sleeps until the next deadline, then ticks.
+        '''
+        self._clock.sleep(self.get_time_until_deadline())
+        return self.tick()
+
+    def tick(self,time_now=None):
+        '''
+        Records a frame starting at time_now for the current deadline,
+        moves to the next deadline and returns the number of frame
+        periods this frame covers.
+        '''
+        if time_now is None:
+            time_now = self._clock.monotonic()
+        lateness = max(0,time_now - self.get_deadline())
+        phase = self._phase
+        phase.tick_count += 1
+        phase.jitter_sum += lateness
+        phase.jitter_max = max(phase.jitter_max,lateness)
+        phase.histogram[bisect.bisect_left(self._bin_edges,1000*lateness)] += 1
+        behind = int(math.floor(lateness/self._period))
+        if behind == 0:
+            self._index += 1
+            return 1
+        if (self._policy == POLICY_CATCH_UP) and (behind <= self._max_catch_up):
+            phase.missed_tick_count += 1
+            self._index += 1
+            return 1
+        # the skipped deadlines never get a frame of their own
+        phase.missed_tick_count += behind
+        self._index += behind + 1
+        return behind + 1
+
+    def skip(self,count):
+        '''
+        Moves count deadlines ahead and records them as frames that
+        started on time, for a caller that knows nothing could happen
+        on them.
+        '''
+        phase = self._phase
+        phase.tick_count += count
+        phase.histogram[0] += count
+        self._index += count
+
+    def get_missed_tick_count(self):
+        return sum(phase.missed_tick_count for phase in self._phases.values())
+
+    def get_statistics(self):
+        '''
+        Returns a dict with tick counts, missed ticks, jitter and the
+        jitter histogram of each phase that ran ticks.
+        '''
+        statistics = {}
+        # list first, since metrics gauges call this from other threads
+        for name, phase in list(self._phases.items()):
+            if phase.tick_count == 0:
+                continue
+            statistics[name] = {'tick_count': phase.tick_count,
+                                'missed_tick_count': phase.missed_tick_count,
+                                'jitter_mean_ms': 1000*phase.jitter_sum/phase.tick_count,
+                                'jitter_max_ms': 1000*phase.jitter_max,
+                                'histogram_bin_edges_ms': list(self._bin_edges),
+                                'histogram': list(phase.histogram)}
+        return statistics
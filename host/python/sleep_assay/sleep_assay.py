@@ -7,16 +7,27 @@ import yaml
 import sys
 import argparse
 import datetime
-import platform
 import json
-import csv
+import platform
 import os
-import numpy as np
-import matplotlib.pyplot as plt
 import math
+import numpy as np
 
 from serial_device2 import SerialDevice, SerialDevices, find_serial_device_ports, WriteFrequencyError
 
+from .transport import SerialTransport, TransportError
+from .data_writer import DataWriter
+from .data_log import state_to_code
+from .live_view import RingBuffer, LiveView
+from .timeline import Timeline, compile_phase, resume_command
+from .clock import Clock, VirtualClock
+from .clock_sync import ClockSync
+from .scheduler import FrameScheduler
+from .journal import RunJournal, JournalError, hash_config_file, get_journal_file_path
+from .metrics import Metrics, MetricsFileWriter
+from .tracing import Tracer, traced
+from .protocol import PROTOCOLS
+
 DEBUG = False
 BAUDRATE = 9600
 
@@ -24,10 +35,11 @@ BAUDRATE = 9600
 class SleepAssay(object):
     '''
     '''
-    def __init__(self,config_file_path,quick_test=False,no_hardware=False,*args,**kwargs):
+    def __init__(self,config_file_path,quick_test=False,no_hardware=False,notify=False,*args,**kwargs):
         self._TIMEOUT = 0.05
         self._WRITE_WRITE_DELAY = 0.05
-        self._RESET_DELAY = 2.0
+        self._READY_TIMEOUT = 10.0
+        self._READY_POLL_INTERVAL = 0.1
         self._RELAY_COUNT = 8
         self._CAMERA_TRIGGER_DUTY_CYCLE = 50
         self._BOARD_INDICATOR_LIGHT_FREQUENCY = 2
@@ -47,12 +59,27 @@ class SleepAssay(object):
         self._METHOD_ID_STOP_ALL_PULSES = 1
         self._METHOD_ID_GET_POWER = 2
         self._METHOD_ID_GET_PWM_STATUS = 3
+        self._METHOD_ID_GET_STATE = 4
+        self._METHOD_ID_SET_NOTIFY = 5
+        self._METHOD_ID_GET_PULSE_COUNTS = 7
+        self._METHOD_ID_SET_FRAME_RELAY = 8
+        self._METHOD_ID_SET_WAVEFORM = 10
 
         self._PWM_STOPPED = 0
         self._PWM_RUNNING = 1
+        self._PWM_LEVEL_COUNT_MAX = 3
+        self._NOTIFY_LEVEL_DISABLED = self._PWM_LEVEL_COUNT_MAX + 1
+        self._FRAME_RELAY_DISABLED = -1
+        self._WAVEFORM_POINTS_PER_REQUEST = 4
 
         self._POWER_MAX = 255
 
+        self._RING_BUFFER_SIZE = 100000
+        # frame deadlines that fall on a board event, but for float error
+        self._FRAME_TOLERANCE = 1e-6
+        self._JOURNAL_INTERVAL = 10.0
+        self._METRICS_INTERVAL = 10.0
+
         self._config_file_path = os.path.abspath(config_file_path)
         if 'debug' in kwargs:
             self.debug = kwargs['debug']
@@ -67,8 +94,12 @@ class SleepAssay(object):
             kwargs.update({'timeout': self._TIMEOUT})
         if 'write_write_delay' not in kwargs:
             kwargs.update({'write_write_delay': self._WRITE_WRITE_DELAY})
+        t_start = time.perf_counter()
         with open(config_file_path,'r') as config_stream:
-            self._config = yaml.load(config_stream)
+            self._config = yaml.safe_load(config_stream)
+        self._timeline_milliseconds_per_hour = int(round(self._MILLISECONDS_PER_HOUR))
+        self._timeline = Timeline(self._config,self._timeline_milliseconds_per_hour)
+        t_config = time.perf_counter()
         os_type = platform.system()
         if os_type == 'Linux':
             try:
@@ -85,32 +116,82 @@ class SleepAssay(object):
                 kwargs['port'] = self._config['relay_board_serial_port']['osx']
             except KeyError:
                 raise RuntimeError('Must specify osx serial port in config file!')
-        t_start = time.time()
+        speed = kwargs.pop('speed',None)
+        board_drift_ppm = kwargs.pop('board_drift_ppm',0)
+        trace = kwargs.pop('trace',False)
+        protocol = kwargs.pop('protocol',None) or self._config.get('protocol','binary')
+        if protocol not in PROTOCOLS:
+            raise RuntimeError('Unknown protocol {0}, must be one of {1}'.format(protocol,sorted(PROTOCOLS)))
+        ready_timeout = kwargs.pop('ready_timeout',self._READY_TIMEOUT)
         self._no_hardware = no_hardware
+        # a virtual board on a virtual clock can tell when its state
+        # changes next, so the frames in between need not be polled
+        self._fast_forward = no_hardware and (speed is None)
+        self._notify = notify
+        self._metrics = Metrics()
+        config = self._config.get('tracing',{})
+        self._tracer = Tracer(enabled=trace or config.get('enabled',False),
+                              max_events=config.get('max_events',Tracer.MAX_EVENTS))
         if not self._no_hardware:
+            self._clock = Clock()
             self._serial_device = SerialDevice(*args,**kwargs)
+            self._transport = SerialTransport(self._serial_device,
+                                              debug=self.debug,
+                                              write_write_delay=kwargs['write_write_delay'],
+                                              metrics=self._metrics,
+                                              tracer=self._tracer)
+        else:
+            # a virtual board on a virtual clock, so whole protocols run in
+            # seconds, only imported without hardware
+            from .virtual_board import VirtualRelayBoard, VirtualTransport
+            self._clock = VirtualClock(speed=speed)
+            self._transport = VirtualTransport(VirtualRelayBoard(self._clock,debug=self.debug,drift_ppm=board_drift_ppm),
+                                               debug=self.debug,
+                                               metrics=self._metrics,
+                                               tracer=self._tracer)
         atexit.register(self._exit_sleep_assay)
-        time.sleep(self._RESET_DELAY)
+        t_connect = time.perf_counter()
+        poll_count = self._wait_until_ready(ready_timeout)
+        # older firmware only speaks json and keeps it
+        self._protocol = self._transport.set_protocol_sync(PROTOCOLS[protocol])
+        t_ready = time.perf_counter()
+        self._clock_sync = ClockSync(**self._config.get('clock_sync',{}))
         self._csv_file_path = None
-        self._csv_file = None
-        self._csv_writer = None
+        self._data_writer = None
+        self._ring_buffer = RingBuffer(self._RING_BUFFER_SIZE)
+        self._live_view = None
         self._video_frame = -1
+        self._frame_offset = 0
+        self._journal = None
+        self._scheduler = None
+        # waveform level and points the board holds for each relay, or
+        # None for none, relays not in here could hold anything
+        self._waveforms = {}
         self._state = 'initialization'
-        self._header = ['video_frame',
-                        'date_time',
-                        'state',
-                        'white_light_power',
-                        'red_light_pwm_status',
-                        'red_light_power']
-        t_end = time.time()
-        self._debug_print('Initialization time =', (t_end - t_start))
+        self._metrics_server = None
+        self._metrics_file_writer = None
+        self._start_metrics()
+        t_end = time.perf_counter()
+        self._startup_times = {'config_s': t_config - t_start,
+                               'connect_s': t_connect - t_config,
+                               'ready_s': t_ready - t_connect,
+                               'ready_poll_count': poll_count,
+                               'total_s': t_end - t_start}
+        print('startup: config {0:.3f} s, connect {1:.3f} s, ready {2:.3f} s after {3} polls, total {4:.3f} s, {5} protocol'.format(self._startup_times['config_s'],
+                                                                                                                                self._startup_times['connect_s'],
+                                                                                                                                self._startup_times['ready_s'],
+                                                                                                                                poll_count,
+                                                                                                                                self._startup_times['total_s'],
+                                                                                                                                self.get_protocol()))
 
     def _debug_print(self, *args):
         if self.debug:
             print(*args)
 
     def _exit_sleep_assay(self):
-        self.stop()
+        # only a finished run or an explicit stop stops the board, so a
+        # run whose host dies keeps going and can be resumed
+        self._close()
 
     def _flatten(self,l):
         out = []
@@ -121,50 +202,149 @@ class SleepAssay(object):
                 out.append(item)
         return out
 
-    def _args_to_request(self,*args):
-        args = self._flatten(args)
-        request = ['[', ','.join(map(str,args)), ']']
-        request = ''.join(request)
-        request = request + '\n';
-        return request
-
     def _send_request(self,*args):
-
-        '''Sends request to device over serial port and
-        returns number of bytes written'''
-
-        request = self._args_to_request(*args)
-        self._debug_print('request', request)
-        bytes_written = 0
-        if not self._no_hardware:
-            bytes_written = self._serial_device.write_check_freq(request,
-                                                                 delay_write=True)
-        return bytes_written
+        '''
+        Sends request to device over serial port and waits until the
+        device acknowledges it
+        '''
+        args = self._flatten(args)
+        self._debug_print('request', args)
+        with self._tracer.span('send_request',method_id=args[0]):
+            self._transport.request_sync(*args)
 
     def _send_request_get_result(self,*args):
         '''
         Sends request to server over serial port and
         returns response result
         '''
-        request = self._args_to_request(*args)
-        self._debug_print('request', request)
-        successful = False
-        result = None
-        while (not successful) and (not self._no_hardware):
-            try:
-                response = self._serial_device.write_read(request,use_readline=True,check_write_freq=False)
-                self._debug_print('response', response)
-                result = json.loads(response)
-                successful = True
-            except:
-                print('Error!','\nrequest:',request)
-                time.sleep(0.5)
+        args = self._flatten(args)
+        self._debug_print('request', args)
+        with self._tracer.span('send_request_get_result',method_id=args[0]):
+            result = self._transport.request_sync(*args)
+        self._debug_print('result', result)
         return result
 
+    def _send_request_get_timed_result(self,*args):
+        '''
+        Sends request to server over serial port and returns response
+        result and the host monotonic times the request was sent and
+        the response received
+        '''
+        args = self._flatten(args)
+        self._debug_print('request', args)
+        with self._tracer.span('send_request_get_timed_result',method_id=args[0]):
+            result, time_sent, time_received = self._transport.request_timed_sync(*args)
+        self._debug_print('result', result)
+        return result, time_sent, time_received
+
+    def _wait_until_ready(self,timeout):
+        '''
+        Polls the board until it answers and returns the number of
+        polls. Opening the port resets the board, so requests are lost
+        until it has booted, which takes however long it takes instead
+        of a fixed delay.
+        '''
+        time_start = time.monotonic()
+        poll_count = 0
+        while True:
+            poll_count += 1
+            try:
+                self._transport.request_once_sync(self._METHOD_ID_GET_STATE,timeout=self._READY_POLL_INTERVAL)
+                return poll_count
+            except TransportError:
+                if time.monotonic() - time_start >= timeout:
+                    raise TransportError('Relay board not ready after {0} s'.format(timeout))
+
+    def get_protocol(self):
+        '''
+        Returns the name of the protocol the board was negotiated to
+        at connect, json or binary.
+        '''
+        for name, protocol in PROTOCOLS.items():
+            if protocol == self._protocol:
+                return name
+
+    def get_startup_times(self):
+        '''
+        Returns how long each step of initialization took in seconds.
+        '''
+        return dict(self._startup_times)
+
+    def _start_metrics(self):
+        config = self._config.get('metrics',{})
+        self._metrics_interval = config.get('interval_s',self._METRICS_INTERVAL)
+        self._metrics.add_gauge('queue_depth',lambda: self._data_writer.get_queue_depth() if self._data_writer else 0)
+        self._metrics.add_gauge('rows_written',lambda: self._data_writer.get_written_row_count() if self._data_writer else 0)
+        self._metrics.add_gauge('rows_dropped',lambda: self._data_writer.get_dropped_row_count() if self._data_writer else 0)
+        self._metrics.add_gauge('video_frame',lambda: self._video_frame)
+        self._metrics.add_gauge('missed_frames',self._get_missed_frame_count)
+        self._metrics.add_gauge('board_clock_drift_ppm',self._clock_sync.get_drift_ppm)
+        if config.get('http_port') is not None:
+            from .metrics import MetricsServer
+            self._metrics_server = MetricsServer(self._metrics,
+                                                 config['http_port'],
+                                                 host=config.get('http_host',MetricsServer.HOST))
+            host, port = self._metrics_server.get_address()
+            print('metrics: http://{0}:{1}/metrics'.format(host,port))
+
+    def _get_missed_frame_count(self):
+        if self._scheduler is None:
+            return 0
+        return sum(phase_statistics['missed_tick_count'] for phase_statistics in self._scheduler.get_statistics().values())
+
+    def get_metrics(self):
+        '''
+        Returns the metrics of requests, the data writer and the frame
+        loop.
+        '''
+        return self._metrics
+
+    def get_tracer(self):
+        '''
+        Returns the tracer of requests, the data writer and the frame
+        loop, disabled unless trace or tracing: enabled is set.
+        '''
+        return self._tracer
+
+    def write_trace(self,trace_file_path=None):
+        '''
+        Writes the traced spans as a Chrome trace event file, next to
+        the data files by default, and returns its path.
+        '''
+        if trace_file_path is None:
+            trace_file_path = self._data_writer.get_index_file_path().replace('-data-index.json','-trace.json')
+        self._tracer.write(trace_file_path)
+        return trace_file_path
+
+    def _start_metrics_file(self):
+        if self._metrics_file_writer is None:
+            metrics_file_path = self._data_writer.get_index_file_path().replace('-data-index.json','-metrics.json')
+            self._metrics_file_writer = MetricsFileWriter(self._metrics,metrics_file_path,interval=self._metrics_interval)
+
+    def _stop_metrics_file(self):
+        '''
+        Writes the metrics file a last time and returns its path.
+        '''
+        metrics_file_path = self._metrics_file_writer.get_metrics_file_path()
+        self._metrics_file_writer.close()
+        self._metrics_file_writer = None
+        return metrics_file_path
+
     def _close(self):
         '''
         Close the device serial port.
         '''
+        # nothing left to stop at exit once the port is closed
+        atexit.unregister(self._exit_sleep_assay)
+        if self._journal is not None:
+            # the last update of a run that did not finish, for --resume
+            self._journal.close()
+        if self._metrics_file_writer is not None:
+            self._metrics_file_writer.close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        self._transport.close()
         if not self._no_hardware:
             self._serial_device.close()
 
@@ -204,6 +384,40 @@ class SleepAssay(object):
                            pwm_level_count,
                            *pwm_info)
 
+    def _set_waveform(self,relay,level,points,offset=0):
+        '''
+        Loads a piecewise-linear power table the board plays back over
+        every on period of pwm level on relay. points are (time, power)
+        with time in milliseconds from the start of the on period, no
+        points clears the table. offset starts the next on period that
+        far into the table. The table goes in chunks small enough for a
+        binary frame, pipelined as one batch.
+        '''
+        points = [(int(time),int(power)) for time, power in points]
+        requests = []
+        for first_point in range(0,max(len(points),1),self._WAVEFORM_POINTS_PER_REQUEST):
+            requests.append(self._flatten([self._METHOD_ID_SET_WAVEFORM,
+                                           relay,
+                                           level,
+                                           int(offset),
+                                           len(points),
+                                           first_point,
+                                           points[first_point:first_point + self._WAVEFORM_POINTS_PER_REQUEST]]))
+        self._debug_print('requests', requests)
+        # a batch that fails part way leaves the board holding anything
+        self._waveforms.pop(relay,None)
+        with self._tracer.span('send_requests',method_id=self._METHOD_ID_SET_WAVEFORM):
+            self._transport.requests_sync(requests)
+        self._waveforms[relay] = (level,tuple(points)) if points else None
+
+    def _set_waveform_offset(self,relay,offset):
+        '''
+        Starts the next on period of relay offset milliseconds into the
+        waveform the board already holds.
+        '''
+        level, points = self._waveforms[relay]
+        self._send_request(self._METHOD_ID_SET_WAVEFORM,relay,level,int(offset),len(points),len(points))
+
     def _stop_all_pulses(self):
         '''
         '''
@@ -221,6 +435,91 @@ class SleepAssay(object):
         result = self._send_request_get_result(self._METHOD_ID_GET_PWM_STATUS)
         return result
 
+    def _get_state(self):
+        '''
+        Returns board time in milliseconds, power, pwm status and
+        pulse count of every relay from a single request. Every call is
+        also a clock sync exchange. pulse_counts is None with firmware
+        that does not count pulses.
+        '''
+        result, time_sent, time_received = self._send_request_get_timed_result(self._METHOD_ID_GET_STATE)
+        board_time, power, pwm_status = result[0:3]
+        pulse_counts = None
+        if len(result) > 3:
+            pulse_counts = result[3]
+        self._clock_sync.add_exchange(time_sent,board_time,time_received)
+        return board_time, power, pwm_status, pulse_counts
+
+    def _get_pulse_counts(self):
+        '''
+        Returns board time in milliseconds and the number of times
+        each relay was switched on since all pulses were last stopped.
+        '''
+        board_time, pulse_counts = self._send_request_get_result(self._METHOD_ID_GET_PULSE_COUNTS)
+        return board_time, pulse_counts
+
+    def get_video_frame_count(self):
+        '''
+        Returns the number of frames the board triggered the camera for
+        since the run started.
+        '''
+        board_time, pulse_counts = self._get_pulse_counts()
+        return pulse_counts[self._config['relays']['camera_trigger']]
+
+    def _set_frame_relay(self,relay):
+        '''
+        Board stamps every notification with the pulse count of relay.
+        relay = _FRAME_RELAY_DISABLED turns frame stamps off.
+        '''
+        self._send_request(self._METHOD_ID_SET_FRAME_RELAY,relay)
+
+    def _set_notify_level(self,relay,level):
+        '''
+        Board sends a notification line whenever a pwm level >= level
+        changes status on relay. level = _NOTIFY_LEVEL_DISABLED turns
+        notifications off for relay.
+        '''
+        self._send_request(self._METHOD_ID_SET_NOTIFY,relay,level)
+
+    def _read_notification(self):
+        '''
+        Returns next notification sent by the board or None if none
+        arrived within a frame period, or on a virtual clock before the
+        phase ends or the clock sync is due.
+        '''
+        if self._fast_forward:
+            time_next = min(self._phase_end_monotonic,self._clock_sync.get_due_time())
+            timeout = max(0,time_next - self._clock.monotonic())
+        else:
+            # nothing else needs the loop more often than once a frame
+            timeout = self.get_frame_period()
+        notification = self._transport.get_notification(timeout)
+        self._debug_print('notification', notification)
+        return notification
+
+    def start_notifications(self):
+        '''
+        Lets the board push state changes instead of polling it every
+        frame. Must be called while all pulses are stopped.
+        '''
+        self._notify_power = [0]*self._RELAY_COUNT
+        self._notify_pwm_status = [[self._PWM_STOPPED]*(self._PWM_LEVEL_COUNT_MAX + 1) for relay in range(self._RELAY_COUNT)]
+        self._notify_seq = None
+        self._board_time = None
+        self._board_time_host_time = None
+        self._camera_trigger_board_start_time = None
+        # pwm0 of the camera trigger and red light change state too
+        # fast to notify on every transition
+        self._set_notify_level(self._config['relays']['camera_trigger'],1)
+        self._set_notify_level(self._config['relays']['white_light'],0)
+        self._set_notify_level(self._config['relays']['red_light'],1)
+        self._set_frame_relay(self._config['relays']['camera_trigger'])
+
+    def stop_notifications(self):
+        for relay in range(self._RELAY_COUNT):
+            self._set_notify_level(relay,self._NOTIFY_LEVEL_DISABLED)
+        self._set_frame_relay(self._FRAME_RELAY_DISABLED)
+
     def _print_datetime(self,dt):
         print('    {0}-{1}-{2}-{3}-{4}-{5}'.format(dt.year,
                                                    dt.month,
@@ -230,7 +529,7 @@ class SleepAssay(object):
                                                    dt.second))
 
     def _start_to_start_datetime(self,start):
-        now_datetime = datetime.datetime.now()
+        now_datetime = self._clock.now()
         offset = datetime.timedelta(start['offset_days'])
         offset_datetime = now_datetime + offset
         start_datetime = datetime.datetime(offset_datetime.year,
@@ -245,20 +544,14 @@ class SleepAssay(object):
         return start_datetime
 
     def _start_datetime_to_delay(self,start_datetime):
-        now_datetime = datetime.datetime.now()
+        now_datetime = self._clock.now()
         delta = start_datetime - now_datetime
-        delay = int(1000*delta.total_seconds())
+        # counted by the board crystal, which runs a little fast or slow
+        delay = int(self._clock_sync.host_to_board_duration(1000*delta.total_seconds()))
         if delay < 0:
             delay = 0
         return delay
 
-    def _writerow(self,columns):
-        if self._csv_writer is not None:
-            utf8row = []
-            for col in columns:
-                utf8row.append(str(col).encode('utf8'))
-            self._csv_writer.writerow(utf8row)
-
     def _get_date_str(self):
         today = datetime.date.today()
         date_str = "{year}-{month}-{day}".format(year=today.year,
@@ -274,10 +567,16 @@ class SleepAssay(object):
         return time_str
 
     def _get_date_time_str(self):
-        date_str = self._get_date_str()
-        time_str = self._get_time_str()
-        return date_str + '-' + time_str
-
+        # one clock read, so the date and time never straddle midnight
+        now = self._clock.now()
+        return "{0}-{1}-{2}-{3}-{4}-{5}".format(now.year,
+                                                now.month,
+                                                now.day,
+                                                now.hour,
+                                                now.minute,
+                                                now.second)
+
+    @traced('start_board_indicator_light_cycle')
     def start_board_indicator_light_cycle(self,relay):
         period = 1000/self._BOARD_INDICATOR_LIGHT_FREQUENCY
         on_duration = (self._BOARD_INDICATOR_LIGHT_DUTY_CYCLE/100)*period
@@ -289,6 +588,7 @@ class SleepAssay(object):
                         [period],
                         [on_duration])
 
+    @traced('start_camera_trigger')
     def start_camera_trigger(self,
                              relay,
                              frame_rate,
@@ -306,259 +606,420 @@ class SleepAssay(object):
                         [period],
                         [on_duration])
 
-    def start_data_writer(self):
-        if self._csv_writer is None:
-            user_home_dir = os.path.expanduser('~')
-            date_str = self._get_date_str()
-            output_dir = os.path.join(user_home_dir,'sleep_assay_data',date_str)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            date_time_str = self._get_date_time_str()
-            self._csv_file_path = os.path.join(output_dir,date_time_str + '-data.txt')
-
-            self._csv_file = open(self._csv_file_path, 'w')
-
-            # Create a new csv writer object to use as the output formatter
-            self._csv_writer = csv.writer(self._csv_file,quotechar='\"',quoting=csv.QUOTE_MINIMAL)
-            self._writerow(self._header)
+    def start_data_writer(self,name=None,index_file_path=None):
+        '''
+        Starts writing data files, or with index_file_path adds new
+        segments to the data files of an interrupted run.
+        '''
+        if self._data_writer is None:
+            config = self._config.get('data_writer',{})
+            kwargs = {}
+            if index_file_path is None:
+                data_dir = os.path.expanduser(config.get('output_dir',os.path.join('~','sleep_assay_data')))
+                date_str = self._get_date_str()
+                output_dir = os.path.join(data_dir,date_str)
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
+                date_time_str = self._get_date_time_str()
+                if name is not None:
+                    date_time_str += '-' + name
+            else:
+                output_dir = os.path.dirname(index_file_path)
+                date_time_str = os.path.basename(index_file_path).replace('-data-index.json','')
+                kwargs['resume'] = True
+
+            if config.get('rotate') == 'daily':
+                kwargs['rotate_daily'] = True
+            if 'rotate_megabytes' in config:
+                kwargs['rotate_bytes'] = int(config['rotate_megabytes']*1e6)
+            if 'flush_interval_s' in config:
+                kwargs['flush_interval'] = config['flush_interval_s']
+            if 'fsync_interval_s' in config:
+                kwargs['fsync_interval'] = config['fsync_interval_s']
+            if 'queue_size' in config:
+                kwargs['queue_size'] = config['queue_size']
+            if 'close_timeout_s' in config:
+                kwargs['close_timeout'] = config['close_timeout_s']
+            self._data_writer = DataWriter(output_dir,date_time_str,metrics=self._metrics,tracer=self._tracer,**kwargs)
+            self._csv_file_path = self._data_writer.get_csv_file_path()
+            self._start_metrics_file()
             return self._csv_file_path
 
     def stop(self):
+        '''
+        Stops every relay on the board. Exiting without calling stop
+        or finishing the run leaves the board running.
+        '''
         self._stop_all_pulses()
 
-    def _duration_days_to_duration_datetime(self,duration_days):
-        duration_datetime = datetime.timedelta(duration_days/(1000/self._MILLISECONDS_PER_SECOND))
-        return duration_datetime
+    @traced('start_phase')
+    def _start_phase(self,phase,start_datetime):
+        '''
+        Starts every pwm command of a compiled phase relative to
+        start_datetime and returns the datetime the phase ends.
+        '''
+        self._journal_phase(phase,start_datetime)
+        issued_command_count = 0
+        try:
+            for command in phase.commands:
+                self._start_command(command,start_datetime)
+                issued_command_count += 1
+        finally:
+            # once per phase, or up to the command that failed
+            self._update_journal(issued_command_count=issued_command_count)
+        end_datetime = start_datetime + datetime.timedelta(milliseconds=phase.duration)
+        print('  end:')
+        self._print_datetime(end_datetime)
+        return end_datetime
 
-    def start_entrainment(self,start_datetime,config):
-        print('entrainment:')
-        print('  start:')
-        self._print_datetime(start_datetime)
-        duration_days = config['duration_days']
-
-        if duration_days <= 0:
-            end_datetime = start_datetime
-            print('  end:')
-            self._print_datetime(end_datetime)
-            return end_datetime
-
-        relay = self._config['relays']['white_light']
-        power = config['white_light']['power']
-        pwm0_on_duration_hours = config['white_light']['pwm0_on_duration_hours']
-        pwm0_off_duration_hours = config['white_light']['pwm0_off_duration_hours']
-        pwm0_period_hours = pwm0_on_duration_hours + pwm0_off_duration_hours
-        pwm0_period = pwm0_period_hours*self._MILLISECONDS_PER_HOUR
-        pwm0_on_duration = pwm0_on_duration_hours*self._MILLISECONDS_PER_HOUR
-        pwm0_period_days = pwm0_period_hours/self._HOURS_PER_DAY
-        count = duration_days/pwm0_period_days
-        delay = self._start_datetime_to_delay(start_datetime)
-        self._start_pwm(relay,
-                        power,
+    def _load_waveform(self,relay,command):
+        '''
+        Makes sure the board holds the waveform of command, or none, for
+        relay before command starts, only sending what changed.
+        '''
+        waveform = None
+        if command.waveform is not None:
+            waveform = (command.waveform_level,tuple(command.waveform))
+        if (relay not in self._waveforms) or (self._waveforms[relay] != waveform):
+            if waveform is None:
+                self._set_waveform(relay,0,())
+            else:
+                self._set_waveform(relay,waveform[0],waveform[1],command.waveform_offset)
+        elif (waveform is not None) and command.waveform_offset:
+            self._set_waveform_offset(relay,command.waveform_offset)
+
+    def _command_to_board_clock(self,command):
+        '''
+        Returns command with its periods, on durations and waveform
+        times counted on the board clock, so its cycles stay on host
+        time for as long as it runs, like its start does.
+        '''
+        def to_board(duration):
+            return int(round(self._clock_sync.host_to_board_duration(duration)))
+        waveform = command.waveform
+        if waveform is not None:
+            waveform = tuple((to_board(time),power) for time, power in waveform)
+        return command._replace(periods=tuple(to_board(period) for period in command.periods),
+                                on_durations=tuple(to_board(on_duration) for on_duration in command.on_durations),
+                                waveform=waveform,
+                                waveform_offset=to_board(command.waveform_offset))
+
+    def _start_command(self,command,start_datetime):
+        command_start_datetime = start_datetime + datetime.timedelta(milliseconds=command.delay)
+        delay = self._start_datetime_to_delay(command_start_datetime)
+        command = self._command_to_board_clock(command)
+        self._load_waveform(self._config['relays'][command.relay_name],command)
+        self._start_pwm(self._config['relays'][command.relay_name],
+                        command.power,
                         delay,
-                        count,
-                        1,
-                        [pwm0_period],
-                        [pwm0_on_duration])
-        duration_datetime = self._duration_days_to_duration_datetime(duration_days)
-        end_datetime = start_datetime + duration_datetime
+                        command.count,
+                        len(command.periods),
+                        list(command.periods),
+                        list(command.on_durations))
+
+    @traced('resume_phase')
+    def _resume_phase(self,phase,start_datetime,issued_command_count):
+        '''
+        Starts what is left of the commands of a phase that is already
+        under way, leaving out the first issued_command_count commands
+        the board still has, and returns the datetime the phase ends.
+        '''
+        now_datetime = self._clock.now()
+        elapsed = int(round(1000*(now_datetime - start_datetime).total_seconds()))
+        self._journal_phase(phase,start_datetime,issued_command_count)
+        try:
+            for command in phase.commands[issued_command_count:]:
+                for resumed_command in resume_command(command,elapsed):
+                    self._start_command(resumed_command,now_datetime)
+                issued_command_count += 1
+        finally:
+            self._update_journal(issued_command_count=issued_command_count)
+        end_datetime = start_datetime + datetime.timedelta(milliseconds=phase.duration)
         print('  end:')
         self._print_datetime(end_datetime)
         return end_datetime
 
+    @traced('update_journal')
+    def _update_journal(self,**fields):
+        if self._journal is not None:
+            self._journal.update(**fields)
+
+    def _journal_phase(self,phase,start_datetime,issued_command_count=0):
+        if self._journal is None:
+            return
+        phases = list(self._journal.get('phases',[]))
+        start_epoch = start_datetime.timestamp()
+        if (not phases) or (phases[-1]['name'] != phase.name):
+            phases.append({'name': phase.name,
+                           'start_epoch': start_epoch,
+                           'command_count': len(phase.commands)})
+        self._journal.update(phases=phases,
+                             phase=phase.name,
+                             phase_start_epoch=start_epoch,
+                             issued_command_count=issued_command_count)
+
+    @traced('start_entrainment')
+    def start_entrainment(self,start_datetime,config):
+        print('entrainment:')
+        print('  start:')
+        self._print_datetime(start_datetime)
+        phase = compile_phase('entrainment',config,milliseconds_per_hour=self._timeline_milliseconds_per_hour)
+        return self._start_phase(phase,start_datetime)
+
+    @traced('start_experiment_run')
     def start_experiment_run(self,run,start_datetime,config):
         print('experiment run {0}:'.format(run))
         print('  start:')
         self._print_datetime(start_datetime)
-        duration_days = config['duration_days']
-
-        if duration_days <= 0:
-            end_datetime = start_datetime
-            print('  end:')
-            self._print_datetime(end_datetime)
-            return end_datetime
-
-        # white light
-        if 'white_light' in config:
-            relay = self._config['relays']['white_light']
-            power = config['white_light']['power']
-            pwm0_on_duration_hours = config['white_light']['pwm0_on_duration_hours']
-            pwm0_off_duration_hours = config['white_light']['pwm0_off_duration_hours']
-            pwm0_period = (pwm0_on_duration_hours + pwm0_off_duration_hours)*self._MILLISECONDS_PER_HOUR
-            pwm0_on_duration = pwm0_on_duration_hours*self._MILLISECONDS_PER_HOUR
-            delay_days = 0
-            if 'delay_days' in config['white_light']:
-                delay_days = config['white_light']['delay_days']
-            duration_datetime = self._duration_days_to_duration_datetime(delay_days)
-            white_start_datetime = start_datetime + duration_datetime
-            delay = self._start_datetime_to_delay(white_start_datetime)
-            if ('pwm1_on_duration_days' in config['white_light']) and ('pwm1_off_duration_days' in config['white_light']):
-                pwm1_on_duration_days = config['white_light']['pwm1_on_duration_days']
-                pwm1_off_duration_days = config['white_light']['pwm1_off_duration_days']
-                pwm1_period_days = pwm1_on_duration_days + pwm1_off_duration_days
-                pwm1_period = pwm1_period_days*self._MILLISECONDS_PER_DAY
-                pwm1_on_duration = pwm1_on_duration_days*self._MILLISECONDS_PER_DAY
-                count = math.ceil((duration_days - delay_days)/pwm1_period_days)
-                self._start_pwm(relay,
-                                power,
-                                delay,
-                                count,
-                                2,
-                                [pwm0_period,pwm1_period],
-                                [pwm0_on_duration,pwm1_on_duration])
-            else:
-                pwm0_period_days = (pwm0_on_duration_hours + pwm0_off_duration_hours)/self._HOURS_PER_DAY
-                count = math.ceil((duration_days - delay_days)/pwm0_period_days)
-                self._start_pwm(relay,
-                                power,
-                                delay,
-                                count,
-                                1,
-                                [pwm0_period],
-                                [pwm0_on_duration])
-
-        # red light
-        if 'red_light' in config:
-            relay = self._config['relays']['red_light']
-            power = config['red_light']['power']
-            pwm0_frequency = config['red_light']['pwm0_frequency_hz']
-            pwm0_duty_cycle = config['red_light']['pwm0_duty_cycle_percent']
-            pwm0_period = 1000/pwm0_frequency
-            pwm0_on_duration = (pwm0_duty_cycle/100)*pwm0_period
-            pwm1_on_duration_hours = config['red_light']['pwm1_on_duration_hours']
-            pwm1_off_duration_hours = config['red_light']['pwm1_off_duration_hours']
-            pwm1_period_hours = pwm1_on_duration_hours + pwm1_off_duration_hours
-            pwm1_period = pwm1_period_hours*self._MILLISECONDS_PER_HOUR
-            pwm1_on_duration = pwm1_on_duration_hours*self._MILLISECONDS_PER_HOUR
-            pwm1_period_days = pwm1_period_hours/self._HOURS_PER_DAY
-            delay_days = 0
-            if 'delay_days' in config['red_light']:
-                delay_days = config['red_light']['delay_days']
-            count = math.ceil((duration_days - delay_days)/pwm1_period_days)
-            duration_datetime = self._duration_days_to_duration_datetime(delay_days)
-            red_start_datetime = start_datetime + duration_datetime
-            delay = self._start_datetime_to_delay(red_start_datetime)
-            self._start_pwm(relay,
-                            power,
-                            delay,
-                            count,
-                            2,
-                            [pwm0_period,pwm1_period],
-                            [pwm0_on_duration,pwm1_on_duration])
-
-        duration_datetime = self._duration_days_to_duration_datetime(duration_days)
-        end_datetime = start_datetime + duration_datetime
-        print('  end:')
-        self._print_datetime(end_datetime)
-        return end_datetime
+        phase = compile_phase('experiment_run{0}'.format(run),config,milliseconds_per_hour=self._timeline_milliseconds_per_hour)
+        return self._start_phase(phase,start_datetime)
 
+    @traced('start_recovery')
     def start_recovery(self,start_datetime,config):
         print('recovery:')
         print('  start:')
         self._print_datetime(start_datetime)
-        duration_days = config['duration_days']
-
-        if duration_days <= 0:
-            end_datetime = start_datetime
-            print('  end:')
-            self._print_datetime(end_datetime)
-            return end_datetime
-
-        relay = self._config['relays']['white_light']
-        power = config['white_light']['power']
-        pwm0_on_duration_hours = config['white_light']['pwm0_on_duration_hours']
-        pwm0_off_duration_hours = config['white_light']['pwm0_off_duration_hours']
-        pwm0_period_hours = pwm0_on_duration_hours + pwm0_off_duration_hours
-        pwm0_period = pwm0_period_hours*self._MILLISECONDS_PER_HOUR
-        pwm0_on_duration = pwm0_on_duration_hours*self._MILLISECONDS_PER_HOUR
-        pwm0_period_days = pwm0_period_hours/self._HOURS_PER_DAY
-        count = duration_days/pwm0_period_days
-        delay = self._start_datetime_to_delay(start_datetime)
-        self._start_pwm(relay,
-                        power,
-                        delay,
-                        count,
-                        1,
-                        [pwm0_period],
-                        [pwm0_on_duration])
-        duration_datetime = self._duration_days_to_duration_datetime(duration_days)
-        end_datetime = start_datetime + duration_datetime
-        print('  end:')
-        self._print_datetime(end_datetime)
-        return end_datetime
-
-    def _write_data(self):
-        if self._no_hardware:
-            time.sleep(1/self._config['camera_trigger']['frame_rate_hz'])
+        phase = compile_phase('recovery',config,milliseconds_per_hour=self._timeline_milliseconds_per_hour)
+        return self._start_phase(phase,start_datetime)
+
+    def get_timeline(self):
+        return self._timeline
+
+    @traced('write_state')
+    def _write_state(self,power,pwm_status,board_time=None):
+        white_light_pwm_status = pwm_status[self._config['relays']['white_light']][0:3]
+        white_light_power = power[self._config['relays']['white_light']]
+        red_light_pwm_status = pwm_status[self._config['relays']['red_light']][1]
+        red_light_power = power[self._config['relays']['red_light']]
+        monotonic, epoch = self._clock.stamp()
+        if (board_time is not None) and self._clock_sync.is_ready():
+            # when the board changed state, not when the host heard of it
+            board_monotonic = self._clock_sync.board_to_host(board_time)
+            epoch += board_monotonic - monotonic
+            monotonic = board_monotonic
+        self._ring_buffer.append((self._video_frame,
+                                  epoch,
+                                  monotonic,
+                                  state_to_code(self._state),
+                                  white_light_power,
+                                  red_light_pwm_status,
+                                  red_light_power))
+        if ((self._white_light_power_prev != white_light_power) or
+            (self._red_light_pwm_status_prev != red_light_pwm_status) or
+            (self._red_light_power_prev != red_light_power) or
+            (self._state_prev != self._state)):
+            # if ((not self._prev_written) and
+            #     (self._white_light_power_prev is not None) and
+            #     (self._red_light_pwm_status_prev is not None) and
+            #     (self._red_light_power_prev is not None) and
+            #     (self._epoch_prev is not None)):
+            #     row = []
+            #     row.append(self._video_frame - 1)
+            #     row.append(self._epoch_prev)
+            #     row.append(self._state_prev)
+            #     row.append(self._white_light_power_prev)
+            #     row.append(self._red_light_pwm_status_prev)
+            #     row.append(self._red_light_power_prev)
+            #     self._writerow(row)
+            if self._data_writer is not None:
+                self._data_writer.write(self._video_frame,
+                                        epoch,
+                                        monotonic,
+                                        self._state,
+                                        white_light_power,
+                                        red_light_pwm_status,
+                                        red_light_power)
+            self._prev_written = True
+        else:
+            self._prev_written = False
+        self._white_light_power_prev = white_light_power
+        self._red_light_pwm_status_prev = red_light_pwm_status
+        self._red_light_power_prev = red_light_power
+        self._state_prev = self._state
+        self._epoch_prev = epoch
+
+    @traced('update_data')
+    def _update_data(self,tick_count=1):
+        '''
+        Writes the current state to the data file if it changed
+        without waiting for the next frame. tick_count is the number of
+        frame periods since the last update.
+        '''
+        if self._notify:
+            if self._clock_sync.is_due(self._clock.monotonic()):
+                # nothing polls the board, so ask it for the time now and then
+                self._get_state()
+            while self._write_notified_data():
+                pass
             return
-        time_start = time.time()
-        pwm_status = self._get_pwm_status()
+        board_time, power, pwm_status, pulse_counts = self._get_state()
         camera_trigger_on = pwm_status[self._config['relays']['camera_trigger']][1]
+        self._camera_trigger_on = camera_trigger_on
         if camera_trigger_on:
-            power = self._get_power()
-            white_light_pwm_status = pwm_status[self._config['relays']['white_light']][0:3]
-            white_light_power = power[self._config['relays']['white_light']]
-            red_light_pwm_status = pwm_status[self._config['relays']['red_light']][1]
-            red_light_power = power[self._config['relays']['red_light']]
-            self._video_frame += 1
-            date_time = self._get_date_time_str()
-            if ((self._white_light_power_prev != white_light_power) or
-                (self._red_light_pwm_status_prev != red_light_pwm_status) or
-                (self._red_light_power_prev != red_light_power) or
-                (self._state_prev != self._state)):
-                # if ((not self._prev_written) and
-                #     (self._white_light_power_prev is not None) and
-                #     (self._red_light_pwm_status_prev is not None) and
-                #     (self._red_light_power_prev is not None) and
-                #     (self._date_time_prev is not None)):
-                #     row = []
-                #     row.append(self._video_frame - 1)
-                #     row.append(self._date_time_prev)
-                #     row.append(self._state_prev)
-                #     row.append(self._white_light_power_prev)
-                #     row.append(self._red_light_pwm_status_prev)
-                #     row.append(self._red_light_power_prev)
-                #     self._writerow(row)
-                row = []
-                row.append(self._video_frame)
-                row.append(date_time)
-                row.append(self._state)
-                row.append(white_light_power)
-                row.append(red_light_pwm_status)
-                row.append(red_light_power)
-                self._writerow(row)
-                self._prev_written = True
+            if pulse_counts is not None:
+                # frames the board triggered, however late this poll is
+                self._video_frame = self._frame_offset + pulse_counts[self._config['relays']['camera_trigger']] - 1
+            else:
+                self._video_frame += tick_count
+            self._write_state(power,pwm_status)
+
+    @traced('wait_for_next_frame')
+    def _wait_for_next_frame(self):
+        if self._notify:
+            # reading notifications already blocks until one arrives
+            if self._live_view is not None:
+                self._live_view.update()
+            return
+        if self._fast_forward:
+            self._skip_unchanged_frames()
+        if self._live_view is not None:
+            # the live view redraws on the wall clock, not the run clock
+            self._live_view.update(time.time() + self.get_time_until_next_frame())
+        self._clock.sleep(self.get_time_until_next_frame())
+
+    def _skip_unchanged_frames(self):
+        '''
+        Skips the frames before the next board event that could change
+        what is logged, the end of the phase or the next clock sync
+        exchange, since polling the virtual board on them would not add
+        a row.
+        '''
+        relays = self._config['relays']
+        relay_levels = [None]*self._RELAY_COUNT
+        relay_levels[relays['white_light']] = 0
+        relay_levels[relays['red_light']] = 0
+        if not self._camera_trigger_on:
+            relay_levels[relays['camera_trigger']] = 1
+        time_next = min(self._phase_end_monotonic,self._clock_sync.get_due_time())
+        event_time = self._transport.get_next_event_time(relay_levels)
+        if event_time is not None:
+            time_next = min(time_next,event_time)
+        frame_count = int(math.ceil((time_next - self._scheduler.get_deadline())/self._scheduler.get_period() - self._FRAME_TOLERANCE))
+        if frame_count > 0:
+            self._scheduler.skip(frame_count)
+
+    def get_time_until_next_frame(self):
+        if self._notify:
+            return 0
+        return self._scheduler.get_time_until_deadline()
+
+    def get_timing_statistics(self):
+        '''
+        Returns tick counts, missed ticks and frame start jitter of
+        each phase of the current or last run.
+        '''
+        return self._scheduler.get_statistics()
+
+    def _write_timing_report(self):
+        statistics = self.get_timing_statistics()
+        clock_sync_statistics = self._clock_sync.get_statistics()
+        timing_file_path = self._data_writer.get_index_file_path().replace('-data-index.json','-timing.json')
+        with open(timing_file_path,'w') as timing_file:
+            json.dump({'frame_period': self._scheduler.get_period(),
+                       'policy': self._scheduler.get_policy(),
+                       'phases': statistics,
+                       'clock_sync': clock_sync_statistics,
+                       'startup': self._startup_times,
+                       'protocol': self.get_protocol()},timing_file,indent=1,sort_keys=True)
+        if clock_sync_statistics['offset_s'] is not None:
+            print('board clock drift {0:.1f} ppm, fit residual {1:.3f} ms from {2} exchanges'.format(clock_sync_statistics['drift_ppm'],
+                                                                                                   clock_sync_statistics['residual_ms'],
+                                                                                                   clock_sync_statistics['exchange_count']))
+        print('frame timing:')
+        for phase in self._timeline.get_phases():
+            if phase.name not in statistics:
+                continue
+            phase_statistics = statistics[phase.name]
+            print('  {0}: {1} frames, {2} missed, jitter mean {3:.3f} ms, max {4:.3f} ms'.format(phase.name,
+                                                                                              phase_statistics['tick_count'],
+                                                                                              phase_statistics['missed_tick_count'],
+                                                                                              phase_statistics['jitter_mean_ms'],
+                                                                                              phase_statistics['jitter_max_ms']))
+        print('timing_file_path:')
+        print(timing_file_path)
+
+    def get_clock_sync(self):
+        return self._clock_sync
+
+    def get_frame_period(self):
+        return 1/self._config['camera_trigger']['frame_rate_hz']
+
+    def get_recent_samples(self,n=None):
+        '''
+        Returns the last n logged frames, oldest first, as a
+        structured array with the binary data file fields.
+        '''
+        return self._ring_buffer.get_last(n)
+
+    def start_live_view(self,redraw_interval=LiveView.REDRAW_INTERVAL):
+        '''
+        Shows the most recent samples while run() is in progress.
+        '''
+        if self._live_view is None:
+            scale_factor = 1000/(self._config['camera_trigger']['frame_rate_hz']*self._MILLISECONDS_PER_DAY)
+            self._live_view = LiveView(self._ring_buffer,scale_factor,redraw_interval=redraw_interval)
+
+    @traced('write_notified_data')
+    def _write_notified_data(self):
+        '''
+        Blocks for at most a frame period waiting for a
+        notification, so the loop only does work when the board
+        reports a transition or the state changes on the host.
+        '''
+        notification = self._read_notification()
+        notified = notification is not None
+        if notified:
+            seq = notification['seq']
+            if (self._notify_seq is not None) and (seq != (self._notify_seq + 1)):
+                print('Error!','\nnotifications dropped:',seq - self._notify_seq - 1)
+            self._notify_seq = seq
+            relay = notification['relay']
+            level = notification['level']
+            self._notify_pwm_status[relay][level] = notification['pwm_status']
+            self._notify_power[relay] = notification['power']
+            self._board_time = notification['time']
+            self._board_time_host_time = self._clock.time()
+            if ((relay == self._config['relays']['camera_trigger']) and
+                (notification['pwm_status'] == self._PWM_RUNNING) and
+                (self._camera_trigger_board_start_time is None)):
+                self._camera_trigger_board_start_time = self._board_time
+        elif (self._state_prev == self._state) or (self._board_time is None):
+            return notified
+        else:
+            # state changed on the host without a board transition
+            self._board_time += int(1000*(self._clock.time() - self._board_time_host_time))
+            self._board_time_host_time = self._clock.time()
+        camera_trigger_on = self._notify_pwm_status[self._config['relays']['camera_trigger']][1]
+        if camera_trigger_on and (self._camera_trigger_board_start_time is not None):
+            if notified and ('frame' in notification):
+                # stamped by the board with the frames triggered so far
+                self._video_frame = self._frame_offset + notification['frame'] - 1
             else:
-                self._prev_written = False
-            self._white_light_power_prev = white_light_power
-            self._red_light_pwm_status_prev = red_light_pwm_status
-            self._red_light_power_prev = red_light_power
-            self._state_prev = self._state
-            self._date_time_prev = date_time
-
-        time_stop = time.time()
-        time_sleep = 1/self._config['camera_trigger']['frame_rate_hz'] - (time_stop - time_start)
-        if time_sleep > 0:
-            time.sleep(time_sleep)
+                frame_period = 1000/self._config['camera_trigger']['frame_rate_hz']
+                self._video_frame = self._frame_offset + int((self._board_time - self._camera_trigger_board_start_time)//frame_period)
+            if notified:
+                self._write_state(self._notify_power,self._notify_pwm_status,self._board_time)
+            else:
+                self._write_state(self._notify_power,self._notify_pwm_status)
+        return notified
 
     def plot_data(self,data_file_path):
-        if self._no_hardware:
-            return
+        # matplotlib is only imported to plot, since it takes longer to
+        # import than everything else a run needs
+        import matplotlib.pyplot as plt
+        from .data_loader import load_decimated
         print('data_file_path: {0}'.format(data_file_path))
         fig = plt.figure()
         filename = os.path.split(data_file_path)[1]
         fig.suptitle(filename, fontsize=14, fontweight='bold')
         self._data_file_path = os.path.abspath(data_file_path)
-        with open(self._data_file_path,'r') as fid:
-            header = fid.readline().rstrip().split(',')
-
-        dt = np.dtype({'names':header,'formats':['S25']*len(header)})
-        self._numpy_data = np.loadtxt(self._data_file_path,dtype=dt,delimiter=",",skiprows=1)
+        decimated = load_decimated(self._data_file_path,['white_light_power','red_light_pwm_status'])
 
         scale_factor = 1000/(self._config['camera_trigger']['frame_rate_hz']*self._MILLISECONDS_PER_DAY)
-        t = np.uint32(self._numpy_data['video_frame'])*scale_factor
 
         # white light
-        power = np.uint8(self._numpy_data['white_light_power'])
+        video_frame, power = decimated['white_light_power']
+        t = video_frame*scale_factor
         y_max = 255
         plt.subplot(2, 1, 1)
         # plt.plot(t, power)
@@ -569,40 +1030,11 @@ class SleepAssay(object):
         duration_days = int(t.max())
         plt.xticks(np.linspace(0, duration_days+1, 2*duration_days+3, endpoint=True))
         plt.grid(True)
-        marker_half_thickness = 0.025
-        start = 0
-        entrainment_duration = self._config['entrainment']['duration_days']
-        stop = entrainment_duration - marker_half_thickness
-        if entrainment_duration > 0:
-            plt.axvspan(start, stop, color='y', alpha=0.5, lw=0)
-            plt.text(start + (stop-start)/2, y_max+25, 'entrainment', fontsize=15, horizontalalignment='center')
-        start = stop
-        stop = start + 2*marker_half_thickness
-        plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
-        run = 0
-        for run_config in self._config['experiment']:
-            start = stop
-            run_duration = run_config['duration_days']
-            stop = start + run_duration - 2*marker_half_thickness
-            if run_duration > 0:
-                plt.axvspan(start, stop, color='g', alpha=0.5, lw=0)
-                plt.text(start + (stop-start)/2, y_max+25, 'experiment run {0}'.format(run), fontsize=15, horizontalalignment='center')
-            start = stop
-            stop = start + 2*marker_half_thickness
-            plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
-            run += 1
-        start = stop
-        recovery_duration = self._config['recovery']['duration_days']
-        stop = start + recovery_duration - marker_half_thickness
-        if recovery_duration > 0:
-            plt.axvspan(start, stop, color='r', alpha=0.5, lw=0)
-            plt.text(start + (stop-start)/2, y_max+25, 'recovery', fontsize=15, horizontalalignment='center')
-        start = stop
-        stop = start + marker_half_thickness
-        plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
+        self._plot_phases(y_max+25)
 
         # red light
-        red_light_pwm_status = np.uint8(self._numpy_data['red_light_pwm_status'])
+        video_frame, red_light_pwm_status = decimated['red_light_pwm_status']
+        t = video_frame*scale_factor
         y_max = 1
         plt.subplot(2, 1, 2)
         # plt.plot(t, red_light_pwm_status)
@@ -613,101 +1045,310 @@ class SleepAssay(object):
         duration_days = int(t.max())
         plt.xticks(np.linspace(0, duration_days+1, 2*duration_days+3, endpoint=True))
         plt.grid(True)
-        marker_half_thickness = 0.025
-        start = 0
-        entrainment_duration = self._config['entrainment']['duration_days']
-        stop = entrainment_duration - marker_half_thickness
-        if entrainment_duration > 0:
-            plt.axvspan(start, stop, color='y', alpha=0.5, lw=0)
-            plt.text(start + (stop-start)/2, y_max+0.1, 'entrainment', fontsize=15, horizontalalignment='center')
-        start = stop
-        stop = start + 2*marker_half_thickness
-        plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
-        run = 0
-        for run_config in self._config['experiment']:
-            start = stop
-            run_duration = run_config['duration_days']
-            stop = start + run_duration - 2*marker_half_thickness
-            if run_duration > 0:
-                plt.axvspan(start, stop, color='g', alpha=0.5, lw=0)
-                plt.text(start + (stop-start)/2, y_max+0.1, 'experiment run {0}'.format(run), fontsize=15, horizontalalignment='center')
-            start = stop
-            stop = start + 2*marker_half_thickness
-            plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
-            run += 1
-        start = stop
-        recovery_duration = self._config['recovery']['duration_days']
-        stop = start + recovery_duration - marker_half_thickness
-        if recovery_duration > 0:
-            plt.axvspan(start, stop, color='r', alpha=0.5, lw=0)
-            plt.text(start + (stop-start)/2, y_max+0.1, 'recovery', fontsize=15, horizontalalignment='center')
-        start = stop
-        stop = start + marker_half_thickness
-        plt.axvspan(start, stop, color='k', alpha=0.5, lw=0)
+        self._plot_phases(y_max+0.1)
 
         plt.show()
 
-    def run(self):
+    def _plot_phases(self,text_y):
+        '''
+        Shades each phase of the timeline on the current axes.
+        '''
+        import matplotlib.pyplot as plt
+        marker_half_thickness = 0.025
+        milliseconds_per_day = self._timeline_milliseconds_per_hour*self._HOURS_PER_DAY
+        for phase in self._timeline.get_phases():
+            start = phase.start/milliseconds_per_day
+            stop = (phase.start + phase.duration)/milliseconds_per_day
+            if phase.duration > 0:
+                if phase.name == 'entrainment':
+                    color = 'y'
+                    label = 'entrainment'
+                elif phase.name == 'recovery':
+                    color = 'r'
+                    label = 'recovery'
+                else:
+                    color = 'g'
+                    label = phase.name.replace('_run',' run ')
+                span_start = start
+                if phase.start > 0:
+                    span_start += marker_half_thickness
+                plt.axvspan(span_start, stop - marker_half_thickness, color=color, alpha=0.5, lw=0)
+                plt.text(start + (stop-start)/2, text_y, label, fontsize=15, horizontalalignment='center')
+            if phase.name == 'recovery':
+                plt.axvspan(stop - marker_half_thickness, stop, color='k', alpha=0.5, lw=0)
+            else:
+                plt.axvspan(stop - marker_half_thickness, stop + marker_half_thickness, color='k', alpha=0.5, lw=0)
+
+    def _resumed_phases(self,start_datetime,issued_phase,issued_command_count):
+        '''
+        Like _phases, but skips the phases that are over and resumes
+        the phase the protocol is in now. issued_command_count commands
+        of issued_phase are already on the board.
+        '''
+        now_datetime = self._clock.now()
+        for phase in self._timeline.get_phases():
+            phase_start_datetime = start_datetime + datetime.timedelta(milliseconds=phase.start)
+            phase_end_datetime = phase_start_datetime + datetime.timedelta(milliseconds=phase.duration)
+            if phase_end_datetime <= now_datetime:
+                continue
+            self._state = phase.name
+            print('{0}:'.format(phase.name))
+            print('  start:')
+            self._print_datetime(phase_start_datetime)
+            if (phase_start_datetime < now_datetime) or (phase.name == issued_phase):
+                if phase.name != issued_phase:
+                    issued_command_count = 0
+                yield self._resume_phase(phase,phase_start_datetime,issued_command_count)
+            else:
+                yield self._start_phase(phase,phase_start_datetime)
+            now_datetime = self._clock.now()
+
+    def _phases(self,start_datetime):
+        '''
+        Starts each phase of the protocol in turn and yields the
+        datetime it ends.
+        '''
+        self._state = 'entrainment'
+        end_datetime = self.start_entrainment(start_datetime,
+                                              self._config['entrainment'])
+        yield end_datetime
+
+        for run in range(len(self._config['experiment'])):
+            self._state = 'experiment_run{0}'.format(run)
+            end_datetime = self.start_experiment_run(run,
+                                                     end_datetime,
+                                                     self._config['experiment'][run])
+            yield end_datetime
+
+        self._state = 'recovery'
+        end_datetime = self.start_recovery(end_datetime,
+                                           self._config['recovery'])
+        yield end_datetime
+
+    def start_run(self,name=None):
+        '''
+        Starts the camera trigger and the first phase of the protocol
+        and returns the data file path. Call update_run until it
+        returns False to log data and start the remaining phases.
+        '''
         self.stop()
+        if self._notify:
+            self.start_notifications()
         print('config_file_path:')
         print(self._config_file_path)
         print('data_file_path:')
-        data_file_path = self.start_data_writer()
+        data_file_path = self.start_data_writer(name)
         print(data_file_path)
         self.start_board_indicator_light_cycle(self._config['relays']['board_indicator_light'])
         if self._quick_test:
             self._config['start']['offset_days'] = -1
             if self._config['camera_trigger']['frame_rate_hz'] <= 1:
                 self._config['camera_trigger']['frame_rate_hz'] *= 10
+        # phases end on the monotonic clock, so wall clock steps and
+        # daylight saving changes cannot shorten or stretch them
+        self._run_start_datetime = self._clock.now()
+        self._run_start_monotonic = self._clock.monotonic()
         camera_trigger_start_datetime = self._start_to_start_datetime(self._config['start'])
 
-        entrainment_duration_datetime = self._duration_days_to_duration_datetime(self._config['entrainment']['duration_days'])
-        end_datetime = camera_trigger_start_datetime + entrainment_duration_datetime
-        for run in range(len(self._config['experiment'])):
-            run_duration_datetime = self._duration_days_to_duration_datetime(self._config['experiment'][run]['duration_days'])
-            end_datetime += run_duration_datetime
-        recovery_duration_datetime = self._duration_days_to_duration_datetime(self._config['recovery']['duration_days'])
-        end_datetime += recovery_duration_datetime
+        for problem in self._timeline.validate():
+            print('Warning!','\n' + problem)
+        end_datetime = camera_trigger_start_datetime + datetime.timedelta(milliseconds=self._timeline.get_duration())
         print('sleep assay will run until:')
         self._print_datetime(end_datetime)
 
         delay = self._start_datetime_to_delay(camera_trigger_start_datetime)
         self._video_frame = -1
+        self._frame_offset = 0
         self.start_camera_trigger(self._config['relays']['camera_trigger'],
                                   self._config['camera_trigger']['frame_rate_hz'],
                                   delay)
-        self._state = 'entrainment'
-        entrainment_end_datetime = self.start_entrainment(camera_trigger_start_datetime,
-                                                          self._config['entrainment'])
+        self._journal = RunJournal(get_journal_file_path(self._data_writer.get_index_file_path()),
+                                   {'config_file_path': self._config_file_path,
+                                    'config_sha256': hash_config_file(self._config_file_path),
+                                    'quick_test': self._quick_test,
+                                    'data_index_file_path': os.path.abspath(self._data_writer.get_index_file_path()),
+                                    'frame_rate_hz': self._config['camera_trigger']['frame_rate_hz'],
+                                    'camera_trigger_start_epoch': camera_trigger_start_datetime.timestamp(),
+                                    'frame_offset': 0,
+                                    'phases': [],
+                                    'video_frame': -1,
+                                    'resume_count': 0,
+                                    'finished': False})
+        self._start_run_loop(camera_trigger_start_datetime)
+        return data_file_path
+
+    def _start_run_loop(self,camera_trigger_start_datetime,resume=False,issued_phase=None,issued_command_count=0):
+        '''
+        Sets up logging and frame timing and starts the first phase,
+        or when resuming the phase the protocol is in now.
+        '''
         self._white_light_power_prev = None
         self._red_light_pwm_status_prev = None
         self._red_light_power_prev = None
         self._state_prev = None
         self._prev_written = False
-        self._date_time_prev = None
-        while(datetime.datetime.now() < entrainment_end_datetime):
-            self._write_data()
-
-        run_start_datetime = entrainment_end_datetime
-        for run in range(len(self._config['experiment'])):
-            self._state = 'experiment_run{0}'.format(run)
-            run_end_datetime = self.start_experiment_run(run,
-                                                         run_start_datetime,
-                                                         self._config['experiment'][run])
-            while(datetime.datetime.now() < run_end_datetime):
-                self._write_data()
-            run_start_datetime = run_end_datetime
-
-        self._state = 'recovery'
-        recovery_start_datetime = run_end_datetime
-        recovery_end_datetime = self.start_recovery(recovery_start_datetime,
-                                                    self._config['recovery'])
-        while(datetime.datetime.now() < recovery_end_datetime):
-            self._write_data()
-
-        self._csv_file.close()
+        self._epoch_prev = None
+        self._camera_trigger_on = False
+        kwargs = {}
+        config = self._config.get('scheduler',{})
+        if 'policy' in config:
+            kwargs['policy'] = config['policy']
+        if 'max_catch_up_frames' in config:
+            kwargs['max_catch_up'] = config['max_catch_up_frames']
+        self._scheduler = FrameScheduler(self.get_frame_period(),self._clock,**kwargs)
+        self._camera_trigger_start_datetime = camera_trigger_start_datetime
+        self._journal_interval = self._config.get('journal',{}).get('interval_s',self._JOURNAL_INTERVAL)
+        self._journal_monotonic = self._clock.monotonic()
+        if not resume:
+            self._run_phases = self._phases(camera_trigger_start_datetime)
+        else:
+            self._run_phases = self._resumed_phases(camera_trigger_start_datetime,issued_phase,issued_command_count)
+        # a run resumed after the end of the protocol finishes on the first update
+        self._phase_end_monotonic = self._clock.monotonic()
+        for end_datetime in self._run_phases:
+            self._phase_end_monotonic = self._datetime_to_monotonic(end_datetime)
+            break
+        self._scheduler.set_phase(self._state)
+        self._scheduler.start()
+
+    def resume_run(self,journal_file_path):
+        '''
+        Picks up a run that was interrupted from its journal, without
+        stopping the board, and returns the data file path. If the
+        board is still running the camera trigger, it is kept and only
+        commands the board never got are started. If the board lost its
+        state, the camera trigger is restarted on the frame times of
+        the original run and the rest of the current phase is started
+        from where the protocol should be now. Data goes to new
+        segments of the original data files and frames keep counting
+        from the original camera trigger start.
+        '''
+        journal = RunJournal(journal_file_path)
+        if journal.get('finished'):
+            raise JournalError('Run already finished: {0}'.format(journal_file_path))
+        if journal.get('config_sha256') != hash_config_file(self._config_file_path):
+            raise JournalError('Config file changed since the run started: {0}'.format(self._config_file_path))
+        if journal.get('quick_test') != self._quick_test:
+            raise JournalError('Run was started with quick_test = {0}'.format(journal.get('quick_test')))
+        self._config['camera_trigger']['frame_rate_hz'] = journal.get('frame_rate_hz')
+        print('journal_file_path:')
+        print(journal_file_path)
+        print('data_file_path:')
+        data_file_path = self.start_data_writer(index_file_path=journal.get('data_index_file_path'))
+        print(data_file_path)
+        self._run_start_datetime = self._clock.now()
+        self._run_start_monotonic = self._clock.monotonic()
+        camera_trigger_start_datetime = datetime.datetime.fromtimestamp(journal.get('camera_trigger_start_epoch'))
+        frame_period = 1000/self._config['camera_trigger']['frame_rate_hz']
+        elapsed = 1000*(self._run_start_datetime - camera_trigger_start_datetime).total_seconds()
+        camera_trigger_relay = self._config['relays']['camera_trigger']
+        board_time, power, pwm_status, pulse_counts = self._get_state()
+        # the indicator light starts right away, the camera trigger may still be waiting to
+        board_running = bool(pwm_status[camera_trigger_relay][1] or
+                             pwm_status[self._config['relays']['board_indicator_light']][1])
+        if self._notify:
+            # before anything is restarted, so no transition goes unnotified
+            self.start_notifications()
+        if board_running:
+            print('board still running, resuming without restarting the camera trigger')
+            frame_offset = journal.get('frame_offset')
+            issued_phase = journal.get('phase')
+            issued_command_count = journal.get('issued_command_count',0)
+            if self._notify:
+                self._notify_power = list(power)
+                self._notify_pwm_status = [list(status) for status in pwm_status]
+                self._board_time = board_time
+                self._board_time_host_time = self._clock.time()
+                self._camera_trigger_board_start_time = board_time - (elapsed - frame_offset*frame_period)
+        else:
+            print('board lost its state, restarting the camera trigger on the original frame times')
+            # the first frame the board has yet to trigger
+            frame_offset = max(0,int(math.ceil(elapsed/frame_period)))
+            issued_phase = None
+            issued_command_count = 0
+            self.start_board_indicator_light_cycle(self._config['relays']['board_indicator_light'])
+            delay = self._start_datetime_to_delay(camera_trigger_start_datetime + datetime.timedelta(milliseconds=frame_offset*frame_period))
+            self.start_camera_trigger(camera_trigger_relay,
+                                      self._config['camera_trigger']['frame_rate_hz'],
+                                      delay)
+        self._frame_offset = frame_offset
+        self._video_frame = max(frame_offset,int(elapsed//frame_period)) - 1
+        journal.update(frame_offset=frame_offset,
+                       resume_count=journal.get('resume_count',0) + 1)
+        self._journal = journal
+        self._start_run_loop(camera_trigger_start_datetime,True,issued_phase,issued_command_count)
+        return data_file_path
+
+    def _datetime_to_monotonic(self,dt):
+        return self._run_start_monotonic + (dt - self._run_start_datetime).total_seconds()
+
+    @traced('update_run')
+    def update_run(self):
+        '''
+        Starts the next phase when the current one is over and writes
+        the current state once. Call it at the frame deadline, see
+        get_time_until_next_frame. Returns False when the protocol is
+        finished.
+        '''
+        while self._clock.monotonic() >= self._phase_end_monotonic:
+            try:
+                self._phase_end_monotonic = self._datetime_to_monotonic(next(self._run_phases))
+            except StopIteration:
+                self.finish_run()
+                return False
+            except TransportError as e:
+                # the board keeps what it got, so pick the phase up from
+                # the journal on the next frame, like a resume
+                self._metrics.increment('phase_start_failures')
+                print('Error!','\nphase start:',e)
+                self._run_phases = self._resumed_phases(self._camera_trigger_start_datetime,
+                                                        self._journal.get('phase'),
+                                                        self._journal.get('issued_command_count',0))
+                return True
+            self._scheduler.set_phase(self._state)
+        tick_count = 1
+        if not self._notify:
+            tick_count = self._scheduler.tick()
+        if tick_count > 1:
+            self._metrics.increment('loop_overruns')
+        time_start = time.perf_counter()
+        try:
+            self._update_data(tick_count)
+        except TransportError as e:
+            # a short outage of the serial link costs frames, not the run
+            self._metrics.increment('skipped_frames')
+            print('Error!','\nframe skipped:',e)
+        self._metrics.observe('update_ms',None,1000*(time.perf_counter() - time_start))
+        if self._clock.monotonic() - self._journal_monotonic >= self._journal_interval:
+            self._journal_monotonic = self._clock.monotonic()
+            self._update_journal(video_frame=self._video_frame,epoch=self._clock.time())
+        return True
+
+    def finish_run(self):
+        self._update_journal(video_frame=self._video_frame,epoch=self._clock.time(),finished=True)
+        self._journal.close()
+        self._journal = None
+        self._data_writer.close()
+        self._write_timing_report()
+        metrics_file_path = self._stop_metrics_file()
+        print('metrics_file_path:')
+        print(metrics_file_path)
+        if self._tracer.is_enabled():
+            trace_file_path = self.write_trace()
+            print('trace_file_path:')
+            print(trace_file_path)
         self._stop_all_pulses()
-        self.plot_data(self._csv_file_path)
+        if self._notify:
+            self.stop_notifications()
+
+    def run(self,journal_file_path=None):
+        if journal_file_path is None:
+            self.start_run()
+        else:
+            self.resume_run(journal_file_path)
+        while self.update_run():
+            self._wait_for_next_frame()
+        self.plot_data(self._data_writer.get_index_file_path())
 
 
 def main(args=None):
@@ -715,18 +1356,29 @@ def main(args=None):
         args = sys.argv[1:]
     parser = argparse.ArgumentParser()
     parser.add_argument("config_file_path", help="Path to yaml config file.")
-    parser.add_argument('-p',"--plot-data", help="Path to csv data file.")
+    parser.add_argument('-p',"--plot-data", help="Path to csv, binary or index data file.")
     parser.add_argument('-q',"--quick-test", help="Quick test.", action="store_true")
     parser.add_argument('-n',"--no-hardware", help="Run without USB hardware attached.", action="store_true")
+    parser.add_argument("--notify", help="Let the relay board push state changes instead of polling it.", action="store_true")
+    parser.add_argument('-l',"--live", help="Plot the most recent data while running.", action="store_true")
+    parser.add_argument('-r',"--resume", help="Path to the -journal.json file of an interrupted run to pick up where it should be now.")
+    parser.add_argument("--protocol", choices=sorted(PROTOCOLS), help="Protocol to ask the relay board for, binary by default. Boards that only know json keep json.")
+    parser.add_argument("--trace", help="Trace requests, data writing and the frame loop to a -trace.json file to open in chrome://tracing or ui.perfetto.dev.", action="store_true")
+    parser.add_argument("--speed", type=float, help="With --no-hardware, run the virtual board this many times faster than real time instead of as fast as possible.")
 
     args = parser.parse_args()
     config_file_path = args.config_file_path
 
-    sa = SleepAssay(config_file_path,args.quick_test,args.no_hardware)
+    sa = SleepAssay(config_file_path,args.quick_test,args.no_hardware,args.notify,speed=args.speed,trace=args.trace,protocol=args.protocol)
     if args.plot_data:
         sa.plot_data(args.plot_data)
     else:
-        sa.run()
+        if args.live:
+            sa.start_live_view()
+        try:
+            sa.run(args.resume)
+        except KeyboardInterrupt:
+            sa.stop()
 
 
 # -----------------------------------------------------------------------------------------
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+from .activity import load_activity, CHUNK_FRAMES
+from .data_loader import load_data
+from .data_log import code_to_state
+from .frame_index import FrameIndex
+
+
+BOUT_DTYPE = np.dtype([('well','<i4'),
+                       ('start_frame','<i8'),
+                       ('stop_frame','<i8'),
+                       ('state','u1'),
+                       ('white_light_power','u1'),
+                       ('red_light_pwm_status','u1')])
+
+SECONDS_PER_MINUTE = 60
+# flies are asleep after 5 minutes without moving
+MIN_BOUT_MINUTES = 5
+
+SUMMARY_FIELDS = ['sleep_minutes',
+                  'bout_count',
+                  'mean_bout_minutes',
+                  'max_bout_minutes',
+                  'latency_minutes']
+
+
+class SleepBoutError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class SleepBoutDetector(object):
+    '''
+    Finds runs of inactivity in per well activity, a chunk of frames
+    at a time, for every well at once.
+
+    A well is inactive in a frame when its activity is at most
+    threshold. Runs start and stop where the inactive mask changes,
+    found with one diff over the whole chunk, and runs still open at
+    the end of a chunk are carried into the next one. Runs of at least
+    min_bout_frames are bouts.
+
+    Example Usage:
+
+    sbd = SleepBoutDetector(5*60*30)
+    for first_frame, activity in chunks:
+        sbd.process(first_frame,activity)
+    bouts = sbd.finish()
+    '''
+    THRESHOLD = 0
+
+    def __init__(self,min_bout_frames,*args,**kwargs):
+        self._min_bout_frames = min_bout_frames
+        self._threshold = kwargs.pop('threshold',self.THRESHOLD)
+        self._open_start = None
+        self._next_frame = None
+        self._bouts = []
+
+    def process(self,first_frame,activity):
+        '''
+        Adds activity of shape (frame_count,well_count) starting at
+        video frame first_frame, which follows the previous chunk.
+        '''
+        inactive = np.asarray(activity) <= self._threshold
+        frame_count, well_count = inactive.shape
+        if self._open_start is None:
+            self._open_start = np.full(well_count,-1,dtype=np.int64)
+        elif first_frame != self._next_frame:
+            raise SleepBoutError('Activity chunk starts at frame {0}, expected {1}'.format(first_frame,self._next_frame))
+        self._next_frame = first_frame + frame_count
+        was_inactive = self._open_start >= 0
+        padded = np.concatenate((was_inactive[np.newaxis],inactive)).view(np.int8)
+        # transposed, so nonzero lists changes well by well in frame order
+        changes = np.diff(padded,axis=0).T
+        start_wells, start_frames = np.nonzero(changes == 1)
+        stop_wells, stop_frames = np.nonzero(changes == -1)
+        start_frames = start_frames + first_frame
+        stop_frames = stop_frames + first_frame
+        # runs open at the start of the chunk stop at the first stop of their well
+        open_wells = np.flatnonzero(was_inactive)
+        start_wells = np.concatenate((open_wells,start_wells))
+        start_frames = np.concatenate((self._open_start[open_wells],start_frames))
+        order = np.lexsort((start_frames,start_wells))
+        start_wells = start_wells[order]
+        start_frames = start_frames[order]
+        # runs still open at the end of the chunk are the last start of their well
+        still_open = inactive[-1] if frame_count > 0 else was_inactive
+        last_start = np.zeros(len(start_wells),dtype=bool)
+        if len(start_wells) > 0:
+            last_start[np.flatnonzero(np.diff(start_wells))] = True
+            last_start[-1] = True
+        open_starts = last_start & still_open[start_wells]
+        self._open_start = np.full(well_count,-1,dtype=np.int64)
+        self._open_start[start_wells[open_starts]] = start_frames[open_starts]
+        self._add_bouts(start_wells[~open_starts],start_frames[~open_starts],stop_frames)
+
+    def _add_bouts(self,wells,start_frames,stop_frames):
+        long_enough = (stop_frames - start_frames) >= self._min_bout_frames
+        bouts = np.zeros(np.count_nonzero(long_enough),dtype=BOUT_DTYPE)
+        bouts['well'] = wells[long_enough]
+        bouts['start_frame'] = start_frames[long_enough]
+        bouts['stop_frame'] = stop_frames[long_enough]
+        self._bouts.append(bouts)
+
+    def finish(self):
+        '''
+        Closes runs still open at the end of the activity and returns
+        every bout sorted by well and start frame.
+        '''
+        if self._open_start is not None:
+            wells = np.flatnonzero(self._open_start >= 0)
+            self._add_bouts(wells,self._open_start[wells],np.full(len(wells),self._next_frame,dtype=np.int64))
+            self._open_start = None
+        if not self._bouts:
+            return np.zeros(0,dtype=BOUT_DTYPE)
+        bouts = np.concatenate(self._bouts)
+        self._bouts = [bouts]
+        return bouts[np.lexsort((bouts['start_frame'],bouts['well']))]
+
+
+def detect_sleep_bouts(video_frame,activity,min_bout_frames,threshold=SleepBoutDetector.THRESHOLD,chunk_frames=16*CHUNK_FRAMES):
+    '''
+    Returns the bouts of inactivity of at least min_bout_frames in
+    activity of shape (frame_count,well_count), reading it chunk_frames
+    frames at a time so memory mapped activity of any length fits.
+    '''
+    detector = SleepBoutDetector(min_bout_frames,threshold=threshold)
+    for start in range(0,len(activity),chunk_frames):
+        detector.process(int(video_frame[start]),activity[start:start + chunk_frames])
+    return detector.finish()
+
+
+def join_light_state(bouts,log):
+    '''
+    Fills in the state, white_light_power and red_light_pwm_status
+    columns of bouts from the data log rows in effect when each bout
+    started.
+    '''
+    fields = ['state','white_light_power','red_light_pwm_status']
+    values = FrameIndex(log,fields=fields).get_values(bouts['start_frame'])
+    for field in fields:
+        bouts[field] = values[field]
+    return bouts
+
+
+def get_phases(log,last_frame):
+    '''
+    Returns the state code, start frame and stop frame of each phase
+    in the data log, the last phase stopping at last_frame.
+    '''
+    if len(log) == 0:
+        return np.zeros(0,dtype=np.uint8), np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+    changed = np.flatnonzero(np.diff(log['state'].astype(np.int16))) + 1
+    starts = np.concatenate(([0],changed))
+    start_frames = log['video_frame'][starts]
+    stop_frames = np.append(start_frames[1:],max(last_frame,start_frames[-1]))
+    return log['state'][starts], start_frames, stop_frames
+
+
+def get_light_transitions(log):
+    '''
+    Returns the video frames of the data log rows where the white
+    light power or red light pwm status changed.
+    '''
+    white = np.diff(log['white_light_power'].astype(np.int16)) != 0
+    red = np.diff(log['red_light_pwm_status'].astype(np.int16)) != 0
+    return log['video_frame'][np.flatnonzero(white | red) + 1]
+
+
+def get_latencies(bouts,frames,well_count):
+    '''
+    Returns an array of shape (len(frames),well_count) with the frames
+    from each of frames to the first bout of each well that starts at
+    or after it, nan when there is none.
+    '''
+    frames = np.asarray(frames,dtype=np.int64)
+    # bouts are sorted by well then start, so one searchsorted finds them all
+    span = max(int(bouts['stop_frame'].max()) if len(bouts) else 0,int(frames.max()) if len(frames) else 0) + 1
+    keys = bouts['well'].astype(np.int64)*span + bouts['start_frame']
+    queries = np.arange(well_count,dtype=np.int64)[np.newaxis,:]*span + frames[:,np.newaxis]
+    index = np.searchsorted(keys,queries)
+    found = index < len(bouts)
+    index[~found] = 0
+    if len(bouts) > 0:
+        found &= bouts['well'][index] == np.arange(well_count)[np.newaxis,:]
+    latencies = np.full(queries.shape,np.nan)
+    if len(bouts) > 0:
+        latencies[found] = (bouts['start_frame'][index] - frames[:,np.newaxis])[found]
+    return latencies
+
+
+def summarize_sleep(bouts,log,well_count,frame_rate,last_frame):
+    '''
+    Returns a list of (state,summary) pairs, one per phase of the data
+    log in order, where summary maps each of SUMMARY_FIELDS to an
+    array with one value per well. Sleep minutes count the part of
+    every bout inside the phase, bouts are counted in the phase they
+    start in and latency is from the start of the phase.
+    '''
+    frames_per_minute = frame_rate*SECONDS_PER_MINUTE
+    states, start_frames, stop_frames = get_phases(log,last_frame)
+    latencies = get_latencies(bouts,start_frames,well_count)
+    lengths = (bouts['stop_frame'] - bouts['start_frame'])/frames_per_minute
+    summaries = []
+    for phase in range(len(states)):
+        start = start_frames[phase]
+        stop = stop_frames[phase]
+        overlap = np.clip(np.minimum(bouts['stop_frame'],stop) - np.maximum(bouts['start_frame'],start),0,None)
+        starts_in_phase = (bouts['start_frame'] >= start) & (bouts['start_frame'] < stop)
+        wells = bouts['well'][starts_in_phase]
+        bout_count = np.bincount(wells,minlength=well_count)
+        length_sum = np.bincount(wells,weights=lengths[starts_in_phase],minlength=well_count)
+        max_length = np.zeros(well_count)
+        np.maximum.at(max_length,wells,lengths[starts_in_phase])
+        latency = latencies[phase]/frames_per_minute
+        latency[latency >= (stop - start)/frames_per_minute] = np.nan
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean_length = np.where(bout_count > 0,length_sum/bout_count,np.nan)
+        summaries.append((code_to_state(states[phase]),
+                          {'sleep_minutes': np.bincount(bouts['well'],weights=overlap,minlength=well_count)/frames_per_minute,
+                           'bout_count': bout_count,
+                           'mean_bout_minutes': mean_length,
+                           'max_bout_minutes': np.where(bout_count > 0,max_length,np.nan),
+                           'latency_minutes': latency}))
+    return summaries
+
+
+def write_sleep_summary(summaries,csv_file_path):
+    with open(csv_file_path,'w',newline='') as csv_file:
+        writer = csv.writer(csv_file,quotechar='\"',quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['state','well'] + SUMMARY_FIELDS)
+        for state, summary in summaries:
+            columns = [summary[field] for field in SUMMARY_FIELDS]
+            for well, values in enumerate(zip(*columns)):
+                writer.writerow([state,well] + ['{0:.6g}'.format(value) for value in values])
+
+
+def analyze_sleep(activity_file_path,data_file_path,frame_rate,min_bout_minutes=MIN_BOUT_MINUTES,threshold=SleepBoutDetector.THRESHOLD):
+    '''
+    Returns the sleep bouts in an activity file joined to the light
+    state of a data file, and their per phase summaries.
+    '''
+    video_frame, activity = load_activity(activity_file_path)
+    log = load_data(data_file_path)
+    min_bout_frames = int(round(min_bout_minutes*SECONDS_PER_MINUTE*frame_rate))
+    bouts = join_light_state(detect_sleep_bouts(video_frame,activity,min_bout_frames,threshold),log)
+    last_frame = int(video_frame[-1]) + 1 if len(video_frame) else 0
+    return bouts, summarize_sleep(bouts,log,activity.shape[1],frame_rate,last_frame)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Find sleep bouts in an activity file and summarize them per phase.")
+    parser.add_argument("activity_file_path", help="Path to activity file.")
+    parser.add_argument("data_file_path", help="Path to csv, binary or index data file of the run.")
+    parser.add_argument("summary_file_path", help="Path to write the csv summary.")
+    parser.add_argument('-f',"--frame-rate", type=float, required=True, help="Camera frame rate in Hz.")
+    parser.add_argument('-m',"--min-bout-minutes", type=float, default=MIN_BOUT_MINUTES, help="Shortest inactivity that counts as sleep.")
+    parser.add_argument('-t',"--threshold", type=int, default=SleepBoutDetector.THRESHOLD, help="Most moving pixels a well can have and still be inactive.")
+
+    args = parser.parse_args(args)
+
+    bouts, summaries = analyze_sleep(args.activity_file_path,
+                                     args.data_file_path,
+                                     args.frame_rate,
+                                     args.min_bout_minutes,
+                                     args.threshold)
+    write_sleep_summary(summaries,args.summary_file_path)
+    print('{0} bouts in {1} phases written to {2}'.format(len(bouts),len(summaries),args.summary_file_path))
+
+
+# -----------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import collections
+
+import numpy as np
+
+
+MILLISECONDS_PER_SECOND = 1000
+MILLISECONDS_PER_HOUR = 3600000
+HOURS_PER_DAY = 24
+# nested pwm levels faster than this, like the red light pwm0, are
+# not expanded into intervals
+EXPANDED_PERIOD_MIN = 60000
+
+RELAY_NAMES = ('white_light','red_light')
+
+# firmware/ssr_nano_pwm/Constants.h
+WAVEFORM_POINT_COUNT_MAX = 16
+POWER_MIN = 0
+POWER_MAX = 255
+
+PwmCommand = collections.namedtuple('PwmCommand',['relay_name',
+                                                  'power',
+                                                  'delay',
+                                                  'count',
+                                                  'periods',
+                                                  'on_durations',
+                                                  'waveform',
+                                                  'waveform_level',
+                                                  'waveform_offset'])
+
+Phase = collections.namedtuple('Phase',['name',
+                                        'start',
+                                        'duration',
+                                        'commands'])
+
+
+class TimelineError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+def _ceil_div(numerator,denominator):
+    return -(-numerator//denominator)
+
+
+def _hours_to_ms(hours,milliseconds_per_hour):
+    return int(round(hours*milliseconds_per_hour))
+
+
+def _days_to_ms(days,milliseconds_per_hour):
+    return int(round(days*HOURS_PER_DAY*milliseconds_per_hour))
+
+
+def _waveform(config,milliseconds_per_hour):
+    '''
+    Returns the waveform of a light config as (time, power) points
+    with time in milliseconds from the start of the on period, or None
+    when it has none.
+    '''
+    if 'waveform' not in config:
+        return None
+    try:
+        points = tuple((_hours_to_ms(hours,milliseconds_per_hour),int(power)) for hours, power in config['waveform'])
+    except (TypeError, ValueError):
+        raise TimelineError('waveform must be a list of [hours, power] points')
+    if not (1 <= len(points) <= WAVEFORM_POINT_COUNT_MAX):
+        raise TimelineError('waveform must have 1 to {0} points'.format(WAVEFORM_POINT_COUNT_MAX))
+    times = [point[0] for point in points]
+    if (times[0] < 0) or (times != sorted(times)):
+        raise TimelineError('waveform hours must be increasing from 0 or more')
+    for time, power in points:
+        if not (POWER_MIN <= power <= POWER_MAX):
+            raise TimelineError('waveform power must be between {0} and {1}'.format(POWER_MIN,POWER_MAX))
+    return points
+
+
+def waveform_power(waveform,elapsed):
+    '''
+    Returns the power of a waveform elapsed milliseconds into its on
+    period with the integer math of the firmware, linear between
+    points, truncated toward zero, and holding before the first and
+    after the last point. elapsed may be a number or an array.
+    '''
+    times = np.array([point[0] for point in waveform],dtype=np.int64)
+    powers = np.array([point[1] for point in waveform],dtype=np.int64)
+    elapsed = np.asarray(elapsed,dtype=np.int64)
+    point = np.searchsorted(times,elapsed,side='right')
+    inside = (point > 0) & (point < len(times))
+    point_0 = np.clip(point - 1,0,len(times) - 1)
+    point_1 = np.clip(point,0,len(times) - 1)
+    duration = np.maximum(times[point_1] - times[point_0],1)
+    power_delta = powers[point_1] - powers[point_0]
+    step = (np.abs(power_delta)*np.maximum(elapsed - times[point_0],0))//duration
+    power = np.where(inside,
+                     powers[point_0] + np.sign(power_delta)*step,
+                     np.where(point == 0,powers[0],powers[-1]))
+    return power
+
+
+def _white_light_command(config,duration,milliseconds_per_hour):
+    power = config['power']
+    pwm0_on_duration = _hours_to_ms(config['pwm0_on_duration_hours'],milliseconds_per_hour)
+    pwm0_period = pwm0_on_duration + _hours_to_ms(config['pwm0_off_duration_hours'],milliseconds_per_hour)
+    delay = _days_to_ms(config.get('delay_days',0),milliseconds_per_hour)
+    if ('pwm1_on_duration_days' in config) and ('pwm1_off_duration_days' in config):
+        pwm1_on_duration = _days_to_ms(config['pwm1_on_duration_days'],milliseconds_per_hour)
+        pwm1_period = pwm1_on_duration + _days_to_ms(config['pwm1_off_duration_days'],milliseconds_per_hour)
+        periods = (pwm0_period,pwm1_period)
+        on_durations = (pwm0_on_duration,pwm1_on_duration)
+    else:
+        periods = (pwm0_period,)
+        on_durations = (pwm0_on_duration,)
+    count = _ceil_div(duration - delay,periods[-1])
+    # the waveform spans each day, whatever pwm1 does
+    return PwmCommand('white_light',power,delay,count,periods,on_durations,_waveform(config,milliseconds_per_hour),0,0)
+
+
+def _red_light_command(config,duration,milliseconds_per_hour):
+    power = config['power']
+    # pwm0 is a real frequency, so it is not scaled with the hours
+    pwm0_period = int(MILLISECONDS_PER_SECOND/config['pwm0_frequency_hz'])
+    pwm0_on_duration = int((config['pwm0_duty_cycle_percent']/100)*pwm0_period)
+    pwm1_on_duration = _hours_to_ms(config['pwm1_on_duration_hours'],milliseconds_per_hour)
+    pwm1_period = pwm1_on_duration + _hours_to_ms(config['pwm1_off_duration_hours'],milliseconds_per_hour)
+    delay = _days_to_ms(config.get('delay_days',0),milliseconds_per_hour)
+    count = _ceil_div(duration - delay,pwm1_period)
+    # the waveform spans each pwm1 on period, pwm0 is a flicker within it
+    return PwmCommand('red_light',power,delay,count,(pwm0_period,pwm1_period),(pwm0_on_duration,pwm1_on_duration),
+                      _waveform(config,milliseconds_per_hour),1,0)
+
+
+def compile_phase(name,config,start=0,milliseconds_per_hour=MILLISECONDS_PER_HOUR):
+    '''
+    Returns the Phase for one entrainment, experiment run or recovery
+    config. Times are integer milliseconds, command delays are from
+    the start of the phase and every command runs a whole number of
+    its slowest period, counted the same way for every phase.
+    '''
+    duration = max(0,_days_to_ms(config['duration_days'],milliseconds_per_hour))
+    commands = []
+    if duration > 0:
+        if 'white_light' in config:
+            commands.append(_white_light_command(config['white_light'],duration,milliseconds_per_hour))
+        if 'red_light' in config:
+            commands.append(_red_light_command(config['red_light'],duration,milliseconds_per_hour))
+    commands = [command for command in commands if command.count > 0]
+    return Phase(name,start,duration,commands)
+
+
+def _resume_window(command,periods,on_durations,offset,length):
+    '''
+    Returns the commands that run the nested levels periods and
+    on_durations of command, which started offset milliseconds ago,
+    for the length milliseconds left of the on window of their
+    parent.
+    '''
+    if length <= 0:
+        return []
+    if (not periods) or (periods[-1] < EXPANDED_PERIOD_MIN):
+        # the window on its own, with any fast levels restarted since
+        # nobody can tell where in their cycle they were, and its
+        # waveform picked up where it is
+        waveform_offset = 0
+        if command.waveform_level == len(periods):
+            waveform_offset = offset
+        return [command._replace(delay=0,
+                                 count=1,
+                                 periods=tuple(periods) + (length,),
+                                 on_durations=tuple(on_durations) + (length,),
+                                 waveform_offset=waveform_offset)]
+    period = periods[-1]
+    on_duration = on_durations[-1]
+    offset = offset % period
+    commands = []
+    if offset < on_duration:
+        commands.extend(_resume_window(command,periods[:-1],on_durations[:-1],offset,min(on_duration - offset,length)))
+    rest = length - (period - offset)
+    if rest > 0:
+        # whole cycles from the next boundary to the end of the window
+        commands.append(command._replace(delay=period - offset,
+                                         count=1,
+                                         periods=tuple(periods) + (rest,),
+                                         on_durations=tuple(on_durations) + (rest,)))
+    return commands
+
+
+def resume_command(command,elapsed):
+    '''
+    Returns the commands that do what is left of command elapsed
+    milliseconds after the start of its phase, with delays from now.
+    Cycles that are over are dropped, the cycle in progress is cut
+    down to what is left of it and the remaining cycles start on their
+    usual boundaries, so the relay switches when it would have if the
+    command had been running all along.
+    '''
+    if elapsed <= command.delay:
+        return [command._replace(delay=command.delay - elapsed)]
+    offset = elapsed - command.delay
+    period = command.periods[-1]
+    cycle = offset//period
+    if cycle >= command.count:
+        return []
+    offset -= cycle*period
+    commands = []
+    if offset < command.on_durations[-1]:
+        commands.extend(_resume_window(command,
+                                       command.periods[:-1],
+                                       command.on_durations[:-1],
+                                       offset,
+                                       command.on_durations[-1] - offset))
+    if cycle + 1 < command.count:
+        commands.append(command._replace(delay=period - offset,count=command.count - cycle - 1))
+    return commands
+
+
+def _expand_command(command,start):
+    '''
+    Returns start, end and level arrays of the on intervals of a
+    command that starts at start, expanding nested levels down to the
+    fastest one slower than EXPANDED_PERIOD_MIN, or to the level of
+    its waveform.
+    '''
+    level = len(command.periods) - 1
+    level_min = level
+    if command.waveform is not None:
+        level_min = min(level,command.waveform_level)
+    starts = start + command.delay + np.arange(command.count,dtype=np.int64)*command.periods[level]
+    ends = starts + command.on_durations[level]
+    while (level > 0) and ((command.periods[level - 1] >= EXPANDED_PERIOD_MIN) or (level > level_min)):
+        level -= 1
+        period = command.periods[level]
+        count = _ceil_div(command.on_durations[level + 1],period)
+        window_ends = np.repeat(ends,count)
+        starts = np.add.outer(starts,np.arange(count,dtype=np.int64)*period).ravel()
+        ends = np.minimum(starts + command.on_durations[level],window_ends)
+    return starts, ends, level
+
+
+class Timeline(object):
+    '''
+    Every phase and every relay on interval of a config, compiled once
+    into sorted integer millisecond arrays measured from the start of
+    entrainment.
+
+    Expected relay states at any time, or at an array of times, are
+    found by binary search, so plotting, logging and validation can
+    share one description of the protocol instead of each redoing the
+    phase math.
+
+    Example Usage:
+
+    tl = Timeline(config)
+    tl.get_state(36*3600*1000)
+    tl.get_expected([0,12*3600*1000])
+    '''
+    def __init__(self,config,milliseconds_per_hour=MILLISECONDS_PER_HOUR):
+        self._milliseconds_per_hour = milliseconds_per_hour
+        phase_configs = [('entrainment',config['entrainment'])]
+        for run in range(len(config['experiment'])):
+            phase_configs.append(('experiment_run{0}'.format(run),config['experiment'][run]))
+        phase_configs.append(('recovery',config['recovery']))
+
+        self._phases = []
+        start = 0
+        for name, phase_config in phase_configs:
+            phase = compile_phase(name,phase_config,start,milliseconds_per_hour)
+            self._phases.append(phase)
+            start += phase.duration
+        self._duration = start
+        self._phase_names = [phase.name for phase in self._phases]
+        self._phase_starts = np.array([phase.start for phase in self._phases],dtype=np.int64)
+        self._phase_ends = self._phase_starts + np.array([phase.duration for phase in self._phases],dtype=np.int64)
+
+        self._intervals = {}
+        for relay_name in RELAY_NAMES:
+            starts = []
+            ends = []
+            powers = []
+            phases = []
+            levels = []
+            waveforms = []
+            waveform_indices = []
+            for phase_index, phase in enumerate(self._phases):
+                for command in phase.commands:
+                    if command.relay_name != relay_name:
+                        continue
+                    command_starts, command_ends, level = _expand_command(command,phase.start)
+                    starts.append(command_starts)
+                    ends.append(command_ends)
+                    powers.append(np.full(len(command_starts),command.power,dtype=np.uint8))
+                    phases.append(np.full(len(command_starts),phase_index,dtype=np.int64))
+                    levels.append(level)
+                    waveform_index = -1
+                    if command.waveform is not None:
+                        waveform_index = len(waveforms)
+                        waveforms.append(command.waveform)
+                    waveform_indices.append(np.full(len(command_starts),waveform_index,dtype=np.int64))
+            if starts:
+                starts = np.concatenate(starts)
+                order = np.argsort(starts,kind='stable')
+                ends = np.concatenate(ends)[order]
+                self._intervals[relay_name] = {'starts': starts[order],
+                                               'ends': ends,
+                                               'ends_max': np.maximum.accumulate(ends),
+                                               'powers': np.concatenate(powers)[order],
+                                               'phases': np.concatenate(phases)[order],
+                                               'level': max(levels),
+                                               'waveforms': waveforms,
+                                               'waveform_indices': np.concatenate(waveform_indices)[order]}
+            else:
+                empty = np.zeros(0,dtype=np.int64)
+                self._intervals[relay_name] = {'starts': empty,
+                                               'ends': empty,
+                                               'ends_max': empty,
+                                               'powers': np.zeros(0,dtype=np.uint8),
+                                               'phases': empty,
+                                               'level': 0,
+                                               'waveforms': [],
+                                               'waveform_indices': empty}
+
+    def get_duration(self):
+        return self._duration
+
+    def get_phases(self):
+        return list(self._phases)
+
+    def get_phase(self,name):
+        return self._phases[self._phase_names.index(name)]
+
+    def get_relay_intervals(self,relay_name):
+        '''
+        Returns sorted start and end times and powers of the on
+        intervals of a relay.
+        '''
+        intervals = self._intervals[relay_name]
+        return intervals['starts'], intervals['ends'], intervals['powers']
+
+    def get_state(self,t):
+        '''
+        Returns the phase name at time t, or None outside of the
+        protocol. t may be a number or an array of numbers.
+        '''
+        t_array = np.asarray(t,dtype=np.int64)
+        index = np.searchsorted(self._phase_starts,t_array,side='right') - 1
+        # zero length phases share their start with the next phase, so
+        # searching from the right already skips them
+        inside = (index >= 0) & (t_array < self._duration)
+        names = np.array(self._phase_names + [None],dtype=object)
+        return names[np.where(inside,index,len(self._phase_names))]
+
+    def get_expected(self,t):
+        '''
+        Returns a dict with (pwm_status, power) for each relay at time
+        t. t may be a number or an array of numbers.
+        '''
+        t_array = np.asarray(t,dtype=np.int64)
+        expected = {}
+        for relay_name, intervals in self._intervals.items():
+            if len(intervals['starts']) == 0:
+                pwm_status = np.zeros(t_array.shape,dtype=np.uint8)
+                power = np.zeros(t_array.shape,dtype=np.uint8)
+            else:
+                index = np.searchsorted(intervals['starts'],t_array,side='right') - 1
+                index_valid = np.maximum(index,0)
+                on = (index >= 0) & (t_array < intervals['ends_max'][index_valid])
+                pwm_status = on.astype(np.uint8)
+                power = np.where(on,intervals['powers'][index_valid],0)
+                if intervals['waveforms']:
+                    # waveforms play back from the start of each interval
+                    waveform_index = np.where(on,intervals['waveform_indices'][index_valid],-1)
+                    elapsed = t_array - intervals['starts'][index_valid]
+                    for waveform_number, waveform in enumerate(intervals['waveforms']):
+                        power = np.where(waveform_index == waveform_number,waveform_power(waveform,elapsed),power)
+                power = power.astype(np.uint8)
+            if np.ndim(t) == 0:
+                pwm_status = pwm_status[()]
+                power = power[()]
+            expected[relay_name] = (pwm_status,power)
+        return expected
+
+    def validate(self):
+        '''
+        Returns a list of problems with the compiled protocol, like
+        pwm commands on a relay that overlap or that run past the end
+        of their phase.
+        '''
+        problems = []
+        for relay_name, intervals in self._intervals.items():
+            starts = intervals['starts']
+            if len(starts) == 0:
+                continue
+            overlaps = np.flatnonzero(starts[1:] < intervals['ends_max'][:-1])
+            for index in overlaps[:1]:
+                problems.append('{0} intervals overlap at {1} ms in {2}'.format(relay_name,
+                                                                                 starts[index + 1],
+                                                                                 self._phase_names[intervals['phases'][index + 1]]))
+            phase_ends = self._phase_ends[intervals['phases']]
+            late = np.flatnonzero(intervals['ends'] > phase_ends)
+            for index in late[:1]:
+                problems.append('{0} is on until {1} ms, past the end of {2} at {3} ms'.format(relay_name,
+                                                                                             intervals['ends'][index],
+                                                                                             self._phase_names[intervals['phases'][index]],
+                                                                                             phase_ends[index]))
+        return problems
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+
+# shared by every disabled span, so tracing off creates no span objects
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self,tracer,name,args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._time_start = time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        self._tracer.add_complete(self._name,self._time_start,time.perf_counter(),self._args)
+        return False
+
+
+class Tracer(object):
+    '''
+    Opt-in span tracing of the request path, the data writer and the
+    frame loop, exported in the Chrome trace event format to open in
+    chrome://tracing or https://ui.perfetto.dev.
+
+    When disabled, span returns one shared do-nothing context manager,
+    so leaving the spans in the code costs the span call, the keyword
+    args dict it is passed and entering and leaving the context, and a
+    method decorated with traced costs the extra wrapper call. When
+    enabled, each span keeps a small tuple in a ring buffer of the
+    last max_events events, so a long run never grows without bound.
+    Events keep the thread they happened in, so the transport loop,
+    the serial reader and the data writer each get their own track.
+
+    Example Usage:
+
+    tracer = Tracer(enabled=True)
+    with tracer.span('send_request',method_id=4):
+        transport.request_sync(4)
+    tracer.write('2016-7-15-9-0-0-trace.json')
+    '''
+    MAX_EVENTS = 200000
+
+    def __init__(self,*args,**kwargs):
+        self._enabled = kwargs.pop('enabled',False)
+        self._events = collections.deque(maxlen=kwargs.pop('max_events',self.MAX_EVENTS))
+        self._thread_names = {}
+        self._pid = os.getpid()
+        self._time_origin = time.perf_counter()
+
+    def is_enabled(self):
+        return self._enabled
+
+    def enable(self):
+        self._enabled = True
+
+    def disable(self):
+        self._enabled = False
+
+    def clear(self):
+        self._events.clear()
+
+    def get_event_count(self):
+        return len(self._events)
+
+    def _thread_id(self):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+        return tid
+
+    def _us(self,time_perf):
+        return 1e6*(time_perf - self._time_origin)
+
+    def span(self,name,**args):
+        '''
+        Returns a context manager that records the time spent inside
+        it as a span of name with args.
+        '''
+        if not self._enabled:
+            return _NULL_SPAN
+        return _Span(self,name,args)
+
+    def add_complete(self,name,time_start,time_end,args=None):
+        '''
+        Records a span of name from time_start to time_end, in
+        time.perf_counter seconds.
+        '''
+        if self._enabled:
+            self._events.append(('X',name,self._us(time_start),1e6*(time_end - time_start),self._thread_id(),None,args))
+
+    def begin_async(self,name,async_id,**args):
+        '''
+        Starts a span that can overlap others of the same thread, like
+        requests in flight together on the transport event loop. Ends
+        with end_async of the same name and async_id.
+        '''
+        if self._enabled:
+            self._events.append(('b',name,self._us(time.perf_counter()),None,self._thread_id(),async_id,args))
+
+    def end_async(self,name,async_id,**args):
+        if self._enabled:
+            self._events.append(('e',name,self._us(time.perf_counter()),None,self._thread_id(),async_id,args))
+
+    def instant(self,name,**args):
+        if self._enabled:
+            self._events.append(('i',name,self._us(time.perf_counter()),None,self._thread_id(),None,args))
+
+    def get_trace(self):
+        '''
+        Returns the recorded events as a Chrome trace event dict.
+        '''
+        trace_events = []
+        for tid, thread_name in list(self._thread_names.items()):
+            trace_events.append({'name': 'thread_name',
+                                 'ph': 'M',
+                                 'pid': self._pid,
+                                 'tid': tid,
+                                 'args': {'name': thread_name}})
+        for ph, name, ts, dur, tid, async_id, args in list(self._events):
+            event = {'name': name,
+                     'ph': ph,
+                     'ts': ts,
+                     'pid': self._pid,
+                     'tid': tid}
+            if dur is not None:
+                event['dur'] = dur
+            if async_id is not None:
+                event['cat'] = name
+                event['id'] = async_id
+            if ph == 'i':
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            trace_events.append(event)
+        return {'traceEvents': trace_events,
+                'displayTimeUnit': 'ms'}
+
+    def write(self,trace_file_path):
+        trace_file_path_tmp = trace_file_path + '.tmp'
+        with open(trace_file_path_tmp,'w') as trace_file:
+            json.dump(self.get_trace(),trace_file)
+        os.replace(trace_file_path_tmp,trace_file_path)
+
+
+def traced(name):
+    '''
+    Decorates a method of an object with a _tracer attribute so every
+    call is recorded as a span of name.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self,*args,**kwargs):
+            if not self._tracer.is_enabled():
+                return function(self,*args,**kwargs)
+            with self._tracer.span(name):
+                return function(self,*args,**kwargs)
+        return wrapper
+    return decorator
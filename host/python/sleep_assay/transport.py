@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import asyncio
+import threading
+import json
+import queue
+import time
+
+from .metrics import Metrics
+from .tracing import Tracer
+from .protocol import (RequestEncoder, FrameParser, ProtocolError, decode_payload, PROTOCOL_JSON,
+                       METHOD_ID_SET_PROTOCOL)
+
+
+DEBUG = False
+
+
+class TransportError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class SerialTransport(object):
+    '''
+    Asyncio transport to the relay board.
+
+    Every request is tagged with a request id, so several requests can
+    be in flight at once and replies are matched to requests by id
+    instead of by order. A request that times out or gets a garbled
+    reply is retried with the same request id after an exponential
+    backoff, so the board can tell a retry from a new request, and
+    gives up after max_retries so a flaky link never stalls the caller
+    for longer than a bounded time.
+
+    Requests, retries, timeouts and reply latency are counted by
+    method id in metrics, along with lines that could not be parsed.
+    With an enabled tracer, each request is traced from first write
+    to reply, along with building the request, waiting out the write
+    throttle, the serial write and parsing each reply line.
+
+    Requests start out as json lines. set_protocol asks the board for
+    the binary protocol of sleep_assay.protocol, length prefixed
+    frames with a crc, and keeps json when the board does not know it.
+    Replies and notifications are read as json lines or binary frames,
+    whichever the board sends.
+
+    The event loop runs in a background thread. The *_sync methods are
+    thin blocking wrappers for callers that are not themselves
+    running in an event loop.
+
+    Example Usage:
+
+    transport = SerialTransport(serial_device)
+    result = transport.request_sync(method_id)
+    transport.close()
+    '''
+    REQUEST_TIMEOUT = 0.5
+    MAX_RETRIES = 3
+    BACKOFF_INITIAL = 0.05
+    BACKOFF_MAX = 1.0
+    MAX_IN_FLIGHT = 4
+    WRITE_WRITE_DELAY = 0.05
+    REQUEST_ID_MAX = 2**31 - 1
+
+    def __init__(self,serial_device,*args,**kwargs):
+        self.debug = kwargs.pop('debug',DEBUG)
+        self._request_timeout = kwargs.pop('request_timeout',self.REQUEST_TIMEOUT)
+        self._max_retries = kwargs.pop('max_retries',self.MAX_RETRIES)
+        self._backoff_initial = kwargs.pop('backoff_initial',self.BACKOFF_INITIAL)
+        self._backoff_max = kwargs.pop('backoff_max',self.BACKOFF_MAX)
+        self._write_write_delay = kwargs.pop('write_write_delay',self.WRITE_WRITE_DELAY)
+        max_in_flight = kwargs.pop('max_in_flight',self.MAX_IN_FLIGHT)
+        self._metrics = kwargs.pop('metrics',None)
+        if self._metrics is None:
+            self._metrics = Metrics()
+        self._tracer = kwargs.pop('tracer',None)
+        if self._tracer is None:
+            self._tracer = Tracer()
+        self._serial_device = serial_device
+        self._request_id = 0
+        self._encoder = RequestEncoder(PROTOCOL_JSON)
+        self._pending = {}
+        self._notifications = queue.Queue()
+        self._running = True
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._run_loop,name='sleep_assay_transport')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        self._in_flight = self._call_in_loop(self._make_semaphore,max_in_flight)
+        self._write_lock = self._call_in_loop(asyncio.Lock)
+        self._time_write_prev = 0
+
+        self._reader_thread = threading.Thread(target=self._read_lines,name='sleep_assay_reader')
+        self._reader_thread.daemon = True
+        self._reader_thread.start()
+
+    def _debug_print(self, *args):
+        if self.debug:
+            print(*args)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _call_in_loop(self,function,*args):
+        '''
+        asyncio primitives are created inside the loop thread so they
+        bind to the right loop on every python version.
+        '''
+        async def call():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(call(),self._loop).result()
+
+    def _make_semaphore(self,value):
+        return asyncio.Semaphore(value)
+
+    def _read_lines(self):
+        '''
+        Reads complete lines and frames in a plain thread, since
+        pyserial is blocking, and hands them to the event loop.
+        '''
+        parser = FrameParser()
+        while self._running:
+            try:
+                chars = self._serial_device.read(self._serial_device.in_waiting or 1)
+            except Exception as e:
+                if self._running:
+                    print('Error!','\nread:',e)
+                    time.sleep(self._backoff_initial)
+                continue
+            if not chars:
+                continue
+            time_received = time.monotonic()
+            for kind, message in parser.feed(chars):
+                self._loop.call_soon_threadsafe(self._handle_message,kind,message,time_received)
+
+    def _handle_message(self,kind,message,time_received=None):
+        self._debug_print('response', kind, message)
+        try:
+            if kind == 'line':
+                with self._tracer.span('json_loads'):
+                    response = json.loads(message.decode('utf8'))
+            elif kind == 'frame':
+                with self._tracer.span('decode_frame'):
+                    response = decode_payload(message)
+            else:
+                self._metrics.increment('crc_failures')
+                raise ProtocolError('Bad crc')
+        except (ValueError, UnicodeDecodeError, ProtocolError):
+            # cannot tell which request a garbled line belongs to, so
+            # leave it to time out and be retried
+            self._metrics.increment('parse_failures')
+            self._debug_print('parse failure', kind, message)
+            return
+        if isinstance(response,dict):
+            self._metrics.increment('notifications')
+            self._notifications.put(response)
+            return
+        # a reply id that is not an int, including a list or dict that
+        # cannot be looked up, is as garbled as a bad line
+        if ((not isinstance(response,list)) or (len(response) == 0) or
+            (not isinstance(response[0],int)) or isinstance(response[0],bool)):
+            self._metrics.increment('parse_failures')
+            self._debug_print('parse failure', kind, message)
+            return
+        request_id = response[0]
+        future = self._pending.get(request_id)
+        if (future is None) or future.done():
+            # late reply to a request that was already retried
+            self._metrics.increment('late_replies')
+            return
+        if len(response) > 1:
+            future.set_result((response[1],time_received))
+        else:
+            future.set_result((None,time_received))
+
+    def _next_request_id(self):
+        self._request_id = (self._request_id + 1) % self.REQUEST_ID_MAX
+        return self._request_id
+
+    def _args_to_request(self,request_id,args):
+        return self._encoder.encode(request_id,args)
+
+    async def _write(self,request):
+        async with self._write_lock:
+            time_since_write_prev = self._loop.time() - self._time_write_prev
+            if time_since_write_prev < self._write_write_delay:
+                with self._tracer.span('write_throttle'):
+                    await asyncio.sleep(self._write_write_delay - time_since_write_prev)
+            time_sent = time.monotonic()
+            with self._tracer.span('serial_write'):
+                self._serial_device.write(request)
+            self._time_write_prev = self._loop.time()
+        return time_sent
+
+    async def request(self,*args):
+        '''
+        Sends request made from flattened args and returns the result
+        of the reply, or None for methods without a result. Raises
+        TransportError when no valid reply arrives after max_retries.
+        '''
+        result, time_sent, time_received = await self.request_timed(*args)
+        return result
+
+    async def request_timed(self,*args):
+        '''
+        Like request, but also returns the host monotonic times the
+        request was last written and its reply line was read, for
+        clock synchronization.
+        '''
+        method_id = args[0] if args else None
+        async with self._in_flight:
+            request_id = self._next_request_id()
+            with self._tracer.span('args_to_request'):
+                request = self._args_to_request(request_id,args)
+            self._metrics.increment('requests',method_id)
+            backoff = self._backoff_initial
+            attempt = 0
+            self._tracer.begin_async('request',request_id,method_id=method_id)
+            while True:
+                future = self._loop.create_future()
+                self._pending[request_id] = future
+                try:
+                    self._debug_print('request', request)
+                    time_sent = await self._write(request)
+                    result, time_received = await asyncio.wait_for(future,self._request_timeout)
+                    self._metrics.observe('request_latency_ms',method_id,1000*(time_received - time_sent))
+                    self._tracer.end_async('request',request_id,attempts=attempt + 1)
+                    return result, time_sent, time_received
+                except asyncio.TimeoutError:
+                    self._metrics.increment('request_timeouts',method_id)
+                finally:
+                    self._pending.pop(request_id,None)
+                attempt += 1
+                if attempt > self._max_retries:
+                    self._metrics.increment('request_failures',method_id)
+                    self._tracer.end_async('request',request_id,attempts=attempt,failed=True)
+                    raise TransportError('No valid response to request: {0}'.format([request_id] + list(args)))
+                self._metrics.increment('request_retries',method_id)
+                self._tracer.instant('request_retry',request_id=request_id,attempt=attempt)
+                print('Error!','\nrequest:',[request_id] + list(args),'\nretry:',attempt)
+                await asyncio.sleep(backoff)
+                backoff = min(2*backoff,self._backoff_max)
+
+    async def request_once(self,*args,**kwargs):
+        '''
+        Sends request once and returns the result of the reply. Raises
+        TransportError without retrying when no valid reply arrives
+        within timeout, for polling a board that may not be listening
+        yet.
+        '''
+        timeout = kwargs.pop('timeout',self._request_timeout)
+        async with self._in_flight:
+            request_id = self._next_request_id()
+            request = self._args_to_request(request_id,args)
+            future = self._loop.create_future()
+            self._pending[request_id] = future
+            try:
+                self._debug_print('request', request)
+                await self._write(request)
+                result, time_received = await asyncio.wait_for(future,timeout)
+                return result
+            except asyncio.TimeoutError:
+                raise TransportError('No response to request: {0}'.format([request_id] + list(args)))
+            finally:
+                self._pending.pop(request_id,None)
+
+    async def set_protocol(self,protocol):
+        '''
+        Asks the board to switch to protocol and returns the protocol
+        requests are sent in from now on. A board that does not know
+        the binary protocol gives no result, so requests stay json.
+        '''
+        result = await self.request(METHOD_ID_SET_PROTOCOL,protocol)
+        if result != protocol:
+            protocol = PROTOCOL_JSON
+        # constant requests are encoded once here instead of every send
+        self._encoder = RequestEncoder(protocol)
+        return protocol
+
+    def set_protocol_sync(self,protocol):
+        return asyncio.run_coroutine_threadsafe(self.set_protocol(protocol),self._loop).result()
+
+    def get_protocol(self):
+        return self._encoder.get_protocol()
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_tracer(self):
+        return self._tracer
+
+    def request_sync(self,*args):
+        return asyncio.run_coroutine_threadsafe(self.request(*args),self._loop).result()
+
+    def request_once_sync(self,*args,**kwargs):
+        return asyncio.run_coroutine_threadsafe(self.request_once(*args,**kwargs),self._loop).result()
+
+    def request_timed_sync(self,*args):
+        return asyncio.run_coroutine_threadsafe(self.request_timed(*args),self._loop).result()
+
+    def requests_sync(self,requests):
+        '''
+        Pipelines a list of requests, each a list of args, and returns
+        their results in the same order.
+        '''
+        async def gather():
+            return await asyncio.gather(*[self.request(*args) for args in requests])
+        return asyncio.run_coroutine_threadsafe(gather(),self._loop).result()
+
+    def get_notification(self,timeout=None):
+        '''
+        Returns next notification pushed by the board or None if none
+        arrives within timeout seconds.
+        '''
+        try:
+            return self._notifications.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self._running:
+            return
+        self._running = False
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._reader_thread.join()
@@ -0,0 +1,838 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+import collections
+import heapq
+import json
+import threading
+
+from .transport import TransportError
+from .metrics import Metrics
+from .tracing import Tracer, traced
+from .protocol import (RequestEncoder, FrameParser, ProtocolError, decode_payload, decode_request, encode_reply,
+                       encode_notification, PROTOCOL_JSON, PROTOCOL_BINARY)
+
+
+DEBUG = False
+
+# firmware/ssr_nano_pwm/Constants.h and Constants.cpp
+RELAY_COUNT = 8
+RELAY_PINS = (2,3,4,5,6,7,8,9)
+HIGH_FREQ_RELAY_PINS = (3,9)
+INDEXED_PWMS_COUNT_MAX = 16
+PWM_LEVEL_COUNT_MIN = 1
+PWM_LEVEL_COUNT_MAX = 3
+NOTIFY_LEVEL_DISABLED = PWM_LEVEL_COUNT_MAX + 1
+NOTIFICATION_QUEUE_SIZE = 16
+REQUEST_ID_HISTORY_SIZE = 8
+FRAME_RELAY_DISABLED = -1
+WAVEFORM_POINT_COUNT_MAX = 16
+WAVEFORM_POINTS_PER_REQUEST = 4
+POWER_MIN = 0
+POWER_MAX = 255
+PWM_STOPPED = 0
+PWM_RUNNING = 1
+
+METHOD_ID_START_PWM = 0
+METHOD_ID_STOP_ALL_PULSES = 1
+METHOD_ID_GET_POWER = 2
+METHOD_ID_GET_PWM_STATUS = 3
+METHOD_ID_GET_STATE = 4
+METHOD_ID_SET_NOTIFY = 5
+METHOD_ID_REQUEST_ID = 6
+METHOD_ID_GET_PULSE_COUNTS = 7
+METHOD_ID_SET_FRAME_RELAY = 8
+METHOD_ID_SET_PROTOCOL = 9
+METHOD_ID_SET_WAVEFORM = 10
+
+UNSIGNED_LONG_MAX = 2**32
+
+
+def _to_int(value):
+    '''
+    Arduino int is 16 bits.
+    '''
+    return ((int(value) + 2**15) % 2**16) - 2**15
+
+
+def _to_long(value):
+    return ((int(value) + 2**31) % 2**32) - 2**31
+
+
+class _PwmInfo(object):
+    __slots__ = ('relay','power','level','child_index','period','on_duration','event_pair')
+
+    def __init__(self,relay,power,level,child_index,period,on_duration):
+        self.relay = relay
+        self.power = power
+        self.level = level
+        self.child_index = child_index
+        self.period = period
+        self.on_duration = on_duration
+        self.event_pair = None
+
+
+class _EventPair(object):
+    '''
+    A pwm of the EventController: callback_0 at the start of each
+    period, callback_1 on_duration later, count times or forever when
+    count < 0. start_callback runs before the first callback_0 and
+    stop_callback after the last callback_1.
+    '''
+    __slots__ = ('callback_0','callback_1','period','on_duration','count','arg',
+                 'start_callback','stop_callback','count_0','count_1','removed')
+
+    def __init__(self,callback_0,callback_1,period,on_duration,count,arg,start_callback,stop_callback):
+        self.callback_0 = callback_0
+        self.callback_1 = callback_1
+        self.period = period
+        self.on_duration = on_duration
+        self.count = count
+        self.arg = arg
+        self.start_callback = start_callback
+        self.stop_callback = stop_callback
+        self.count_0 = 0
+        self.count_1 = 0
+        self.removed = False
+
+
+class _Waveform(object):
+    __slots__ = ('relay','level','offset','point_count','times','powers','running','elapsed','power','step_event')
+
+    def __init__(self):
+        self.relay = 0
+        self.level = 0
+        self.offset = 0
+        self.point_count = 0
+        self.times = [0]*WAVEFORM_POINT_COUNT_MAX
+        self.powers = [0]*WAVEFORM_POINT_COUNT_MAX
+        self.running = False
+        self.elapsed = 0
+        self.power = 0
+        self.step_event = None
+
+
+class VirtualRelayBoard(object):
+    '''
+    Software stand-in for a relay board running the ssr_nano_pwm
+    firmware.
+
+    The callbacks, nested pwm levels, pwm status levels, pulse counts,
+    waveforms, notifications, request id replies and json and binary
+    protocols follow the firmware source, and the board reads and writes the
+    same bytes as the serial device, so it can be used anywhere a
+    serial device is. Board time comes from a clock,
+    so with a VirtualClock a whole protocol runs in seconds. Events are
+    run in time order up to the clock time whenever the board is read
+    or written, as if the firmware loop had been running all along.
+    With drift_ppm the board clock gains that many microseconds every
+    second, like a crystal that is a little off.
+
+    Example Usage:
+
+    board = VirtualRelayBoard(VirtualClock())
+    board.write(b'[4]\\n')
+    board.read(board.in_waiting)
+    '''
+    def __init__(self,clock,*args,**kwargs):
+        self.debug = kwargs.pop('debug',DEBUG)
+        # a real crystal runs a little fast or slow
+        self._rate = 1 + kwargs.pop('drift_ppm',0)/1e6
+        self._clock = clock
+        self._start_time = clock.time()
+        self._lock = threading.RLock()
+        self._parser = FrameParser()
+        self._output = bytearray()
+        self._events = []
+        self._event_count = 0
+        self._event_time = None
+        self._indexed_pwms = [None]*INDEXED_PWMS_COUNT_MAX
+        self._waveforms = [_Waveform() for index in range(len(HIGH_FREQ_RELAY_PINS))]
+        self._power = [POWER_MIN]*RELAY_COUNT
+        self._pwm_status = [[PWM_STOPPED]*(PWM_LEVEL_COUNT_MAX + 1) for relay in range(RELAY_COUNT)]
+        self._notify_level = [NOTIFY_LEVEL_DISABLED]*RELAY_COUNT
+        self._pulse_counts = [0]*RELAY_COUNT
+        self._frame_relay = FRAME_RELAY_DISABLED
+        self._notifications = collections.deque()
+        self._notification_seq = 0
+        self._clear_request_ids()
+        self._protocol = PROTOCOL_JSON
+        self._time_ms = 0
+
+    def _debug_print(self, *args):
+        if self.debug:
+            print(*args)
+
+    # serial device interface
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self.update()
+            return len(self._output)
+
+    def read(self,size=1):
+        with self._lock:
+            self.update()
+            chars = bytes(self._output[:size])
+            del self._output[:size]
+            return chars
+
+    def write(self,chars):
+        with self._lock:
+            for kind, message in self._parser.feed(chars):
+                self.update()
+                if kind == 'line':
+                    self._process_line(message)
+                elif kind == 'frame':
+                    self._process_frame(message)
+                # frames with a bad crc are dropped and retried by the host
+                self._write_notifications()
+            return len(chars)
+
+    def close(self):
+        pass
+
+    def get_next_event_time(self,relay_levels=None):
+        '''
+        Returns the clock time of the next pending event, or None. With
+        relay_levels, the lowest pwm level of interest on each relay or
+        None for none, only events that can change those levels count.
+        '''
+        with self._lock:
+            while self._events and self._events[0][2].removed:
+                heapq.heappop(self._events)
+            if relay_levels is None:
+                event_times = [event[0] for event in self._events[0:1]]
+            else:
+                event_times = [event[0] for event in self._events if self._event_is_of_interest(event[2],relay_levels)]
+            if not event_times:
+                return None
+            return self._start_time + min(event_times)/(1000*self._rate)
+
+    def get_notify_levels(self):
+        '''
+        Returns the lowest pwm level notified on each relay, or None for
+        relays that do not notify.
+        '''
+        with self._lock:
+            return [None if level == NOTIFY_LEVEL_DISABLED else level for level in self._notify_level]
+
+    def _event_is_of_interest(self,event_pair,relay_levels):
+        if event_pair.removed:
+            return False
+        if event_pair.callback_0 == self._waveform_step_event_callback:
+            waveform = self._waveforms[event_pair.arg]
+            relay, level = waveform.relay, waveform.level
+        else:
+            pwm_info = self._indexed_pwms[event_pair.arg]
+            if pwm_info is None:
+                return True
+            relay, level = pwm_info.relay, pwm_info.level
+            if event_pair.start_callback is not None:
+                # the status of the parent level changes too
+                level += 1
+        return (relay_levels[relay] is not None) and (level >= relay_levels[relay])
+
+    def update(self):
+        '''
+        Runs every event due by the clock time, like the firmware loop.
+        '''
+        with self._lock:
+            self._time_ms = int(round(1000*self._rate*(self._clock.time() - self._start_time)))
+            while self._events and (self._events[0][0] <= self._time_ms):
+                event_time, _, event_pair, which = heapq.heappop(self._events)
+                if event_pair.removed:
+                    continue
+                self._event_time = event_time
+                self._run_event(event_time,event_pair,which)
+            self._event_time = None
+            self._write_notifications()
+
+    def _millis(self):
+        return self._now_ms() % UNSIGNED_LONG_MAX
+
+    # EventController
+    def _schedule(self,event_time,event_pair,which):
+        heapq.heappush(self._events,(event_time,self._event_count,event_pair,which))
+        self._event_count += 1
+
+    def _now_ms(self):
+        if self._event_time is not None:
+            return self._event_time
+        return self._time_ms
+
+    def _add_pwm(self,callback_0,callback_1,delay,period,on_duration,count,arg,start_callback=None,stop_callback=None):
+        event_pair = _EventPair(callback_0,callback_1,period,on_duration,count,arg,start_callback,stop_callback)
+        if count == 0:
+            return event_pair
+        start_time = self._now_ms() + max(0,delay)
+        self._schedule(start_time,event_pair,0)
+        self._schedule(start_time + on_duration,event_pair,1)
+        return event_pair
+
+    def _add_event(self,callback,delay,arg):
+        # a one shot event runs like a pwm of one period that never switches off
+        event_pair = _EventPair(callback,None,0,0,1,arg,None,None)
+        self._schedule(self._now_ms() + max(0,delay),event_pair,0)
+        return event_pair
+
+    def _run_event(self,event_time,event_pair,which):
+        if which == 0:
+            if (event_pair.count_0 == 0) and (event_pair.start_callback is not None):
+                event_pair.start_callback(event_pair.arg)
+            event_pair.count_0 += 1
+            event_pair.callback_0(event_pair.arg)
+            if (not event_pair.removed) and ((event_pair.count < 0) or (event_pair.count_0 < event_pair.count)):
+                self._schedule(event_time + event_pair.period,event_pair,0)
+        else:
+            event_pair.count_1 += 1
+            event_pair.callback_1(event_pair.arg)
+            if event_pair.removed:
+                return
+            if (event_pair.count < 0) or (event_pair.count_1 < event_pair.count):
+                self._schedule(event_time + event_pair.period,event_pair,1)
+            else:
+                event_pair.removed = True
+                if event_pair.stop_callback is not None:
+                    event_pair.stop_callback(event_pair.arg)
+
+    def _remove_all_events(self):
+        for event in self._events:
+            event[2].removed = True
+        self._events = []
+
+    # IndexedContainer
+    def _indexed_pwms_size(self):
+        return sum(1 for pwm_info in self._indexed_pwms if pwm_info is not None)
+
+    def _indexed_pwms_add(self,pwm_info):
+        index = self._indexed_pwms.index(None)
+        self._indexed_pwms[index] = pwm_info
+        return index
+
+    # Controller
+    def _get_high_freq_index(self,relay):
+        if RELAY_PINS[relay] in HIGH_FREQ_RELAY_PINS:
+            return HIGH_FREQ_RELAY_PINS.index(RELAY_PINS[relay])
+        return -1
+
+    def _open_relay(self,relay):
+        self._power[relay] = POWER_MIN
+
+    def _set_relay_power(self,relay,power):
+        if power >= POWER_MAX:
+            self._power[relay] = POWER_MAX
+        else:
+            self._power[relay] = power
+
+    def _set_all_pwm_status_stopped(self):
+        for relay in range(RELAY_COUNT):
+            for level in range(PWM_LEVEL_COUNT_MAX + 1):
+                self._pwm_status[relay][level] = PWM_STOPPED
+
+    def _notify(self,relay,level,power):
+        if level < self._notify_level[relay]:
+            return
+        if len(self._notifications) < NOTIFICATION_QUEUE_SIZE:
+            notification = collections.OrderedDict([('seq',self._notification_seq),
+                                                    ('time',self._millis())])
+            if self._frame_relay != FRAME_RELAY_DISABLED:
+                notification['frame'] = self._pulse_counts[self._frame_relay]
+            notification['relay'] = relay
+            notification['level'] = level
+            notification['pwm_status'] = self._pwm_status[relay][level]
+            notification['power'] = power
+            self._notifications.append(notification)
+        # seq still advances when the queue is full so the host can detect dropped notifications
+        self._notification_seq = (self._notification_seq + 1) % UNSIGNED_LONG_MAX
+
+    def _write_notifications(self):
+        while self._notifications:
+            notification = self._notifications.popleft()
+            if self._protocol == PROTOCOL_BINARY:
+                self._output.extend(encode_notification(notification))
+            else:
+                self._output.extend((json.dumps(notification,separators=(',',':')) + '\n').encode())
+
+    def _write(self,value):
+        self._output.extend(json.dumps(value,separators=(',',':')).encode())
+
+    def _method_has_result(self,method_id):
+        return method_id in (METHOD_ID_GET_POWER,METHOD_ID_GET_PWM_STATUS,METHOD_ID_GET_STATE,METHOD_ID_GET_PULSE_COUNTS,
+                             METHOD_ID_SET_PROTOCOL)
+
+    def _clear_request_ids(self):
+        self._request_ids = [-1]*REQUEST_ID_HISTORY_SIZE
+        self._request_id_index = 0
+
+    def _request_id_is_duplicate(self,request_id):
+        if request_id in self._request_ids:
+            return True
+        self._request_ids[self._request_id_index] = request_id
+        self._request_id_index = (self._request_id_index + 1) % REQUEST_ID_HISTORY_SIZE
+        return False
+
+    def _process_line(self,line):
+        self._debug_print('virtual board request', line)
+        try:
+            message = json.loads(line.decode('utf8'))
+        except (ValueError, UnicodeDecodeError):
+            return
+        if (not isinstance(message,list)) or (len(message) == 0):
+            return
+        try:
+            self._process_message(message)
+        except (TypeError, ValueError, IndexError):
+            # the firmware reads missing or malformed arguments as 0
+            pass
+
+    def _process_message(self,message):
+        position = 0
+        method_id = _to_int(message[position])
+        position += 1
+        request_id = -1
+        if method_id == METHOD_ID_REQUEST_ID:
+            request_id = _to_long(message[position])
+            method_id = _to_int(message[position + 1])
+            position += 2
+        args = message[position:]
+
+        has_result = self._method_has_result(method_id)
+        if request_id >= 0:
+            self._output.extend('[{0}'.format(request_id).encode())
+            if has_result:
+                self._output.extend(b',')
+            elif self._request_id_is_duplicate(request_id):
+                self._output.extend(b']\n')
+                return
+
+        result = self._run_method(method_id,args)
+        if has_result:
+            self._write(result)
+
+        if request_id >= 0:
+            self._output.extend(b']\n')
+        elif has_result:
+            self._output.extend(b'\n')
+
+    def _process_frame(self,payload):
+        '''
+        Binary requests always carry a request id and are answered with
+        a binary reply frame, whatever the protocol of notifications.
+        '''
+        self._debug_print('virtual board frame', payload)
+        try:
+            method_id, request_id, args = decode_request(payload)
+        except ProtocolError:
+            return
+        has_result = self._method_has_result(method_id)
+        if (not has_result) and self._request_id_is_duplicate(request_id):
+            self._output.extend(encode_reply(method_id,request_id))
+            return
+        result = self._run_method(method_id,args)
+        self._output.extend(encode_reply(method_id,request_id,result if has_result else None))
+
+    def _run_method(self,method_id,args):
+        if method_id == METHOD_ID_START_PWM:
+            self._start_pwm_callback(args)
+        elif method_id == METHOD_ID_STOP_ALL_PULSES:
+            self._stop_all_pwm_callback()
+        elif method_id == METHOD_ID_GET_POWER:
+            return list(self._power)
+        elif method_id == METHOD_ID_GET_PWM_STATUS:
+            return [list(statuses) for statuses in self._pwm_status]
+        elif method_id == METHOD_ID_GET_STATE:
+            return [self._millis(),list(self._power),[list(statuses) for statuses in self._pwm_status],list(self._pulse_counts)]
+        elif method_id == METHOD_ID_SET_NOTIFY:
+            self._set_notify_callback(args)
+        elif method_id == METHOD_ID_GET_PULSE_COUNTS:
+            return [self._millis(),list(self._pulse_counts)]
+        elif method_id == METHOD_ID_SET_FRAME_RELAY:
+            self._set_frame_relay_callback(args)
+        elif method_id == METHOD_ID_SET_PROTOCOL:
+            return self._set_protocol_callback(args)
+        elif method_id == METHOD_ID_SET_WAVEFORM:
+            self._set_waveform_callback(args)
+        return None
+
+    # Callbacks
+    def _start_pwm_callback(self,args):
+        args = list(args)
+        relay = _to_int(args[0])
+        if (relay < 0) or (relay >= RELAY_COUNT):
+            return
+        power = min(max(_to_int(args[1]),POWER_MIN),POWER_MAX)
+        if (power < POWER_MAX) and (self._get_high_freq_index(relay) < 0):
+            power = POWER_MAX
+        delay = _to_long(args[2])
+        count = _to_int(args[3])
+        pwm_level_count = min(max(_to_int(args[4]),PWM_LEVEL_COUNT_MIN),PWM_LEVEL_COUNT_MAX)
+        if (INDEXED_PWMS_COUNT_MAX - self._indexed_pwms_size()) < pwm_level_count:
+            return
+        pwm_args = [_to_long(arg) for arg in args[5:5 + 2*pwm_level_count]]
+        pwm_args += [0]*(2*pwm_level_count - len(pwm_args))
+
+        child_index = -1
+        for pwm_level in range(pwm_level_count):
+            pwm_info = _PwmInfo(relay,power,pwm_level,child_index,pwm_args[2*pwm_level],pwm_args[2*pwm_level + 1])
+            child_index = self._indexed_pwms_add(pwm_info)
+        index = child_index
+
+        if count < 0:
+            self._add_pwm(self._start_power_pwm_event_callback,
+                          self._stop_pwm_event_callback,
+                          delay,
+                          pwm_info.period,
+                          pwm_info.on_duration,
+                          -1,
+                          index,
+                          self._set_parent_pwm_status_running_event_callback)
+        else:
+            self._add_pwm(self._start_power_pwm_event_callback,
+                          self._stop_pwm_event_callback,
+                          delay,
+                          pwm_info.period,
+                          pwm_info.on_duration,
+                          count,
+                          index,
+                          self._set_parent_pwm_status_running_event_callback,
+                          self._set_parent_pwm_status_stopped_event_callback)
+
+    def _stop_all_pwm_callback(self):
+        self._remove_all_events()
+        self._indexed_pwms = [None]*INDEXED_PWMS_COUNT_MAX
+        self._stop_all_waveforms()
+        for relay in range(RELAY_COUNT):
+            self._open_relay(relay)
+        self._set_all_pwm_status_stopped()
+        self._pulse_counts = [0]*RELAY_COUNT
+
+    def _set_notify_callback(self,args):
+        relay = _to_int(args[0])
+        if (relay < 0) or (relay >= RELAY_COUNT):
+            return
+        level = _to_int(args[1])
+        self._notify_level[relay] = min(max(level,0),NOTIFY_LEVEL_DISABLED)
+
+    def _set_frame_relay_callback(self,args):
+        relay = _to_int(args[0])
+        if (relay < 0) or (relay >= RELAY_COUNT):
+            relay = FRAME_RELAY_DISABLED
+        self._frame_relay = relay
+
+    def _set_protocol_callback(self,args):
+        protocol = _to_int(args[0]) if args else PROTOCOL_JSON
+        if protocol in (PROTOCOL_JSON,PROTOCOL_BINARY):
+            self._protocol = protocol
+        # sent once by every host that connects, which numbers its
+        # requests from the start again
+        self._clear_request_ids()
+        return self._protocol
+
+    def _set_waveform_callback(self,args):
+        args = list(args) + [0]*(5 + 2*WAVEFORM_POINTS_PER_REQUEST - len(args))
+        relay = _to_int(args[0])
+        if (relay < 0) or (relay >= RELAY_COUNT):
+            return
+        index = self._get_high_freq_index(relay)
+        if index < 0:
+            return
+        level = _to_int(args[1])
+        offset = _to_long(args[2])
+        point_count = _to_int(args[3])
+        first_point = _to_int(args[4])
+        if ((level < 0) or (level >= PWM_LEVEL_COUNT_MAX) or
+            (point_count < 0) or (point_count > WAVEFORM_POINT_COUNT_MAX) or
+            (first_point < 0) or (first_point > point_count)):
+            return
+        waveform = self._waveforms[index]
+        waveform.relay = relay
+        waveform.level = level
+        waveform.offset = max(offset,0)
+        waveform.point_count = point_count
+        position = 5
+        for point in range(first_point,min(point_count,first_point + WAVEFORM_POINTS_PER_REQUEST)):
+            waveform.times[point] = _to_long(args[position]) % UNSIGNED_LONG_MAX
+            waveform.powers[point] = min(max(_to_int(args[position + 1]),POWER_MIN),POWER_MAX)
+            position += 2
+
+    def _get_waveform_power(self,index,elapsed):
+        '''
+        Returns the power of the waveform at index elapsed ms into its
+        on period and when that power changes next, or elapsed when it
+        never does.
+        '''
+        waveform = self._waveforms[index]
+        point = 0
+        while (point < waveform.point_count) and (waveform.times[point] <= elapsed):
+            point += 1
+        if point == 0:
+            return waveform.powers[0], waveform.times[0]
+        if point == waveform.point_count:
+            return waveform.powers[point - 1], elapsed
+        time_0 = waveform.times[point - 1]
+        duration = waveform.times[point] - time_0
+        power_0 = waveform.powers[point - 1]
+        power_delta = waveform.powers[point] - power_0
+        if power_delta == 0:
+            return power_0, waveform.times[point]
+        power_delta_abs = abs(power_delta)
+        step = (power_delta_abs*(elapsed - time_0))//duration
+        next_elapsed = time_0 + ((step + 1)*duration + power_delta_abs - 1)//power_delta_abs
+        if power_delta > 0:
+            return power_0 + step, next_elapsed
+        return power_0 - step, next_elapsed
+
+    def _update_waveform(self,index):
+        waveform = self._waveforms[index]
+        waveform.power, next_elapsed = self._get_waveform_power(index,waveform.elapsed)
+        if next_elapsed > waveform.elapsed:
+            waveform.step_event = self._add_event(self._waveform_step_event_callback,next_elapsed - waveform.elapsed,index)
+            waveform.elapsed = next_elapsed
+
+    def _start_waveform(self,index):
+        self._stop_waveform(index)
+        waveform = self._waveforms[index]
+        waveform.running = True
+        waveform.elapsed = waveform.offset
+        waveform.offset = 0
+        self._update_waveform(index)
+
+    def _stop_waveform(self,index):
+        waveform = self._waveforms[index]
+        if waveform.step_event is not None:
+            waveform.step_event.removed = True
+            waveform.step_event = None
+        waveform.running = False
+
+    def _stop_all_waveforms(self):
+        for waveform in self._waveforms:
+            waveform.step_event = None
+            waveform.running = False
+
+    def _get_pwm_power(self,index):
+        pwm_info = self._indexed_pwms[index]
+        high_freq_index = self._get_high_freq_index(pwm_info.relay)
+        if high_freq_index >= 0:
+            waveform = self._waveforms[high_freq_index]
+            if waveform.running:
+                return waveform.power
+            if (waveform.point_count > 0) and (waveform.level == pwm_info.level):
+                return self._get_waveform_power(high_freq_index,waveform.offset)[0]
+        return pwm_info.power
+
+    def _set_parent_pwm_status_running_event_callback(self,index):
+        pwm_info = self._indexed_pwms[index]
+        level = pwm_info.level + 1
+        self._pwm_status[pwm_info.relay][level] = PWM_RUNNING
+        self._notify(pwm_info.relay,level,self._get_pwm_power(index))
+
+    def _remove_parent_and_children(self,index):
+        if index >= 0:
+            self._remove_parent_and_children(self._indexed_pwms[index].child_index)
+            self._indexed_pwms[index] = None
+
+    def _set_parent_pwm_status_stopped_event_callback(self,index):
+        pwm_info = self._indexed_pwms[index]
+        level = pwm_info.level + 1
+        self._pwm_status[pwm_info.relay][level] = PWM_STOPPED
+        self._notify(pwm_info.relay,level,POWER_MIN)
+        self._remove_parent_and_children(index)
+
+    def _start_power_pwm_event_callback(self,index):
+        pwm_info = self._indexed_pwms[index]
+        self._pwm_status[pwm_info.relay][pwm_info.level] = PWM_RUNNING
+        high_freq_index = self._get_high_freq_index(pwm_info.relay)
+        if ((high_freq_index >= 0) and
+            (self._waveforms[high_freq_index].point_count > 0) and
+            (self._waveforms[high_freq_index].level == pwm_info.level)):
+            self._start_waveform(high_freq_index)
+        power = self._get_pwm_power(index)
+        if pwm_info.child_index < 0:
+            self._set_relay_power(pwm_info.relay,power)
+            if pwm_info.power > POWER_MIN:
+                self._pulse_counts[pwm_info.relay] = (self._pulse_counts[pwm_info.relay] + 1) % UNSIGNED_LONG_MAX
+        else:
+            child = self._indexed_pwms[pwm_info.child_index]
+            child.event_pair = self._add_pwm(self._start_power_pwm_event_callback,
+                                             self._stop_pwm_event_callback,
+                                             0,
+                                             child.period,
+                                             child.on_duration,
+                                             -1,
+                                             pwm_info.child_index)
+        self._notify(pwm_info.relay,pwm_info.level,power)
+
+    def _stop_pwm_event_callback(self,index):
+        pwm_info = self._indexed_pwms[index]
+        self._open_relay(pwm_info.relay)
+        self._pwm_status[pwm_info.relay][pwm_info.level] = PWM_STOPPED
+        high_freq_index = self._get_high_freq_index(pwm_info.relay)
+        if ((high_freq_index >= 0) and
+            self._waveforms[high_freq_index].running and
+            (self._waveforms[high_freq_index].level == pwm_info.level)):
+            self._stop_waveform(high_freq_index)
+        self._notify(pwm_info.relay,pwm_info.level,POWER_MIN)
+        if pwm_info.child_index >= 0:
+            child = self._indexed_pwms[pwm_info.child_index]
+            if child.event_pair is not None:
+                child.event_pair.removed = True
+            self._stop_pwm_event_callback(pwm_info.child_index)
+
+    def _waveform_step_event_callback(self,index):
+        waveform = self._waveforms[index]
+        waveform.step_event = None
+        if not waveform.running:
+            return
+        power = waveform.power
+        self._update_waveform(index)
+        if waveform.power != power:
+            if self._pwm_status[waveform.relay][0] == PWM_RUNNING:
+                self._set_relay_power(waveform.relay,waveform.power)
+            self._notify(waveform.relay,waveform.level,waveform.power)
+
+
+class VirtualTransport(object):
+    '''
+    Blocking transport to a VirtualRelayBoard with the interface of
+    SerialTransport.
+
+    Requests use the same request id framing, protocols and reply
+    parsing as SerialTransport, but are answered synchronously, and waiting for a
+    notification advances the clock straight to the next board event,
+    so nothing ever waits in real time on a VirtualClock.
+
+    Example Usage:
+
+    transport = VirtualTransport(VirtualRelayBoard(VirtualClock()))
+    result = transport.request_sync(method_id)
+    '''
+    REQUEST_ID_MAX = 2**31 - 1
+
+    def __init__(self,board,*args,**kwargs):
+        self.debug = kwargs.pop('debug',DEBUG)
+        self._metrics = kwargs.pop('metrics',None)
+        if self._metrics is None:
+            self._metrics = Metrics()
+        self._tracer = kwargs.pop('tracer',None)
+        if self._tracer is None:
+            self._tracer = Tracer()
+        self._board = board
+        self._clock = board._clock
+        self._request_id = 0
+        self._encoder = RequestEncoder(PROTOCOL_JSON)
+        self._notifications = collections.deque()
+        self._parser = FrameParser()
+
+    def _debug_print(self, *args):
+        if self.debug:
+            print(*args)
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_tracer(self):
+        return self._tracer
+
+    def get_board(self):
+        return self._board
+
+    def _next_request_id(self):
+        self._request_id = (self._request_id + 1) % self.REQUEST_ID_MAX
+        return self._request_id
+
+    def _read_responses(self):
+        responses = []
+        for kind, message in self._parser.feed(self._board.read(self._board.in_waiting)):
+            self._debug_print('response', kind, message)
+            try:
+                if kind == 'line':
+                    with self._tracer.span('json_loads'):
+                        response = json.loads(message.decode('utf8'))
+                elif kind == 'frame':
+                    with self._tracer.span('decode_frame'):
+                        response = decode_payload(message)
+                else:
+                    self._metrics.increment('crc_failures')
+                    raise ProtocolError('Bad crc')
+            except (ValueError, UnicodeDecodeError, ProtocolError):
+                self._metrics.increment('parse_failures')
+                print('Error!','\nresponse:',message)
+                continue
+            if isinstance(response,dict):
+                self._metrics.increment('notifications')
+                self._notifications.append(response)
+            else:
+                responses.append(response)
+        return responses
+
+    def request_sync(self,*args):
+        result, time_sent, time_received = self.request_timed_sync(*args)
+        return result
+
+    def request_once_sync(self,*args,**kwargs):
+        # the virtual board is always listening
+        return self.request_sync(*args)
+
+    @traced('request')
+    def request_timed_sync(self,*args):
+        time_sent = self._clock.monotonic()
+        request_id = self._next_request_id()
+        with self._tracer.span('args_to_request'):
+            request = self._encoder.encode(request_id,args)
+        self._debug_print('request', request)
+        with self._tracer.span('board_write'):
+            self._board.write(request)
+        self._metrics.increment('requests',args[0] if args else None)
+        for response in self._read_responses():
+            if isinstance(response,list) and response and (response[0] == request_id):
+                time_received = self._clock.monotonic()
+                self._metrics.observe('request_latency_ms',args[0] if args else None,1000*(time_received - time_sent))
+                if len(response) > 1:
+                    return response[1], time_sent, time_received
+                return None, time_sent, time_received
+        self._metrics.increment('request_failures',args[0] if args else None)
+        raise TransportError('No valid response to request: {0}'.format([request_id] + list(args)))
+
+    def requests_sync(self,requests):
+        return [self.request_sync(*args) for args in requests]
+
+    def set_protocol_sync(self,protocol):
+        result = self.request_sync(METHOD_ID_SET_PROTOCOL,protocol)
+        if result != protocol:
+            protocol = PROTOCOL_JSON
+        self._encoder = RequestEncoder(protocol)
+        return protocol
+
+    def get_protocol(self):
+        return self._encoder.get_protocol()
+
+    def get_next_event_time(self,relay_levels=None):
+        return self._board.get_next_event_time(relay_levels)
+
+    def get_notification(self,timeout=None):
+        '''
+        Returns next notification pushed by the board or None if none
+        arrives within timeout seconds of clock time.
+        '''
+        self._read_responses()
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = self._clock.time() + timeout
+        # step from event to event that can notify until one of them does
+        notify_levels = self._board.get_notify_levels()
+        while not self._notifications:
+            next_event_time = self._board.get_next_event_time(notify_levels)
+            if (next_event_time is None) or ((deadline is not None) and (next_event_time > deadline)):
+                if deadline is not None:
+                    self._clock.sleep(deadline - self._clock.time())
+                    self._read_responses()
+                break
+            self._clock.sleep(next_event_time - self._clock.time())
+            self._read_responses()
+        if self._notifications:
+            return self._notifications.popleft()
+        return None
+
+    def close(self):
+        self._board.close()
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from sleep_assay.activity import ActivityExtractor, extract_activity, grid_well_labels, load_activity, METHODS
+
+
+def make_frames(frame_count=300,shape=(40,60),seed=0):
+    '''
+    Frames with slowly drifting illumination, noise and a square that
+    jumps around, so both methods see motion and the background moves.
+    '''
+    rng = np.random.default_rng(seed)
+    drift = 60*np.sin(np.linspace(0,3*np.pi,frame_count))
+    frames = 100 + drift[:,np.newaxis,np.newaxis] + rng.normal(0,4,(frame_count,) + shape)
+    for frame in range(frame_count):
+        y = rng.integers(0,shape[0] - 6)
+        x = rng.integers(0,shape[1] - 6)
+        frames[frame,y:y + 6,x:x + 6] += 80
+    return np.clip(np.round(frames),0,255).astype(np.uint8)
+
+
+def process_in_chunks(extractor,frames,chunk_frames):
+    return np.concatenate([extractor.process(frames[start:start + chunk_frames])
+                           for start in range(0,len(frames),chunk_frames)])
+
+
+@pytest.mark.parametrize('method',METHODS)
+def test_chunk_size_does_not_change_activity(method):
+    frames = make_frames()
+    labels = grid_well_labels(frames.shape[1:3],2,3)
+    expected = ActivityExtractor(labels,method=method,threshold=10,alpha=0.05).process(frames)
+    assert expected.sum() > 0
+    for chunk_frames in (1,7,256):
+        extractor = ActivityExtractor(labels,method=method,threshold=10,alpha=0.05)
+        assert np.array_equal(process_in_chunks(extractor,frames,chunk_frames),expected)
+
+
+@pytest.mark.parametrize('method',METHODS)
+def test_state_continues_a_recording(method):
+    frames = make_frames()
+    labels = grid_well_labels(frames.shape[1:3],2,3)
+    expected = ActivityExtractor(labels,method=method,threshold=10,alpha=0.05).process(frames)
+    extractor = ActivityExtractor(labels,method=method,threshold=10,alpha=0.05)
+    extractor.process(frames[:120])
+    extractor = ActivityExtractor(labels,method=method,threshold=10,alpha=0.05,state=extractor.get_state())
+    assert np.array_equal(extractor.process(frames[120:]),expected[120:])
+
+
+@pytest.mark.parametrize('method',METHODS)
+def test_range_matches_whole_recording(method,tmp_path):
+    frames_file_path = str(tmp_path/'frames.npy')
+    np.save(frames_file_path,make_frames())
+    labels = grid_well_labels((40,60),2,3)
+    whole_file_path = str(tmp_path/'whole.bin')
+    range_file_path = str(tmp_path/'range.bin')
+    extract_activity(frames_file_path,whole_file_path,labels,32,method=method,threshold=10,alpha=0.05)
+    extract_activity(frames_file_path,range_file_path,labels,32,100,200,method=method,threshold=10,alpha=0.05)
+    video_frame, activity = load_activity(range_file_path)
+    assert np.array_equal(video_frame,np.arange(100,200))
+    assert np.array_equal(activity,load_activity(whole_file_path)[1][100:200])
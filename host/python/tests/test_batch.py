@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from sleep_assay.activity import extract_activity, grid_well_labels, load_activity, METHODS
+from sleep_assay.batch import ActivityJob, run_jobs
+
+from test_activity import make_frames
+
+
+@pytest.mark.parametrize('method',METHODS)
+def test_merged_job_matches_single_pass(method,tmp_path):
+    frames_file_path = str(tmp_path/'frames.npy')
+    np.save(frames_file_path,make_frames())
+    labels = grid_well_labels((40,60),2,3)
+    single_file_path = str(tmp_path/'single.bin')
+    extract_activity(frames_file_path,single_file_path,labels,method=method,threshold=10,alpha=0.05)
+    job = ActivityJob(frames_file_path,str(tmp_path/'job'),labels,chunk_frames=16,job_chunk_frames=70,
+                      method=method,threshold=10,alpha=0.05)
+    run_jobs([job],workers=2)
+    merged_file_path = str(tmp_path/'merged.bin')
+    assert job.merge(merged_file_path) == 300
+    assert np.array_equal(load_activity(merged_file_path)[1],load_activity(single_file_path)[1])
@@ -0,0 +1,46 @@
+import datetime
+import json
+import time
+
+import numpy as np
+
+from sleep_assay.data_writer import DataWriter, load_data_index
+
+
+def write_rows(data_writer,epochs):
+    for video_frame, epoch in enumerate(epochs):
+        data_writer.write(video_frame,epoch,video_frame,'entrainment',100,0,0)
+
+
+def test_daily_rotation_follows_row_epochs(tmp_path):
+    midnight = time.mktime(datetime.date(2016,7,16).timetuple())
+    epochs = midnight + np.arange(-5,5)*3600.0
+    data_writer = DataWriter(str(tmp_path),'run',rotate_daily=True)
+    write_rows(data_writer,epochs)
+    assert data_writer.close() == 0
+    with open(data_writer.get_index_file_path(),'r') as index_file:
+        segments = json.load(index_file)['segments']
+    assert [segment['rows'] for segment in segments] == [5,5]
+    assert np.array_equal(load_data_index(data_writer.get_index_file_path())['epoch'],epochs)
+
+
+def test_dropped_rows_are_reported_from_writer_thread(tmp_path,capsys):
+    data_writer = DataWriter(str(tmp_path),'run',queue_size=1)
+    write_rows(data_writer,1e9 + np.arange(1000))
+    data_writer.close()
+    assert data_writer.get_dropped_row_count() > 0
+    # once as they start and once on close, not once per row
+    assert capsys.readouterr().out.count('rows dropped') <= 2
+    assert data_writer.get_written_row_count() + data_writer.get_dropped_row_count() == 1000
+
+
+def test_close_gives_up_on_failing_disk(tmp_path):
+    data_writer = DataWriter(str(tmp_path),'run',close_timeout=0.2)
+    data_writer.RETRY_DELAY = 0.01
+    def write_rows_failing(rows):
+        raise OSError('disk')
+    data_writer._write_rows = write_rows_failing
+    write_rows(data_writer,1e9 + np.arange(10))
+    time_start = time.monotonic()
+    assert data_writer.close() == 10
+    assert time.monotonic() - time_start < 5
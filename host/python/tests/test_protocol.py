@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from sleep_assay.protocol import (CONSTANT_REQUESTS, FRAME_PAYLOAD_SIZE_MAX, FRAME_SYNC, METHOD_ID_GET_STATE,
+                                  METHOD_ID_REQUEST_ID, METHOD_ID_SET_WAVEFORM, PROTOCOL_BINARY, PROTOCOL_JSON,
+                                  FrameParser, ProtocolError, RequestEncoder, crc16, decode_payload,
+                                  decode_request, encode_json_request, encode_notification, encode_reply,
+                                  encode_request)
+
+
+STATE = [123456,[0,100,0,0,0,0,0,255],[[1,0,0,0]]*8,[1,2,3,4,5,6,7,8]]
+NOTIFICATION = {'seq': 7, 'time': 1000, 'frame': 42, 'relay': 1, 'level': 0, 'pwm_status': 1, 'power': 100}
+
+
+def feed_bytes(parser,chars):
+    # one byte at a time, like a slow serial link
+    messages = []
+    for position in range(len(chars)):
+        messages.extend(parser.feed(chars[position:position + 1]))
+    return messages
+
+
+def test_crc_matches_firmware_crc():
+    # CRC-16/CCITT-FALSE check value, what _crc_xmodem_update gives from 0xFFFF
+    assert crc16(b'123456789') == 0x29B1
+
+
+@pytest.mark.parametrize('protocol',[PROTOCOL_JSON,PROTOCOL_BINARY])
+def test_constant_requests_match_full_encoding(protocol):
+    encoder = RequestEncoder(protocol)
+    for args in CONSTANT_REQUESTS:
+        for request_id in (0,1,2**31 - 2):
+            if protocol == PROTOCOL_BINARY:
+                expected = encode_request(request_id,args)
+            else:
+                expected = encode_json_request(request_id,args)
+            assert encoder.encode(request_id,args) == expected
+    assert json.loads(RequestEncoder(PROTOCOL_JSON).encode(5,CONSTANT_REQUESTS[0]))[:2] == [METHOD_ID_REQUEST_ID,5]
+
+
+def test_request_round_trips_through_parser():
+    args = [METHOD_ID_SET_WAVEFORM,1,0,-5,4,2,0,10,1000,20]
+    messages = feed_bytes(FrameParser(),encode_request(9,args))
+    assert [kind for kind, chars in messages] == ['frame']
+    method_id, request_id, decoded_args = decode_request(messages[0][1])
+    assert (method_id,request_id) == (METHOD_ID_SET_WAVEFORM,9)
+    assert decoded_args == args[1:]
+
+
+def test_replies_notifications_and_lines_share_the_stream():
+    chars = (encode_reply(METHOD_ID_GET_STATE,3,STATE) + b'[4,[1,2]]\n' +
+             encode_notification(NOTIFICATION) + encode_reply(METHOD_ID_GET_STATE,5))
+    messages = feed_bytes(FrameParser(),chars)
+    assert [kind for kind, chars in messages] == ['frame','line','frame','frame']
+    assert decode_payload(messages[0][1]) == [3,STATE]
+    assert json.loads(messages[1][1]) == [4,[1,2]]
+    assert dict(decode_payload(messages[2][1])) == NOTIFICATION
+    assert decode_payload(messages[3][1]) == [5]
+
+
+def test_parser_resyncs_after_bad_frames():
+    reply = encode_reply(METHOD_ID_GET_STATE,3,STATE)
+    corrupt = bytearray(reply)
+    corrupt[10] ^= 0xFF
+    lost_byte = reply[:5] + reply[6:]
+    too_long = bytes((FRAME_SYNC,FRAME_PAYLOAD_SIZE_MAX + 1))
+    for bad in (bytes(corrupt),lost_byte,too_long):
+        messages = feed_bytes(FrameParser(),bad + reply + b'[6]\n')
+        frames = [chars for kind, chars in messages if kind == 'frame']
+        assert [decode_payload(chars) for chars in frames] == [[3,STATE]]
+        assert 'crc_error' in [kind for kind, chars in messages]
+        assert messages[-1] == ('line',b'[6]')
+
+
+def test_bad_payloads_raise_protocol_error():
+    with pytest.raises(ProtocolError):
+        decode_payload(b'')
+    with pytest.raises(ProtocolError):
+        decode_payload(encode_reply(METHOD_ID_GET_STATE,3,STATE)[2:-3])
@@ -0,0 +1,46 @@
+import json
+import queue
+
+from sleep_assay.transport import SerialTransport
+
+
+# any method, the device answers them all the same
+METHOD_ID = 2
+
+
+class ReplyingDevice(object):
+    '''
+    Serial device that answers every json request with the given bad
+    replies before the good one.
+    '''
+    def __init__(self,bad_replies):
+        self._bad_replies = bad_replies
+        self._chars = queue.Queue()
+
+    @property
+    def in_waiting(self):
+        return self._chars.qsize()
+
+    def read(self,size):
+        try:
+            chars = self._chars.get(timeout=0.05)
+        except queue.Empty:
+            return b''
+        return chars
+
+    def write(self,request):
+        request_id = json.loads(request.decode())[1]
+        for reply in self._bad_replies + [[request_id,7]]:
+            self._chars.put((json.dumps(reply) + '\n').encode())
+
+
+def test_reply_with_bad_request_id_is_a_parse_failure():
+    bad_replies = [[[1],0],[{'1': 1},0],[True,0],[1.0,0],['1',0]]
+    transport = SerialTransport(ReplyingDevice(bad_replies),write_write_delay=0)
+    try:
+        assert transport.request_sync(METHOD_ID) == 7
+        metrics = transport.get_metrics()
+        assert metrics.get_counter('parse_failures') == len(bad_replies)
+        assert metrics.get_counter('late_replies') == 0
+    finally:
+        transport.close()